@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Benchmark the vectorized electronic chemical potential solver against a brentq loop
+
+The brentq loop over temperatures is how ``calculate_thermal_electronic_contribution``
+solved for the chemical potential before ``calculate_chemical_potential``. Run with
+
+    python benchmarks/chemical_potential.py
+"""
+
+from __future__ import division, print_function
+import time
+
+import numpy as np
+from scipy.optimize import brentq
+from pymatgen import Spin
+from pymatgen.electronic_structure.dos import Dos
+
+from prlworkflows.analysis.thermal_electronic import getdos, gfind, calculate_chemical_potential, k_B
+
+################################################################################
+#                                CONFIGURATION                                 #
+################################################################################
+
+ndosmx = 10001  # number of points in the DOS grid
+t_max = 2000  # maximum temperature
+t_step = 5  # temperature step size
+memory_budgets = [None, 16]  # memory budgets in MB to benchmark the vectorized solver with
+repeats = 3  # best of this many runs is reported
+
+
+################################################################################
+#                                     RUN                                      #
+################################################################################
+
+def metallic_dos():
+    """Synthetic metallic DOS: a free electron band with a d band at the Fermi level"""
+    energies = np.linspace(-12.0, 8.0, 3001)
+    band = energies + 10.0
+    densities = 0.3*np.sqrt(np.clip(band, 0, None)) + 2.0/(1.0 + ((energies + 0.5)/1.5)**2)*(band > 0)
+    return Dos(0.0, energies, {Spin.up: densities})
+
+
+def best_time(func, repeats):
+    """Best wall time of several calls and the result of the last call"""
+    times = []
+    for _ in range(repeats):
+        tick = time.time()
+        result = func()
+        times.append(time.time() - tick)
+    return min(times), result
+
+
+def main():
+    n_electrons, fermi_shift, energies, densities = getdos(metallic_dos(), -100, 100, 0.0, ndosmx, 1000)
+    temperatures = np.arange(0, t_max + t_step, t_step)
+    beta = 1.0/(temperatures*k_B)
+    beta[0] = 1.0e30
+
+    def brentq_loop():
+        return np.array([brentq(gfind, -5.0, 5.0, args=(energies, densities, n_electrons, b), maxiter=10000) for b in beta])
+
+    brentq_time, brentq_mu = best_time(brentq_loop, repeats)
+    print('{} DOS points, {} temperatures from 0 K to {} K'.format(energies.size, temperatures.size, t_max))
+    print('brentq loop: {:.3f} s'.format(brentq_time))
+    for memory_budget in memory_budgets:
+        solver_time, solver_mu = best_time(lambda: calculate_chemical_potential(energies, densities, n_electrons, beta, memory_budget=memory_budget), repeats)
+        # at 0 K the root is only defined to within the DOS grid spacing
+        max_difference = np.max(np.abs(solver_mu[1:] - brentq_mu[1:]))
+        print('vectorized (memory_budget={}): {:.3f} s, {:.1f}x speedup, max |delta mu| = {:.1e} eV'.format(
+            memory_budget, solver_time, brentq_time/solver_time, max_difference))
+
+
+if __name__ == '__main__':
+    main()
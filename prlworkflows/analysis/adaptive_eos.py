@@ -0,0 +1,117 @@
+"""
+Adaptive sampling of E-V curves
+
+Decides which volumes to calculate next so that the minimum of the E-V curve is bracketed and
+the equilibrium volume and bulk modulus of the EOS fit reach a target uncertainty.
+"""
+
+from __future__ import division
+
+import numpy as np
+from pymatgen.analysis.eos import EOS, PolynomialEOS
+
+
+def eos_parameter_errors(eos_fit):
+    """
+    Standard errors of the parameters of a least squares EOS fit
+
+    The covariance of the parameters is estimated from the Jacobian of the EOS at the optimum
+    and the residual variance, i.e. sigma^2 (J^T J)^-1.
+
+    Parameters
+    ----------
+    eos_fit : pymatgen.analysis.eos.EOSBase
+        Fitted (non-polynomial) equation of state
+
+    Returns
+    -------
+    numpy.ndarray
+        Standard errors of the parameters (e0, b0, b1, v0). Infinite if there are not more
+        volumes than parameters or the parameters are not determined by the volumes.
+    """
+    if isinstance(eos_fit, PolynomialEOS):
+        raise ValueError('Parameter errors are only supported for non-polynomial EOS')
+    volumes = np.asarray(eos_fit.volumes, dtype=float)
+    energies = np.asarray(eos_fit.energies, dtype=float)
+    params = np.asarray(eos_fit.eos_params, dtype=float)
+    n_params = params.size
+    if volumes.size <= n_params:
+        return np.full(n_params, np.inf)
+    # central differences of the EOS with respect to each parameter
+    jacobian = np.empty((volumes.size, n_params))
+    for j in range(n_params):
+        step = 1e-6*max(abs(params[j]), 1e-8)
+        delta = np.zeros(n_params)
+        delta[j] = step
+        jacobian[:, j] = (eos_fit._func(volumes, params + delta) - eos_fit._func(volumes, params - delta))/(2*step)
+    residuals = energies - eos_fit._func(volumes, params)
+    variance = np.dot(residuals, residuals)/(volumes.size - n_params)
+    try:
+        covariance = variance*np.linalg.inv(np.dot(jacobian.T, jacobian))
+    except np.linalg.LinAlgError:
+        return np.full(n_params, np.inf)
+    return np.sqrt(np.abs(np.diag(covariance)))
+
+
+def next_eos_volumes(volumes, energies, eos='vinet', v0_tolerance=1e-3, b0_tolerance=1e-2, num_new=2):
+    """
+    Volumes to add to an E-V curve, or an empty list if the EOS fit is converged
+
+    1. If the lowest energy is at the smallest or largest volume, the minimum is not bracketed
+       and num_new volumes are added beyond that end with the average volume spacing.
+    2. If there are too few volumes to estimate the uncertainty of the fit, one volume is added
+       at each end.
+    3. If the relative standard error of v0 or b0 is above its tolerance, num_new volumes are
+       added at the midpoints of the widest intervals closest to v0.
+
+    Parameters
+    ----------
+    volumes : list
+        Volumes of the E-V curve
+    energies : list
+        Energies of the E-V curve
+    eos : str
+        Equation of state to fit. Defaults to 'vinet'.
+    v0_tolerance : float
+        Target relative standard error of the equilibrium volume. Defaults to 1e-3.
+    b0_tolerance : float
+        Target relative standard error of the bulk modulus. Defaults to 1e-2.
+    num_new : int
+        Number of volumes to add per iteration. Defaults to 2.
+
+    Returns
+    -------
+    tuple
+        Tuple of (new volumes, status). status is a dictionary of whether the minimum is
+        'bracketed' and, if it is, the fitted 'v0' and 'b0_GPa' and their relative standard
+        errors 'v0_relative_error' and 'b0_relative_error'.
+    """
+    order = np.argsort(volumes)
+    volumes = np.asarray(volumes, dtype=float)[order]
+    energies = np.asarray(energies, dtype=float)[order]
+    spacing = np.mean(np.diff(volumes))
+    steps = spacing*np.arange(1, num_new + 1)
+
+    min_idx = np.argmin(energies)
+    if min_idx == 0:
+        return (volumes[0] - steps[::-1]).tolist(), {'bracketed': False}
+    if min_idx == volumes.size - 1:
+        return (volumes[-1] + steps).tolist(), {'bracketed': False}
+
+    eos_fit = EOS(eos).fit(volumes, energies)
+    errors = eos_parameter_errors(eos_fit)
+    status = {
+        'bracketed': True,
+        'v0': float(eos_fit.v0),
+        'b0_GPa': float(eos_fit.b0_GPa),
+        'v0_relative_error': float(errors[3]/abs(eos_fit.v0)),
+        'b0_relative_error': float(errors[1]/abs(eos_fit.b0)),
+    }
+    if not np.all(np.isfinite(errors)):
+        return [volumes[0] - spacing, volumes[-1] + spacing], status
+    if status['v0_relative_error'] <= v0_tolerance and status['b0_relative_error'] <= b0_tolerance:
+        return [], status
+    gaps = np.diff(volumes)
+    midpoints = volumes[:-1] + gaps/2
+    score = gaps/(1. + np.abs(midpoints - eos_fit.v0)/spacing)
+    return sorted(midpoints[np.argsort(-score)[:num_new]].tolist()), status
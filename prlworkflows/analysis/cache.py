@@ -0,0 +1,138 @@
+"""
+Persistent on-disk cache for analysis results made of numpy arrays
+"""
+
+from __future__ import division
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+
+def hash_arrays(arrays, params=None):
+    """
+    Content hash of a sequence of numpy arrays and a dictionary of JSON serializable parameters
+
+    Parameters
+    ----------
+    arrays : list
+        List of array-like objects. The dtype, shape and data of each array are hashed.
+    params : dict
+        Parameters that the cached result depends on
+
+    Returns
+    -------
+    str
+        Hex digest of the SHA-256 hash
+    """
+    sha = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        sha.update(array.dtype.str.encode('ascii'))
+        sha.update(str(array.shape).encode('ascii'))
+        sha.update(array.tobytes())
+    sha.update(json.dumps(params or {}, sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class ArrayCache(object):
+    """
+    Content-addressed cache of dictionaries of numpy arrays, stored as .npz files in a directory
+
+    The cache is bounded by size. When it grows beyond ``max_size``, the least recently used
+    entries are evicted. Reading an entry marks it as recently used by updating its
+    modification time, so several processes can safely share one cache directory.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache. Created if it does not exist.
+    max_size : float
+        Maximum size of the cache in MB. Defaults to 1024.
+    """
+    suffix = '.npz'
+
+    def __init__(self, cache_dir, max_size=1024):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        """
+        Return the cached dictionary of arrays for the key, or None if the key is not cached
+
+        Unreadable entries, e.g. truncated or corrupt files, are removed and treated as missing.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                result = {name: data[name] for name in data.files}
+        except (IOError, OSError, ValueError, EOFError, zipfile.BadZipfile):
+            if os.path.exists(path):
+                self._remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted by another process after reading
+            pass
+        return result
+
+    def put(self, key, arrays):
+        """Store a dictionary of arrays under the key and evict old entries if the cache is too large"""
+        fd, tmp_path = tempfile.mkstemp(suffix=self.suffix, dir=self.cache_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                np.savez(fp, **arrays)
+            # atomic, so readers never see a partially written entry
+            os.rename(tmp_path, self._path(key))
+        except Exception:
+            self._remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within max_size"""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(self.suffix) or filename.startswith('.tmp-'):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(entry[1] for entry in entries)
+        max_bytes = self.max_size*1024**2
+        for mtime, size, path in sorted(entries):
+            if total_size <= max_bytes:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(self.suffix):
+                self._remove(os.path.join(self.cache_dir, filename))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
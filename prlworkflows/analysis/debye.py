@@ -10,10 +10,12 @@ to clean up and use the proper Gruneisen parameter and to factor out the Debye p
 
 from __future__ import unicode_literals, division, print_function
 
+from fractions import Fraction
+from math import factorial
+
 import numpy as np
 
 from scipy.constants import physical_constants
-from scipy.integrate import quadrature
 from scipy.stats import gmean
 
 from pymatgen.analysis.eos import EOS
@@ -22,6 +24,72 @@ from pymatgen.analysis.eos import EOS
 __author__ = "Kiran Mathew, Brandon Bocklund"
 __credits__ = "Cormac Toher"
 
+# Precomputed coefficients for the Debye function D_3(y) = 3/y^3 * int_0^y x^3/(e^x-1) dx
+# Below _DEBYE_SERIES_CUTOFF, the Bernoulli series
+#   D_3(y) = 1 - 3y/8 + 3 * sum_k B_2k y^2k / ((2k+3) (2k)!)
+# is used, which converges for y < 2*pi. Above it, the exponentially convergent form
+#   D_3(y) = 3/y^3 * (pi^4/15 - sum_k exp(-ky) (y^3/k + 3y^2/k^2 + 6y/k^3 + 6/k^4))
+# is used. With the number of terms below, both truncation errors are below 1e-16 at the
+# cutoff and decrease away from it, so the relative error is bounded by 1e-14.
+_DEBYE_SERIES_CUTOFF = 2.0
+_DEBYE_SERIES_TERMS = 20
+_DEBYE_EXP_TERMS = 24
+_DEBYE_EXP_K = np.arange(1, _DEBYE_EXP_TERMS + 1, dtype=float)
+
+
+def _bernoulli_numbers(n):
+    """Exact Bernoulli numbers B_0 to B_n as Fractions"""
+    b = [Fraction(1)]
+    for m in range(1, n + 1):
+        binomial = 1  # (m+1 choose k)
+        total = Fraction(0)
+        for k in range(m):
+            total += binomial * b[k]
+            binomial = binomial * (m + 1 - k) // (k + 1)
+        b.append(-total / (m + 1))
+    return b
+
+
+# computed exactly and rounded once, since floating point recurrences lose precision
+_DEBYE_SERIES_COEFFS = np.array([float(3 * b / ((2 * k + 3) * factorial(2 * k)))
+                                 for k, b in enumerate(_bernoulli_numbers(2 * _DEBYE_SERIES_TERMS)[2::2], start=1)])
+
+
+def debye_function(y):
+    """
+    Third order Debye function, D_3(y) = 3/y^3 * int_0^y x^3/(e^x-1) dx
+
+    Evaluated with a precomputed series expansion for small y and an exponentially
+    convergent asymptotic form for large y, with a relative error below 1e-14 for all y > 0.
+
+    Parameters
+    ----------
+    y : float or numpy.ndarray
+        Upper limit of the integral, usually the Debye temperature/T
+
+    Returns
+    -------
+    float or numpy.ndarray
+        Value of the Debye function, unitless. Same shape as y.
+    """
+    y = np.asarray(y, dtype=float)
+    result = np.empty(y.shape)
+    small = y < _DEBYE_SERIES_CUTOFF
+    # Horner evaluation of the series in y^2
+    y_small = y[small]
+    y2 = y_small ** 2
+    series = np.zeros(y_small.shape)
+    for coeff in _DEBYE_SERIES_COEFFS[::-1]:
+        series = (series + coeff) * y2
+    result[small] = 1. - 3. / 8. * y_small + series
+    # exp(-700) underflows the terms of the sum relative to pi^4/15, capping y avoids inf*0
+    y_large = y[~small]
+    y_capped = np.minimum(y_large, 700.)[..., np.newaxis]
+    k = _DEBYE_EXP_K
+    tail = np.sum(np.exp(-k * y_capped) * (y_capped ** 3 / k + 3. * y_capped ** 2 / k ** 2 + 6. * y_capped / k ** 3 + 6. / k ** 4), axis=-1)
+    result[~small] = 3. / y_large ** 3 * (np.pi ** 4 / 15. - tail)
+    return float(result) if result.ndim == 0 else result
+
 
 class DebyeModel(object):
     """
@@ -61,10 +129,13 @@ class DebyeModel(object):
         value and 1 is the low temperature value. Defaults to 1.
     mass_average_mode : str
         Either 'arithmetic' or 'geometric'. Default is 'arithmetic'
+    ev_eos_fit : pymatgen.analysis.eos.EOSBase
+        Existing fit of the energies and volumes with the same EOS, e.g. from an EOS analysis,
+        to use instead of fitting them again
     """
     def __init__(self, energies, volumes, structure, t_min=5, t_step=5,
                  t_max=2000.0, eos="vinet", poisson=0.25,
-                 gruneisen=True, bp2gru=1., mass_average_mode='arithmetic'):
+                 gruneisen=True, bp2gru=1., mass_average_mode='arithmetic', ev_eos_fit=None):
         self.energies = energies
         self.volumes = volumes
         self.structure = structure
@@ -85,7 +156,7 @@ class DebyeModel(object):
             raise ValueError("DebyeModel mass_average_mode must be either 'arithmetic' or 'geometric'")
         # fit E and V and get the bulk modulus(used to compute the Debye temperature)
         self.eos = EOS(eos)
-        self.ev_eos_fit = self.eos.fit(volumes, energies)
+        self.ev_eos_fit = ev_eos_fit or self.eos.fit(volumes, energies)
         self.bulk_modulus = self.ev_eos_fit.b0_GPa  # in GPa
 
         self.calculate_F_el()
@@ -94,12 +165,14 @@ class DebyeModel(object):
         """
         Calculate the Helmholtz vibrational free energy
 
-        """
-        self.F_vib = np.zeros((len(self.volumes), self.temperatures.size ))
-        for v_idx, vol in enumerate(self.volumes):
-            for t_idx, temp in enumerate(self.temperatures):
-                self.F_vib[v_idx, t_idx] = self.vibrational_free_energy(temp, vol)
+        The Debye temperatures for all volumes are computed at once and F_vib is evaluated
+        on the full (volume, temperature) grid by broadcasting. The results agree with
+        evaluating ``vibrational_free_energy`` point by point with adaptive quadrature to
+        within a relative tolerance of 1e-7 (the tolerance of the adaptive quadrature).
 
+        """
+        volumes = np.asarray(self.volumes, dtype=float)
+        self.F_vib = self.vibrational_free_energy(self.temperatures[np.newaxis, :], volumes[:, np.newaxis])
 
     def vibrational_free_energy(self, temperature, volume):
         """
@@ -107,11 +180,11 @@ class DebyeModel(object):
         Eq(4) in doi.org/10.1016/j.comphy.2003.12.001
 
         Args:
-            temperature (float): temperature in K
-            volume (float)
+            temperature (float or numpy.ndarray): temperature in K
+            volume (float or numpy.ndarray): volume in Ang^3, must broadcast with temperature
 
         Returns:
-            float: vibrational free energy in eV
+            float or numpy.ndarray: vibrational free energy in eV
         """
         y = self.debye_temperature(volume) / temperature
         return self.kb * self.natoms * temperature * (9./8. * y + 3 * np.log(1 - np.exp(-y)) - self.debye_integral(y))
@@ -132,10 +205,10 @@ class DebyeModel(object):
         to True or False in the QuasiharmonicDebyeApprox constructor.
 
         Args:
-            volume (float): in Ang^3
+            volume (float or numpy.ndarray): in Ang^3
 
         Returns:
-            float: debye temperature in K
+            float or numpy.ndarray: debye temperature in K
          """
         term1 = (2./3. * (1. + self.poisson) / (1. - 2. * self.poisson))**1.5
         term2 = (1./3. * (1. + self.poisson) / (1. - self.poisson))**1.5
@@ -158,18 +231,12 @@ class DebyeModel(object):
         """
         Debye integral. Eq(5) in  doi.org/10.1016/j.comphy.2003.12.001
 
+        See ``debye_function`` for details of the evaluation.
+
         Args:
-            y (float): debye temperature/T, upper limit
+            y (float or numpy.ndarray): debye temperature/T, upper limit
 
         Returns:
-            float: unitless
+            float or numpy.ndarray: unitless
         """
-        # floating point limit is reached around y=155, so values beyond that
-        # are set to the limiting value(T-->0, y --> \infty) of
-        # 6.4939394 (from wolfram alpha).
-        factor = 3. / y ** 3
-        if y < 155:
-            integral = quadrature(lambda x: x ** 3 / (np.exp(x) - 1.), 0, y)
-            return list(integral)[0] * factor
-        else:
-            return 6.493939 * factor
+        return debye_function(y)
@@ -0,0 +1,181 @@
+"""
+Incremental quasiharmonic analysis that is updated as the volumes of a workflow finish
+
+The thermal contributions of each finished volume (E_0, F_el(T) and F_vib(T)) are stored as
+one document per volume in the ``qha_columns`` collection, i.e. the columns of a partial
+G(V,T) matrix. Once enough volumes are stored, the QHA is run on all of them and published as a
+provisional result, which is refined each time another volume finishes.
+"""
+
+from __future__ import division
+
+import numpy as np
+from pymongo.errors import DuplicateKeyError
+from pymatgen import Structure
+from pymatgen.analysis.eos import EOS
+
+from prlworkflows.analysis.quasiharmonic import Quasiharmonic
+from prlworkflows.analysis.thermal_electronic import calculate_thermal_electronic_contribution_batch
+from prlworkflows.database import INDEXES, encode_array, decode_array, ensure_indexes, get_static_calculations
+
+
+def add_qha_columns(db, tag, t_min=5, t_step=5, t_max=2000.0, phonon=False, tasks_collection='tasks', el_kwargs=None):
+    """
+    Store the E_0, F_el and F_vib columns of the volumes with a tag that are not stored yet
+
+    A unique index on the tag and task_id of the columns ensures that volumes finishing at the
+    same time never store a column twice.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database of the calculations, e.g. ``VaspCalcDb.db``
+    tag : str
+        Tag of the calculations (``metadata.tag``)
+    t_min : float
+        Minimum temperature
+    t_step : float
+        Temperature step size
+    t_max : float
+        Maximum temperature (inclusive)
+    phonon : bool
+        Whether to add F_vib from the ``phonon`` collection to the columns
+    tasks_collection : str
+        Name of the task collection. Defaults to 'tasks'.
+    el_kwargs : dict
+        Additional keyword arguments to pass to ``calculate_thermal_electronic_contribution_batch``
+
+    Returns
+    -------
+    int
+        Number of new columns
+    """
+    columns = db['qha_columns']
+    ensure_indexes(db, {'qha_columns': INDEXES['qha_columns']})
+    stored_task_ids = set(column['task_id'] for column in columns.find({'metadata.tag': tag}, {'task_id': 1}))
+    calculations = get_static_calculations(db, tag, collection=tasks_collection, dos=False)
+    new_task_ids = [task_id for task_id in calculations['task_ids'] if task_id not in stored_task_ids]
+    if new_task_ids:
+        calculations = get_static_calculations(db, tag, collection=tasks_collection, task_ids=new_task_ids,
+                                               all_structures=True)
+        # natom=1, because we want the properties per formula unit, like Quasiharmonic
+        f_el = calculate_thermal_electronic_contribution_batch(calculations['dos_objects'], t0=t_min, t1=t_max,
+                                                              td=t_step, natom=1, **(el_kwargs or {}))['free_energy']
+        for i, task_id in enumerate(calculations['task_ids']):
+            query = {'metadata.tag': tag, 'task_id': task_id}
+            update = {'$set': {'volume': calculations['volumes'][i], 'energy': calculations['energies'][i],
+                               'structure': calculations['structures'][i], 'F_el': encode_array(f_el[i])}}
+            try:
+                columns.update_one(query, update, upsert=True)
+            except DuplicateKeyError:
+                # a concurrent update inserted the column after the stored task_ids were read
+                columns.update_one(query, update)
+
+    if phonon:
+        phonon_docs = list(db['phonon'].find({'metadata.tag': tag}, {'volume': 1, 'F_vib': 1}))
+        for column in columns.find({'metadata.tag': tag, 'F_vib': {'$exists': False}}, {'volume': 1}):
+            for phonon_doc in phonon_docs:
+                if np.isclose(phonon_doc['volume'], column['volume'], rtol=1e-4, atol=0):
+                    f_vib = np.asarray(phonon_doc['F_vib'], dtype=float)
+                    columns.update_one({'_id': column['_id']}, {'$set': {'F_vib': encode_array(f_vib)}})
+                    break
+    return len(new_task_ids)
+
+
+def update_incremental_qha(db, tag, num_volumes, t_min=5, t_step=5, t_max=2000.0, phonon=False, min_volumes=5,
+                           eos='vinet', poisson=0.25, bp2gru=1., metadata=None, tasks_collection='tasks',
+                           el_kwargs=None):
+    """
+    Add the finished volumes with a tag to the partial G(V,T) and publish the QHA once enough exist
+
+    The ``qha`` document of the tag is replaced by each update, unless it already includes more
+    volumes (updates of concurrently finishing volumes can arrive out of order). It has
+    'incremental' set to True, 'provisional' set to True until all the volumes are included and
+    'num_volumes' gives the number of volumes it is based on. A unique index on the tag of
+    incremental documents ensures that concurrent updates never create a second document.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database of the calculations, e.g. ``VaspCalcDb.db``
+    tag : str
+        Tag of the calculations (``metadata.tag``)
+    num_volumes : int
+        Total number of volumes that will be calculated
+    t_min : float
+        Minimum temperature
+    t_step : float
+        Temperature step size
+    t_max : float
+        Maximum temperature (inclusive)
+    phonon : bool
+        If True, F_vib comes from the phonon calculations and only volumes with a phonon
+        calculation are used. If False, the Debye model is used.
+    min_volumes : int
+        Number of volumes needed before a provisional result is published. Defaults to 5.
+    eos : str
+        Equation of state used for fitting. Defaults to 'vinet'.
+    poisson : float
+        Poisson ratio, defaults to 0.25. Only used in Debye
+    bp2gru : float
+        Debye model fitting parameter for dBdP in the Gruneisen parameter. Defaults to 1.
+    metadata : dict
+        Metadata of the QHA document. The tag is always added.
+    tasks_collection : str
+        Name of the task collection. Defaults to 'tasks'.
+    el_kwargs : dict
+        Additional keyword arguments to pass to ``calculate_thermal_electronic_contribution_batch``
+
+    Returns
+    -------
+    dict
+        The published QHA document, or None if there are not enough volumes yet
+    """
+    add_qha_columns(db, tag, t_min=t_min, t_step=t_step, t_max=t_max, phonon=phonon,
+                    tasks_collection=tasks_collection, el_kwargs=el_kwargs)
+    query = {'metadata.tag': tag}
+    if phonon:
+        query['F_vib'] = {'$exists': True}
+    columns = sorted(db['qha_columns'].find(query), key=lambda column: column['volume'])
+    if len(columns) < min(min_volumes, num_volumes):
+        return None
+
+    energies = [column['energy'] for column in columns]
+    volumes = [column['volume'] for column in columns]
+    f_el = np.vstack([decode_array(column['F_el']) for column in columns])
+    structure = Structure.from_dict(columns[0]['structure'])
+    # the cold curve is fit once and shared with the Debye model
+    ev_eos_fit = EOS(eos).fit(volumes, energies)
+    if phonon:
+        model = 'phonon'
+        f_vib = np.vstack([decode_array(column['F_vib']) for column in columns])
+        vib_kwargs = None
+    else:
+        model = 'debye'
+        f_vib = None
+        vib_kwargs = {'ev_eos_fit': ev_eos_fit}
+    qha = Quasiharmonic(energies, volumes, structure, F_vib=f_vib, F_el=f_el, t_min=t_min, t_step=t_step, t_max=t_max,
+                        eos=eos, poisson=poisson, bp2gru=bp2gru, vib_kwargs=vib_kwargs)
+
+    qha_result = {}
+    qha_result['structure'] = structure.as_dict()
+    qha_result['formula_pretty'] = structure.composition.reduced_formula
+    qha_result['metadata'] = dict(metadata or {}, tag=tag)
+    qha_result['has_phonon'] = phonon
+    qha_result['incremental'] = True
+    qha_result['provisional'] = len(columns) < num_volumes
+    qha_result['num_volumes'] = len(columns)
+    qha_result['eos'] = {'e0': float(ev_eos_fit.e0), 'v0': float(ev_eos_fit.v0),
+                         'b0_GPa': float(ev_eos_fit.b0_GPa), 'b1': float(ev_eos_fit.b1)}
+    qha_result[model] = qha.get_summary_dict()
+    qha_result[model]['temperatures'] = qha_result[model]['temperatures'].tolist()
+
+    # never replace a result based on more volumes
+    ensure_indexes(db, {'qha': INDEXES['qha']})
+    query = {'metadata.tag': tag, 'incremental': True, 'num_volumes': {'$lte': len(columns)}}
+    try:
+        db['qha'].replace_one(query, qha_result, upsert=True)
+    except DuplicateKeyError:
+        # the result has more volumes or was just inserted by a concurrent update
+        db['qha'].replace_one(query, qha_result)
+    return qha_result
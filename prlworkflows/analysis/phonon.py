@@ -2,12 +2,504 @@
 Phonon analysis using phonopy
 """
 
+import multiprocessing
+import warnings
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+import numpy as np
 from phonopy import Phonopy
-from phonopy.interface.vasp import Vasprun as PhonopyVasprun
+from pymatgen import Structure
 from pymatgen.io.phonopy import get_phonopy_structure
+from pymongo import UpdateOne
+from prlworkflows.database import decode_array
 from prlworkflows.utils import J_per_mol_to_eV_per_atom
 
 
+class _PRECFOCKFilter(object):
+    """
+    File-like wrapper that replaces the PRECFOCK lines of VASP 5.2.8 vasprun.xml files
+
+    VASP 5.2.8 writes an invalid PRECFOCK tag that stops the XML parser. Same workaround as
+    phonopy's VasprunWrapper.
+    """
+    def __init__(self, fp):
+        self._fp = fp
+
+    def read(self, size=None):
+        line = self._fp.readline()
+        if b'PRECFOCK' in line:
+            return b'<i type="string" name="PRECFOCK"></i>'
+        return line
+
+
+def _is_vasp_528(fp):
+    """True if the vasprun.xml file was written by VASP 5.2.8. Rewinds the file."""
+    try:
+        for line in fp:
+            if b'"version"' in line:
+                return b'5.2.8' in line
+        return False
+    finally:
+        fp.seek(0)
+
+
+def read_force_constants_vasprun(vasprun_path):
+    """
+    Read the force constants from a vasprun.xml of a VASP force constants (IBRION=5-8) run
+
+    Gives the same force constants as phonopy's ``Vasprun.read_force_constants``, but the file
+    is parsed incrementally and only the atom types and the mass-normalized Hessian are kept.
+    The rows of the Hessian are parsed into a preallocated array and all other elements are
+    discarded as soon as they are parsed, so the memory does not grow with the file size.
+
+    Parameters
+    ----------
+    vasprun_path : str
+        Path to the vasprun.xml file
+
+    Returns
+    -------
+    tuple
+        Tuple of (force constants, elements). The force constants are in eV/Ang^2 with shape
+        (number of atoms, number of atoms, 3, 3) and elements are the atom types.
+    """
+    hessian = None
+    row = 0
+    in_hessian = False
+    in_atomtypes = False
+    masses = None
+    elements = None
+    parents = []
+    with open(vasprun_path, 'rb') as fp:
+        source = _PRECFOCKFilter(fp) if _is_vasp_528(fp) else fp
+        for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'varray' and elem.get('name') == 'hessian':
+                    # like phonopy, the last Hessian in the file is used
+                    in_hessian = True
+                    row = 0
+                    hessian = np.empty((masses.size*3, masses.size*3)) if masses is not None else []
+                elif elem.tag == 'array' and elem.get('name') == 'atomtypes' and masses is None:
+                    in_atomtypes = True
+                parents.append(elem)
+                continue
+
+            parents.pop()
+            if in_hessian and elem.tag == 'v':
+                values = [float(x) for x in elem.text.split()]
+                if isinstance(hessian, list):
+                    hessian.append(values)
+                elif row < hessian.shape[0] and len(values) == hessian.shape[1]:
+                    hessian[row] = values
+                else:
+                    raise ValueError('The Hessian in {} does not match the number of atoms'.format(vasprun_path))
+                row += 1
+            elif in_hessian and elem.tag == 'varray':
+                in_hessian = False
+                if isinstance(hessian, list):
+                    hessian = np.array(hessian)
+                elif row != hessian.shape[0]:
+                    raise ValueError('The Hessian in {} does not match the number of atoms'.format(vasprun_path))
+            elif in_atomtypes and elem.tag == 'array':
+                in_atomtypes = False
+                num_atoms, elements, type_masses = [], [], []
+                for rc in elem.findall('./set/rc'):
+                    atom_info = [c.text for c in rc.findall('./c')]
+                    num_atoms.append(int(atom_info[0]))
+                    elements.append(atom_info[1].strip())
+                    type_masses.append(float(atom_info[2]))
+                masses = np.repeat(type_masses, num_atoms)
+            # keep the atom types until the whole array is parsed, drop everything else
+            if not in_atomtypes and parents:
+                parents[-1].remove(elem)
+
+    if hessian is None or masses is None:
+        raise ValueError('No Hessian and atom types found in {}'.format(vasprun_path))
+    num_atom = masses.size
+    if hessian.shape != (num_atom*3, num_atom*3):
+        raise ValueError('The Hessian in {} does not match the number of atoms'.format(vasprun_path))
+    # (3N, 3N) -> (N, N, 3, 3) and undo the normalization by the atomic masses.
+    # phonopy needs C-contiguous force constants, so the transposed view is multiplied into a new array.
+    force_constants = np.empty((num_atom, num_atom, 3, 3))
+    np.multiply(hessian.reshape(num_atom, 3, num_atom, 3).transpose(0, 2, 1, 3),
+                -np.sqrt(np.outer(masses, masses))[:, :, np.newaxis, np.newaxis], out=force_constants)
+    return force_constants, elements
+
+
+def get_phonopy(structure, supercell_matrix, force_constants):
+    """
+    Return a Phonopy object of the unitcell with the force constants set
+
+    Parameters
+    ----------
+    structure : pymatgen.Structure
+        Unitcell (not supercell) of interest.
+    supercell_matrix : numpy.ndarray
+        3x3 matrix of the supercell deformation, e.g. [[3, 0, 0], [0, 3, 0], [0, 0, 3]].
+    force_constants : numpy.ndarray
+        Force constants of the supercell
+
+    Returns
+    -------
+    phonopy.Phonopy
+    """
+    ph_unitcell = get_phonopy_structure(structure)
+    ph = Phonopy(ph_unitcell, supercell_matrix)
+    ph.set_force_constants(force_constants)
+    return ph
+
+
+def get_phonopy_thermal_properties(ph, qpoint_mesh, t_min=5, t_step=5, t_max=2000.0):
+    """
+    Return the thermal properties of a Phonopy object on a q-point mesh in eV/atom
+
+    The thermal properties are calculated on the irreducible q-points of the mesh.
+
+    Parameters
+    ----------
+    ph : phonopy.Phonopy
+        Phonopy object with force constants
+    qpoint_mesh : list
+        Mesh of q-points to calculate thermal properties on.
+    t_min : float
+        Minimum temperature
+    t_step : float
+        Temperature step size
+    t_max : float
+        Maximum temperature (inclusive)
+
+    Returns
+    -------
+    tuple
+        Tuple of (temperature, F_vib, S_vib, Cv_vib)
+    """
+    ph.set_mesh(qpoint_mesh, is_mesh_symmetry=True)
+    ph.set_thermal_properties(t_min=t_min, t_max=t_max, t_step=t_step)
+    # the thermal properties are for the unit cell
+    temperatures, f_vib, s_vib, cv_vib = ph.get_thermal_properties()
+    # convert the units into our expected eV/atom-form (and per K)
+    f_vib *= J_per_mol_to_eV_per_atom*1000
+    s_vib *= J_per_mol_to_eV_per_atom
+    cv_vib *= J_per_mol_to_eV_per_atom
+    return temperatures, f_vib, s_vib, cv_vib
+
+
+def qpoint_mesh_from_length(ph, length):
+    """
+    Return a q-point mesh with a density set by a length, like VASP's automatic k-point meshes
+
+    The number of q-points along each reciprocal lattice vector b_i of the primitive cell is
+    max(1, ceil(length*|b_i|)), where |b_i| is in 1/Ang without the factor of 2 pi.
+
+    Parameters
+    ----------
+    ph : phonopy.Phonopy
+        Phonopy object
+    length : float
+        Length in Ang
+
+    Returns
+    -------
+    list
+        Mesh of q-points
+    """
+    # the columns of the inverse of the (row) lattice vectors are the reciprocal lattice vectors
+    reciprocal_lengths = np.linalg.norm(np.linalg.inv(ph.get_primitive().get_cell()), axis=0)
+    return [max(1, int(np.ceil(length*b - 1e-8))) for b in reciprocal_lengths]
+
+
+def converge_qpoint_mesh(ph, tolerance, t_min=5, t_step=5, t_max=2000.0, initial_length=20.0, growth=1.5,
+                         max_length=400.0):
+    """
+    Increase the q-point mesh density until F_vib over the temperature range is converged
+
+    Meshes from ``qpoint_mesh_from_length`` are evaluated for lengths that increase
+    geometrically, until the largest change of F_vib over all temperatures between two
+    successive meshes is below the tolerance. That change is the error estimate of the
+    converged F_vib.
+
+    Parameters
+    ----------
+    ph : phonopy.Phonopy
+        Phonopy object with force constants
+    tolerance : float
+        Tolerance of F_vib in eV/atom
+    t_min : float
+        Minimum temperature
+    t_step : float
+        Temperature step size
+    t_max : float
+        Maximum temperature (inclusive)
+    initial_length : float
+        Length of the first mesh in Ang, see ``qpoint_mesh_from_length``
+    growth : float
+        Factor that the length is increased by in each step
+    max_length : float
+        Largest length to try. If F_vib is not converged at this length, a warning is raised
+        and the densest mesh is returned.
+
+    Returns
+    -------
+    tuple
+        Tuple of (q-point mesh, error estimate, (temperature, F_vib, S_vib, Cv_vib))
+    """
+    length = initial_length
+    qpoint_mesh = qpoint_mesh_from_length(ph, length)
+    thermal_properties = get_phonopy_thermal_properties(ph, qpoint_mesh, t_min=t_min, t_step=t_step, t_max=t_max)
+    error = None
+    while length*growth <= max_length:
+        length *= growth
+        new_mesh = qpoint_mesh_from_length(ph, length)
+        if new_mesh == qpoint_mesh:
+            continue
+        new_properties = get_phonopy_thermal_properties(ph, new_mesh, t_min=t_min, t_step=t_step, t_max=t_max)
+        error = float(np.max(np.abs(new_properties[1] - thermal_properties[1])))
+        qpoint_mesh, thermal_properties = new_mesh, new_properties
+        if error < tolerance:
+            break
+    else:
+        warnings.warn('F_vib is not converged to {} eV/atom with the q-point mesh {}, the last change was {} eV/atom'
+                      .format(tolerance, qpoint_mesh, error))
+    return qpoint_mesh, error, thermal_properties
+
+
+def get_phonon_thermal_properties_dict(ph, t_min=5, t_step=5, t_max=2000.0, qpoint_mesh=(50, 50, 50),
+                                       qpoint_mesh_tolerance=None):
+    """
+    Return the thermal properties of a Phonopy object as the fields of a ``phonon`` document
+
+    Parameters
+    ----------
+    ph : phonopy.Phonopy
+        Phonopy object with force constants
+    t_min : float
+        Minimum temperature
+    t_step : float
+        Temperature step size
+    t_max : float
+        Maximum temperature (inclusive)
+    qpoint_mesh : list
+        Mesh of q-points to calculate thermal properties on. Ignored if qpoint_mesh_tolerance is passed.
+    qpoint_mesh_tolerance : float
+        If passed, the q-point mesh is converged until F_vib changes by less than this
+        tolerance in eV/atom (see ``converge_qpoint_mesh``).
+
+    Returns
+    -------
+    dict
+        Dictionary of 'temperatures', 'F_vib', 'S_vib', 'CV_vib', 'qpoint_mesh' and 'qpoint_mesh_error'
+    """
+    if qpoint_mesh_tolerance is not None:
+        qpoint_mesh, qpoint_mesh_error, thermal_properties = converge_qpoint_mesh(
+            ph, qpoint_mesh_tolerance, t_min=t_min, t_step=t_step, t_max=t_max)
+    else:
+        qpoint_mesh_error = None
+        thermal_properties = get_phonopy_thermal_properties(ph, qpoint_mesh, t_min=t_min, t_step=t_step, t_max=t_max)
+    temperatures, f_vib, s_vib, cv_vib = thermal_properties
+    return {
+        'F_vib': f_vib.tolist(),
+        'CV_vib': cv_vib.tolist(),
+        'S_vib': s_vib.tolist(),
+        'temperatures': temperatures.tolist(),
+        'qpoint_mesh': [int(n) for n in qpoint_mesh],
+        'qpoint_mesh_error': qpoint_mesh_error,
+    }
+
+
+def get_phonopy_from_document(phonon_doc, db=None):
+    """
+    Rebuild the Phonopy object of a ``phonon`` document from its stored force constants
+
+    Parameters
+    ----------
+    phonon_doc : dict
+        Document from the ``phonon`` collection with at least the 'unitcell',
+        'supercell_matrix' and 'force_constants' fields
+    db : pymongo.database.Database
+        Database of the document. Required if the force constants are stored in GridFS.
+
+    Returns
+    -------
+    phonopy.Phonopy
+    """
+    force_constants = decode_array(phonon_doc['force_constants'], db=db)
+    return get_phonopy(Structure.from_dict(phonon_doc['unitcell']), phonon_doc['supercell_matrix'], force_constants)
+
+
+def interpolate_force_constants(volumes, force_constants, target_volumes, degree=2):
+    """
+    Interpolate force constants in volume with a polynomial fit of each element
+
+    Parameters
+    ----------
+    volumes : list
+        Volumes of the force constants
+    force_constants : list
+        Force constants with the same shape (same supercell and atom order) at each volume
+    target_volumes : list
+        Volumes to interpolate the force constants at
+    degree : int
+        Degree of the polynomial in volume. Limited to one less than the number of volumes.
+
+    Returns
+    -------
+    numpy.ndarray
+        Force constants at each target volume
+    """
+    force_constants = np.asarray(force_constants)
+    n_volumes = force_constants.shape[0]
+    degree = min(degree, n_volumes - 1)
+    coefficients = np.polyfit(np.asarray(volumes, dtype=float), force_constants.reshape(n_volumes, -1), degree)
+    interpolated = np.dot(np.vander(np.asarray(target_volumes, dtype=float), degree + 1), coefficients)
+    return interpolated.reshape((len(target_volumes),) + force_constants.shape[1:])
+
+
+def interpolate_phonon_f_vib(phonon_docs, structures, t_min=5, t_step=5, t_max=2000.0, degree=2, db=None):
+    """
+    F_vib at every volume of a QHA from phonon calculations at only some of the volumes
+
+    Volumes with a phonon calculation use its stored F_vib. At the other volumes, the force
+    constants are interpolated in volume (see ``interpolate_force_constants``) and the thermal
+    properties are calculated for the structure at that volume.
+
+    The interpolation error is estimated by leaving out each interior phonon volume in turn,
+    interpolating its F_vib from the others and comparing to the calculated F_vib. With few
+    phonon volumes, this uses a lower degree polynomial than the interpolation itself, so the
+    estimate is conservative.
+
+    Parameters
+    ----------
+    phonon_docs : list
+        Documents from the ``phonon`` collection with the same supercell
+    structures : list
+        pymatgen Structures (unitcells) of all volumes, in the same atom order as the phonon unitcells
+    t_min : float
+        Minimum temperature
+    t_step : float
+        Temperature step size
+    t_max : float
+        Maximum temperature (inclusive)
+    degree : int
+        Degree of the polynomial used to interpolate the force constants in volume
+    db : pymongo.database.Database
+        Database of the documents. Required if the force constants are stored in GridFS.
+
+    Returns
+    -------
+    tuple
+        Tuple of (F_vib, interpolation). F_vib has the shape (len(structures), len(temperatures)).
+        interpolation is a dictionary with the 'phonon_volumes', the 'interpolated_volumes', the
+        'degree' and the 'leave_one_out_errors' (max |delta F_vib| in eV/atom at each interior
+        phonon volume) and their maximum, 'max_error'.
+    """
+    phonon_docs = sorted(phonon_docs, key=lambda doc: doc['volume'])
+    phonon_volumes = np.array([doc['volume'] for doc in phonon_docs])
+    force_constants = np.array([decode_array(doc['force_constants'], db=db) for doc in phonon_docs])
+    supercell_matrix = phonon_docs[0]['supercell_matrix']
+    qpoint_mesh = phonon_docs[0].get('qpoint_mesh', [50, 50, 50])
+
+    def f_vib_at(structure, fc):
+        ph = get_phonopy(structure, supercell_matrix, fc)
+        return get_phonon_thermal_properties_dict(ph, t_min=t_min, t_step=t_step, t_max=t_max,
+                                                  qpoint_mesh=qpoint_mesh)['F_vib']
+
+    f_vib = []
+    interpolated_volumes = []
+    for structure in structures:
+        matches = np.flatnonzero(np.isclose(phonon_volumes, structure.volume, rtol=1e-4, atol=0))
+        if matches.size > 0:
+            f_vib.append(phonon_docs[matches[0]]['F_vib'])
+        else:
+            fc = interpolate_force_constants(phonon_volumes, force_constants, [structure.volume], degree=degree)[0]
+            f_vib.append(f_vib_at(structure, fc))
+            interpolated_volumes.append(structure.volume)
+
+    leave_one_out_errors = []
+    for idx in range(1, len(phonon_docs) - 1):
+        others = np.arange(len(phonon_docs)) != idx
+        fc = interpolate_force_constants(phonon_volumes[others], force_constants[others], [phonon_volumes[idx]],
+                                         degree=degree)[0]
+        structure = Structure.from_dict(phonon_docs[idx]['unitcell'])
+        error = np.max(np.abs(np.array(f_vib_at(structure, fc)) - np.array(phonon_docs[idx]['F_vib'])))
+        leave_one_out_errors.append(float(error))
+
+    interpolation = {
+        'phonon_volumes': phonon_volumes.tolist(),
+        'interpolated_volumes': interpolated_volumes,
+        'degree': min(degree, len(phonon_docs) - 1),
+        'leave_one_out_errors': leave_one_out_errors,
+        'max_error': max(leave_one_out_errors) if leave_one_out_errors else None,
+    }
+    return np.array(f_vib), interpolation
+
+
+def _recalculate_phonon_document(args):
+    """Thermal properties of one phonon document, for the process pool"""
+    phonon_doc, kwargs = args
+    ph = get_phonopy_from_document(phonon_doc)
+    return phonon_doc['_id'], get_phonon_thermal_properties_dict(ph, **kwargs)
+
+
+def recalculate_phonon_thermal_properties(db, tag, t_min=5, t_step=5, t_max=2000.0, qpoint_mesh=(50, 50, 50),
+                                          qpoint_mesh_tolerance=None, processes=None):
+    """
+    Recalculate the thermal properties of all phonon documents with a tag from their force constants
+
+    The force constants of every volume are read from the ``phonon`` collection, the thermal
+    properties are recalculated in a process pool and the documents are updated with one bulk
+    write. No VASP files are needed.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database with the ``phonon`` collection, e.g. ``VaspCalcDb.db``
+    tag : str
+        Tag of the phonon documents (``metadata.tag``)
+    t_min : float
+        Minimum temperature
+    t_step : float
+        Temperature step size
+    t_max : float
+        Maximum temperature (inclusive)
+    qpoint_mesh : list
+        Mesh of q-points to calculate thermal properties on. Ignored if qpoint_mesh_tolerance is passed.
+    qpoint_mesh_tolerance : float
+        If passed, the q-point mesh is converged until F_vib changes by less than this
+        tolerance in eV/atom (see ``converge_qpoint_mesh``).
+    processes : int
+        Number of processes. If None (the default), uses the number of CPUs.
+
+    Returns
+    -------
+    int
+        Number of updated documents
+    """
+    kwargs = dict(t_min=t_min, t_step=t_step, t_max=t_max, qpoint_mesh=qpoint_mesh,
+                  qpoint_mesh_tolerance=qpoint_mesh_tolerance)
+    projection = {'unitcell': 1, 'supercell_matrix': 1, 'force_constants': 1}
+    tasks = []
+    for doc in db['phonon'].find({'metadata.tag': tag}, projection):
+        # GridFS arrays are read here, so the workers do not need a database connection
+        doc['force_constants'] = decode_array(doc['force_constants'], db=db)
+        tasks.append((doc, kwargs))
+    if not tasks:
+        return 0
+    if processes == 1 or len(tasks) == 1:
+        results = [_recalculate_phonon_document(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(), len(tasks)))
+        try:
+            results = pool.map(_recalculate_phonon_document, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    updates = [UpdateOne({'_id': doc_id}, {'$set': thermal_properties}) for doc_id, thermal_properties in results]
+    return db['phonon'].bulk_write(updates, ordered=False).modified_count
+
+
 def get_f_vib_phonopy(structure, supercell_matrix, vasprun_path,
                      qpoint_mesh=(50, 50, 50), t_min=5, t_step=5, t_max=2000.0,):
     """
@@ -37,21 +529,8 @@ def get_f_vib_phonopy(structure, supercell_matrix, vasprun_path,
 
     """
     # get the force constants from a vasprun.xml file
-    vasprun = PhonopyVasprun(vasprun_path)
-    force_constants, elements = vasprun.read_force_constants()
-
-    ph_unitcell = get_phonopy_structure(structure)
-    ph = Phonopy(ph_unitcell, supercell_matrix)
-    # set the force constants we found
-    ph.set_force_constants(force_constants)
-    # calculate the thermal properties
-    ph.set_mesh(qpoint_mesh)
-    ph.set_thermal_properties(t_min=t_min, t_max=t_max, t_step=t_step)
-    # the thermal properties are for the unit cell
-    temperatures, f_vib, s_vib, cv_vib = ph.get_thermal_properties()
-    # convert the units into our expected eV/atom-form (and per K)
-    f_vib *= J_per_mol_to_eV_per_atom*1000
-    s_vib *= J_per_mol_to_eV_per_atom
-    cv_vib *= J_per_mol_to_eV_per_atom
+    force_constants, elements = read_force_constants_vasprun(vasprun_path)
+    ph = get_phonopy(structure, supercell_matrix, force_constants)
+    temperatures, f_vib, s_vib, cv_vib = get_phonopy_thermal_properties(ph, qpoint_mesh, t_min=t_min, t_step=t_step,
+                                                                        t_max=t_max)
     return temperatures, f_vib, s_vib, cv_vib, ph.force_constants
-
@@ -15,16 +15,121 @@ from __future__ import unicode_literals, division, print_function
 from collections import defaultdict
 
 import numpy as np
-from scipy.optimize import minimize
-from pymatgen.analysis.eos import EOS, EOSError
+from scipy.optimize import minimize, leastsq
+from pymatgen.analysis.eos import EOS, EOSError, PolynomialEOS
 
-from prlworkflows.analysis.thermal_electronic import calculate_thermal_electronic_contribution
+from prlworkflows.analysis.thermal_electronic import calculate_thermal_electronic_contribution_batch
 from prlworkflows.analysis.debye import DebyeModel
 
 __author__ = "Kiran Mathew, Brandon Bocklund"
 __credits__ = "Cormac Toher"
 
 
+def fit_polynomial_eos(volumes, energies, order=3):
+    """
+    Fit many E(V) curves at once with polynomials in the strain f = (V_ref/V)^(2/3) - 1
+
+    All curves share the same volumes, so the fit is a single linear least squares
+    problem with one right hand side per curve. A third order polynomial is the
+    third order Birch-Murnaghan EOS.
+
+    Parameters
+    ----------
+    volumes : numpy.ndarray
+        Array of volumes of shape (n_volumes,) in Ang^3
+    energies : numpy.ndarray
+        Array of energies of shape (n_volumes,) or (n_volumes, n_curves), e.g. G(V,T)
+    order : int
+        Order of the polynomial. Must be less than the number of volumes.
+
+    Returns
+    -------
+    tuple
+        Tuple of (coefficients, reference_volume). The coefficients have shape
+        (order+1,) or (order+1, n_curves) and are ordered from the constant term up.
+    """
+    volumes = np.asarray(volumes, dtype=float)
+    if order >= volumes.size:
+        raise ValueError('The polynomial order ({}) must be less than the number of volumes ({})'.format(order, volumes.size))
+    # center the strain on the mean volume to keep the Vandermonde matrix well conditioned
+    reference_volume = np.mean(volumes)
+    strain = (reference_volume / volumes) ** (2. / 3.) - 1.
+    vandermonde = strain[:, np.newaxis] ** np.arange(order + 1)
+    coefficients = np.linalg.lstsq(vandermonde, np.asarray(energies, dtype=float), rcond=None)[0]
+    return coefficients, reference_volume
+
+
+def minimize_polynomial_eos(coefficients, reference_volume, volume_guess, tol=1e-12, max_iterations=50):
+    """
+    Find the minima of polynomial EOS fits from ``fit_polynomial_eos`` with vectorized Newton steps
+
+    Parameters
+    ----------
+    coefficients : numpy.ndarray
+        Polynomial coefficients of shape (order+1,) or (order+1, n_curves)
+    reference_volume : float
+        Reference volume of the strain, as returned by ``fit_polynomial_eos``
+    volume_guess : float or numpy.ndarray
+        Starting volume(s) for the Newton iterations, e.g. the volume of the lowest energy point
+    tol : float
+        Convergence tolerance in the strain
+    max_iterations : int
+        Maximum number of Newton iterations
+
+    Returns
+    -------
+    tuple
+        Tuple of arrays (E_min, V_min). Curves that did not converge to a minimum are NaN.
+    """
+    coefficients = np.asarray(coefficients, dtype=float)
+    powers = np.arange(coefficients.shape[0]).reshape((-1,) + (1,) * (coefficients.ndim - 1))
+    first_derivative = (coefficients * powers)[1:]
+    second_derivative = (first_derivative * powers[:-1])[1:]
+
+    def evaluate(coeffs, strain):
+        # Horner evaluation of polynomials with the constant term first
+        result = np.zeros(np.broadcast(coeffs[0], strain).shape)
+        for coeff in coeffs[::-1]:
+            result = result * strain + coeff
+        return result
+
+    strain = (reference_volume / np.asarray(volume_guess, dtype=float)) ** (2. / 3.) - 1.
+    strain = strain * np.ones(coefficients.shape[1:])
+    converged = np.zeros(strain.shape, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(max_iterations):
+            step = evaluate(first_derivative, strain) / evaluate(second_derivative, strain)
+            strain = np.where(converged, strain, strain - step)
+            converged |= np.abs(step) < tol
+            if np.all(converged | ~np.isfinite(strain)):
+                break
+        # only accept converged points that are minima with a positive volume
+        is_minimum = converged & (evaluate(second_derivative, strain) > 0) & (strain > -1.)
+        energy = np.where(is_minimum, evaluate(coefficients, strain), np.nan)
+        volume = np.where(is_minimum, reference_volume * (strain + 1.) ** (-1.5), np.nan)
+    return energy, volume
+
+
+def _fit_eos_from(eos_fit, initial_params):
+    """
+    Least squares fit of a pymatgen EOS to its volumes and energies, starting from initial_params
+
+    ``EOSBase.fit`` always starts from its parabola initial guess and has no public way to pass
+    another one. This is the same fit with another starting point. It evaluates the private
+    ``EOSBase._func`` and sets ``eos_params`` and the private ``_params`` (which e0, b0, b1 and
+    v0 read), like ``EOSBase.fit`` does in pymatgen v2018.x to v2023.x. All the access to
+    pymatgen internals is kept here, so that only this needs updating if they change.
+
+    Returns:
+        int: ``ierr`` of scipy.optimize.leastsq, 1 to 4 if the fit converged
+    """
+    objective_func = lambda pars, x, y: y - eos_fit._func(x, pars)
+    params, ierr = leastsq(objective_func, initial_params, args=(eos_fit.volumes, eos_fit.energies))
+    eos_fit.eos_params = params
+    eos_fit._params = params
+    return ierr
+
+
 class Quasiharmonic(object):
     """
     Class to perform quasiharmonic calculations.
@@ -63,10 +168,34 @@ class Quasiharmonic(object):
         value and 1 is the low temperature value. Defaults to 1.
     vib_kwargs : dict
         Additional keyword arguments to pass to the vibrational calculator
+    el_kwargs : dict
+        Additional keyword arguments to pass to ``calculate_thermal_electronic_contribution_batch``,
+        e.g. ``processes`` to evaluate the DOS objects in parallel
+    F_el : numpy.ndarray
+        Precomputed array of F_el(V,T) of shape (len(volumes), len(temperatures)), e.g. the
+        ``F_el`` of another Quasiharmonic on the same volumes. If passed, dos_objects are ignored.
+    fit_mode : str
+        How G(V) is fit and minimized at each temperature. 'eos' (the default) fits each
+        temperature separately with the pymatgen EOS given by ``eos``. 'polynomial' fits all
+        temperatures at once with polynomials in V^(-2/3) (see ``fit_polynomial_eos``), which
+        is much faster for fine temperature grids. A third order polynomial is the
+        Birch-Murnaghan EOS.
+    polynomial_order : int
+        Order of the polynomials used by the 'polynomial' fit mode. Defaults to 3.
+    warm_start : bool
+        If True, the 'eos' fit mode sweeps through the temperatures in order and starts the
+        EOS fit and the volume minimization at each temperature from the EOS parameters and
+        optimum volume of the previous temperature. Falls back to the default (cold) start
+        if the warm started fit diverges. Defaults to False.
+    G_0 : numpy.ndarray
+        Precomputed array of G_0(V,T) = E_0(V) + F_el(V,T) + PV, i.e. everything but F_vib,
+        e.g. the ``G_0`` of another Quasiharmonic on the same volumes and pressure. If passed,
+        F_el is not calculated (``F_el`` is the passed F_el or None) and dos_objects are ignored.
     """
     def __init__(self, energies, volumes, structure, dos_objects=None, F_vib=None, t_min=5, t_step=5,
                  t_max=2000.0, eos="vinet", pressure=0.0, poisson=0.25,
-                 bp2gru=1., vib_kwargs=None):
+                 bp2gru=1., vib_kwargs=None, el_kwargs=None, F_el=None, fit_mode='eos', polynomial_order=3,
+                 warm_start=False, G_0=None):
         self.energies = np.array(energies)
         self.volumes = np.array(volumes)
         self.natoms = len(structure)
@@ -75,6 +204,11 @@ class Quasiharmonic(object):
         self.pressure = pressure
         self.gpa_to_ev_ang = 1./160.21766208  # 1 GPa in ev/Ang^3
         self.eos = EOS(eos)
+        if fit_mode not in ('eos', 'polynomial'):
+            raise ValueError("Quasiharmonic fit_mode must be either 'eos' or 'polynomial'")
+        self.fit_mode = fit_mode
+        self.polynomial_order = polynomial_order
+        self.warm_start = warm_start
 
         # get the vibrational properties as a function of V and T
         if F_vib is None:  # use the Debye model
@@ -87,16 +221,27 @@ class Quasiharmonic(object):
 
 
         # get the electronic properties as a function of V and T
-        if dos_objects:
+        if F_el is not None:
+            self.F_el = np.asarray(F_el)
+        elif G_0 is not None:
+            self.F_el = None
+        elif dos_objects:
             # we set natom to 1 always because we want the property per formula unit here.
-            thermal_electronic_props = [calculate_thermal_electronic_contribution(dos, t0=t_min, t1=t_max, td=t_step, natom=1) for dos in dos_objects]
-            self.F_el = [p['free_energy'] for p in thermal_electronic_props]
+            el_kwargs = el_kwargs or {}
+            thermal_electronic_props = calculate_thermal_electronic_contribution_batch(dos_objects, t0=t_min, t1=t_max, td=t_step,
+                                                                                      natom=1, **el_kwargs)
+            self.F_el = thermal_electronic_props['free_energy']
         else:
             self.F_el = np.zeros((self.volumes.size, self.temperatures.size))
 
         # Set up the array of Gibbs energies
         # G = E_0(V) + F_vib(V,T) + F_el(V,T) + PV
-        self.G = self.energies[:, np.newaxis] + self.F_vib + self.F_el + self.pressure * self.volumes[:, np.newaxis] * self.gpa_to_ev_ang
+        # G_0 is everything but the vibrational contribution
+        if G_0 is not None:
+            self.G_0 = np.asarray(G_0)
+        else:
+            self.G_0 = self.energies[:, np.newaxis] + self.F_el + self.pressure * self.volumes[:, np.newaxis] * self.gpa_to_ev_ang
+        self.G = self.G_0 + self.F_vib
 
         # set up the final variables of the optimized Gibbs energies
         self.gibbs_free_energy = []  # optimized values, eV
@@ -112,6 +257,27 @@ class Quasiharmonic(object):
         Note: The data points for which the equation of state fitting fails
             are skipped.
         """
+        if self.fit_mode == 'polynomial':
+            coefficients, reference_volume = fit_polynomial_eos(self.volumes, self.G, order=self.polynomial_order)
+            volume_guess = self.volumes[np.argmin(self.G, axis=0)]
+            G_opt, V_opt = minimize_polynomial_eos(coefficients, reference_volume, volume_guess)
+            self.gibbs_free_energy = G_opt.tolist()
+            self.optimum_volumes = V_opt.tolist()
+            return
+        if self.warm_start:
+            # continuation: seed each temperature with the results of the previous one
+            eos_params, V_opt = None, np.nan
+            for temp_idx in range(self.temperatures.size):
+                try:
+                    eos_fit = self.fit_eos(self.G[:, temp_idx], initial_params=eos_params)
+                except EOSError:
+                    eos_params, G_opt, V_opt = None, np.nan, np.nan
+                else:
+                    eos_params = eos_fit.eos_params
+                    G_opt, V_opt = self._minimize_eos_fit(eos_fit, volume_guess=V_opt if np.isfinite(V_opt) else None)
+                self.gibbs_free_energy.append(float(G_opt))
+                self.optimum_volumes.append(float(V_opt))
+            return
         for temp_idx in range(self.temperatures.size):
             G_opt, V_opt = self.optimizer(temp_idx)
             self.gibbs_free_energy.append(float(G_opt))
@@ -140,18 +306,57 @@ class Quasiharmonic(object):
 
         # fit equation of state, G(V, T, P)
         try:
-            eos_fit = self.eos.fit(self.volumes, G_V)
+            eos_fit = self.fit_eos(G_V)
         except EOSError:
             return np.nan, np.nan
+        return self._minimize_eos_fit(eos_fit)
+
+    def fit_eos(self, G_V, initial_params=None):
+        """
+        Fit the equation of state to G(V) at one temperature
+
+        Args:
+            G_V (numpy.ndarray): Gibbs energies at each of self.volumes
+            initial_params (list): EOS parameters to start the least squares fit from, e.g.
+                from the previous temperature. If None, or if the warm started fit diverges
+                (fails, leaves the volume range or gives a negative bulk modulus), the fit
+                is cold started from pymatgen's parabola initial guess.
+
+        Returns:
+            pymatgen.analysis.eos.EOSBase: fitted equation of state
+
+        Raises:
+            EOSError: if the cold started fit fails
+        """
+        if initial_params is not None:
+            eos_fit = self.eos.model(self.volumes, G_V)
+            # polynomial EOS are linear fits and have no starting point to warm start
+            if not isinstance(eos_fit, PolynomialEOS):
+                ierr = _fit_eos_from(eos_fit, initial_params)
+                params = np.asarray(eos_fit.eos_params)
+                # parameters are e0, b0, b1, v0
+                if ierr in (1, 2, 3, 4) and np.all(np.isfinite(params)) and params[1] > 0 and \
+                        self.volumes.min() < params[3] < self.volumes.max():
+                    return eos_fit
+        return self.eos.fit(self.volumes, G_V)
+
+    @staticmethod
+    def _minimize_eos_fit(eos_fit, volume_guess=None):
+        """
+        Minimize a fitted EOS wrt volume, starting from volume_guess or the lowest energy volume
+
+        Returns:
+            float, float: G_opt(V_opt, T, P) in eV and V_opt in Ang^3.
+        """
         # minimize the fit eos wrt volume
         # Note: the ref energy and the ref volume(E0 and V0) not necessarily
         # the same as minimum energy and min volume.
-        volume_guess = eos_fit.volumes[np.argmin(eos_fit.energies)]
+        if volume_guess is None:
+            volume_guess = eos_fit.volumes[np.argmin(eos_fit.energies)]
         min_wrt_vol = minimize(eos_fit.func, volume_guess)
         # G_opt=G(V_opt, T, P), V_opt
         return min_wrt_vol.fun, min_wrt_vol.x[0]
 
-
     def get_summary_dict(self):
         """
         Returns a dict with a summary of the computed properties.
@@ -2,15 +2,121 @@
 
 from __future__ import division
 import math
+import multiprocessing
 import numpy as np
 from scipy.constants import physical_constants
-from scipy.optimize import brentq
 from scipy.integrate import cumtrapz, trapz
 
+from prlworkflows.analysis.cache import hash_arrays
+
 k_B = physical_constants['Boltzmann constant in eV/K'][0]
 
+# part of the cache keys of the results; increment when the algorithm changes the results, so
+# that entries cached by older versions are not used
+THERMAL_ELECTRONIC_CACHE_VERSION = 1
+
 # TODO: check and fix all XXX and TODOs
 
+def _gaussian_refined_grid(x0, xde, sigma, fac, size, gap_center=None, dF=0.0):
+    """
+    Build the energy grid refined by Gaussians around the Fermi level (and the band gap edge)
+
+    Each spacing depends on the previous grid point, so the grid is built recursively. The
+    recursion is done on Python floats, which is much faster than indexing numpy arrays and
+    performs exactly the same floating point operations.
+
+    Parameters
+    ----------
+    x0 : float
+        First point of the grid
+    xde : float
+        Spacing of the uniform grid
+    sigma : float
+        Width of the Gaussians
+    fac : float
+        Height of the Gaussians
+    size : int
+        Number of grid points
+    gap_center : float
+        If not None, a second Gaussian is centered at ``gap_center - dF``
+    dF : float
+        Shift of the second Gaussian
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    grid = [0.0] * size
+    x = grid[0] = float(x0)
+    if gap_center is None:
+        for i in range(1, size):
+            f1 = fac*math.exp(-0.5*(x/sigma)**2)
+            x = x + 2.0*xde/(1.0+f1)
+            grid[i] = x
+    else:
+        for i in range(1, size):
+            f1 = fac*math.exp(-0.5*(x/sigma)**2)
+            f2 = fac*math.exp(-0.5*((x-gap_center+dF)/sigma)**2)
+            x = x + 3.0*xde/(1.0+f1+f2)
+            grid[i] = x
+    return np.array(grid)
+
+
+def _interpolate_dos(energies, dos_energies, vaspEdos, edn, vde, eBoF):
+    """
+    Linearly interpolate the VASP DOS onto energies, handling the band edges of a gap
+
+    Parameters
+    ----------
+    energies : numpy.ndarray
+        Energies to interpolate at, relative to the undoped Fermi level
+    dos_energies : numpy.ndarray
+        Uniform energy grid of the VASP DOS
+    vaspEdos : numpy.ndarray
+        VASP DOS
+    edn : float
+        First energy of dos_energies
+    vde : float
+        Spacing of dos_energies
+    eBoF : float
+        Energy of the bottom of the conduction band. Negative if there is no gap.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    kx = ((energies-edn)/vde).astype(int)  # truncates like int()
+    kx = np.clip(kx, 0, dos_energies.size-2)
+    e0, e1 = dos_energies[kx], dos_energies[kx+1]
+    d0, d1 = vaspEdos[kx], vaspEdos[kx+1]
+    # handling near the top of valence band
+    top_of_valence = (d1 == 0.0) & (e1 > 0.0) & (e1 < vde)
+    # handling near the bottom of conduction band
+    bottom_of_conduction = ~top_of_valence & (eBoF > 0.0) & (d0 == 0.0) & (e1-eBoF < vde) & (e1-eBoF > 0.0)
+    linear = ~(top_of_valence | bottom_of_conduction)
+
+    grid_dos = np.zeros(energies.shape)
+    idx = top_of_valence & (energies < 0.0)
+    grid_dos[idx] = d0[idx] * energies[idx] / e0[idx]
+    idx = bottom_of_conduction & (energies > eBoF)
+    grid_dos[idx] = d1[idx] * (energies[idx] - eBoF) / (e1[idx] - eBoF)
+    grid_dos[linear] = d0[linear] + (d1[linear] - d0[linear]) / vde * (energies[linear] - e0[linear])
+    return grid_dos
+
+
+def _electrons_at_fermi_level(grid_energies, ados):
+    """
+    Number of electrons at the Fermi level (zero energy), or None if zero is not on the grid
+
+    Interpolates the integrated DOS in the first step where the energies change sign.
+    """
+    crossings = np.flatnonzero(grid_energies[:-1]*grid_energies[1:] <= 0.0)
+    if crossings.size == 0:
+        return None
+    i = crossings[0]
+    return ados[i] - grid_energies[i]/(grid_energies[i+1]-grid_energies[i])*(ados[i+1]-ados[i])
+
+
 def getdos(dos, xdn, xup, dope, dos_grid_size, gaussian_grid_size): # Line 186
     """
 
@@ -42,7 +148,6 @@ def getdos(dos, xdn, xup, dope, dos_grid_size, gaussian_grid_size): # Line 186
     vde = (eup - edn)/(n_dos-1) # change in energy per step
     # linearize: sometimes rounding errors in DOSCAR
     dos_energies = np.linspace(edn, eup, n_dos)
-    grid_dos = np.zeros(dos_grid_size)
 
     from pymatgen import Spin
     try:
@@ -57,24 +162,21 @@ def getdos(dos, xdn, xup, dope, dos_grid_size, gaussian_grid_size): # Line 186
     # TODO: from original code seems like an arbitrary number
     # set the minimum energy to the highest energy where the DOS is 0, as long as the energy is less than -15eV
     # easy area to optimize out by removal, but need a test case
-    for i in range(dos_energies.size):
-        if dos_energies[i] <-15.0 and vaspEdos[i]==0.0:
-            xdn = dos_energies[i]
-        if dos_energies[i] > -15.0:
-            break
+    zero_dos_below = np.flatnonzero((dos_energies < -15.0) & (vaspEdos == 0.0))
+    if zero_dos_below.size > 0:
+        xdn = dos_energies[zero_dos_below[-1]]
     grid_energies = np.linspace(xdn, xup, dos_grid_size, dtype=float)
     xde = (xup - xdn)/(dos_grid_size - 1)
 
     # TODO: What are iBoF and eBoF
+    # iBoF is the index of the last zero DOS point of a band gap that starts within one step
+    # above the Fermi level (the point before the bottom of the conduction band), -1 if none.
     iBoF = -1
-    for i,eband in enumerate(dos_energies):
-        if eband > 0.0 and eband <=vde and vaspEdos[i]==0.0:
-          iBoF = 1
-          continue
-        if iBoF == 1:
-          if vaspEdos[i]!=0.0:
-            iBoF = i-1
-            break
+    gap_start = np.flatnonzero((dos_energies > 0.0) & (dos_energies <= vde) & (vaspEdos == 0.0))
+    if gap_start.size > 0:
+        nonzero_above = np.flatnonzero(vaspEdos[gap_start[0]+1:] != 0.0)
+        # 1 if the gap never closes, kept for compatibility with the original loop
+        iBoF = gap_start[0] + nonzero_above[0] if nonzero_above.size > 0 else 1
 
     eBoF = -1.0
     if iBoF>0:
@@ -86,102 +188,46 @@ def getdos(dos, xdn, xup, dope, dos_grid_size, gaussian_grid_size): # Line 186
           eBoF = dos_energies[iBoF+1] - espr
 
     if gaussian_grid_size != 0.0:
-      grid_energies[0] = xdn
-    # line 238
+      # line 238
       sigma = (xup-xdn) / gaussian_grid_size
       fac = gaussian_grid_size / (math.sqrt(2.0 * math.pi))
-      for i in range(1, dos_grid_size):
-        if iBoF<0:
-          f1 = fac*math.exp(-0.5*(grid_energies[i-1]/sigma)**2)
-          yde = 2.0*xde/(1.0+f1)
-        else:
-          f1 = fac*math.exp(-0.5*(grid_energies[i-1]/sigma)**2)
-          f2 = fac*math.exp(-0.5*((grid_energies[i-1]-eBoF)/sigma)**2)
-          yde = 3.0*xde/(1.0+f1+f2)
-        grid_energies[i] = grid_energies[i-1] + yde
-
-
-    for i in range(0, dos_grid_size):
-        tx = grid_energies[i]
-        kx = int((tx-edn)/vde) # Converted to int, remember the type!
-        kx = max([kx,0])
-        kx = min([n_dos-2, kx])
-        # handling near the top of valence band
-        if vaspEdos[kx+1]==0.0 and dos_energies[kx+1]>0.0 and dos_energies[kx+1]<vde:
-          if tx >= 0.0:
-            grid_dos[i] = 0.0
-          else:
-            grid_dos[i] = vaspEdos[kx] * tx / dos_energies[kx]
-        elif eBoF > 0.0 and vaspEdos[kx]==0.0 and dos_energies[kx+1]-eBoF<vde and dos_energies[kx+1]-eBoF>0.0:
-          if tx <= eBoF:
-            grid_dos[i] = 0.0
-          else:
-            grid_dos[i] = vaspEdos[kx + 1] * (tx - eBoF) / (dos_energies[kx + 1] - eBoF)
-        else:
-          grid_dos[i] = vaspEdos[kx] + (vaspEdos[kx + 1] - vaspEdos[kx]) / vde * (grid_energies[i] - dos_energies[kx])
+      grid_energies = _gaussian_refined_grid(xdn, xde, sigma, fac, dos_grid_size,
+                                             gap_center=eBoF if iBoF >= 0 else None)
+
+    grid_dos = _interpolate_dos(grid_energies, dos_energies, vaspEdos, edn, vde, eBoF)
 
     # find undoped number of electrons by integrating on the dos until the
     # energies change sign, then interpolate the sign change step
     ados = cumtrapz(grid_dos, grid_energies, initial=0.0)
-    for i in range(0, dos_grid_size-1):
-        if grid_energies[i]*grid_energies[i+1]<=0.0:
-            n_electrons = ados[i] - grid_energies[i]/(grid_energies[i+1]-grid_energies[i])*(ados[i+1]-ados[i])
-            break
+    n_electrons = _electrons_at_fermi_level(grid_energies, ados)
+    if n_electrons is None:
+        raise ValueError('The Fermi level is not within the energy range of the DOS grid')
 
     dF = 0.0
     if dope != 0.0:
         n_electrons += dope
-        for i in range(0, dos_grid_size-1):
-            if (ados[i] - n_electrons)*(ados[i+1]-n_electrons) < 0.0:
-                if i == (dos_grid_size-1) or ados[i] == ados[i+1]:
-                    # we are doping too much
-                    raise ValueError('Too much doping')
-                dF = (n_electrons-ados[i])/(ados[i+1] - ados[i])*(grid_energies[i+1] - grid_energies[i])+grid_energies[i]
-                # dF is the shift in the Fermi energy due to doping
+        # dF is the shift in the Fermi energy due to doping, interpolated in the last step
+        # where the integrated DOS crosses the doped number of electrons
+        crossings = np.flatnonzero((ados[:-1] - n_electrons)*(ados[1:] - n_electrons) < 0.0)
+        if crossings.size > 0:
+            i = crossings[-1]
+            dF = (n_electrons-ados[i])/(ados[i+1] - ados[i])*(grid_energies[i+1] - grid_energies[i])+grid_energies[i]
         grid_energies = grid_energies - dF # This is done in a loop (line 289), but I think we can do without
 
     if gaussian_grid_size != 0.0 and abs(dope)>0.0001:
-      grid_energies[0] = xdn - dF
       sigma = (xup-xdn) / gaussian_grid_size
       fac = gaussian_grid_size / (math.sqrt(2.0 * math.pi))
-      for i in range(1, dos_grid_size):
-        if iBoF<0:
-          f1 = fac*math.exp(-0.5*(grid_energies[i-1]/sigma)**2)
-          yde = 2.0*xde/(1.0+f1)
-        else:
-          f1 = fac*math.exp(-0.5*(grid_energies[i-1]/sigma)**2)
-          if dF < eBoF:
-            f2 = fac*math.exp(-0.5*((grid_energies[i-1]-eBoF+dF)/sigma)**2)
-          else:
-            f2 = fac*math.exp(-0.5*((grid_energies[i-1]+dF)/sigma)**2)
-          yde = 3.0*xde/(1.0+f1+f2)
-        grid_energies[i] = grid_energies[i-1]+yde
-
-      for i in range(0, dos_grid_size):
-        tx = grid_energies[i] + dF
-        kx = int((tx-edn)/vde) # Converted to int, remember the type!
-        kx = max([kx,0])
-        kx = min([n_dos-2, kx])
-        if vaspEdos[kx+1]==0.0 and dos_energies[kx+1]>0.0 and dos_energies[kx+1]<vde:
-          # handling near the Top of valence band
-          if tx >= 0.0:
-            grid_dos[i] = 0.0
-          else:
-            grid_dos[i] = vaspEdos[kx] * tx / dos_energies[kx]
-        elif eBoF > 0.0 and vaspEdos[kx]==0.0 and dos_energies[kx+1]-eBoF<vde and dos_energies[kx+1]-eBoF>0.0:
-          # handling near the bottom of conduction band
-            if tx <= eBoF:
-              grid_dos[i] = 0.0
-            else:
-              grid_dos[i] = vaspEdos[kx + 1] * (tx - eBoF) / (dos_energies[kx + 1] - eBoF)
-        else:
-          grid_dos[i] = vaspEdos[kx] + (vaspEdos[kx + 1] - vaspEdos[kx]) / vde * (tx - dos_energies[kx])
+      if iBoF<0:
+        grid_energies = _gaussian_refined_grid(xdn - dF, xde, sigma, fac, dos_grid_size)
+      else:
+        grid_energies = _gaussian_refined_grid(xdn - dF, xde, sigma, fac, dos_grid_size,
+                                               gap_center=eBoF if dF < eBoF else 0.0, dF=dF)
+      grid_dos = _interpolate_dos(grid_energies + dF, dos_energies, vaspEdos, edn, vde, eBoF)
 
     ados = cumtrapz(grid_dos, grid_energies, initial=0.0)
-    for i in range(0, dos_grid_size-1):
-        if grid_energies[i]*grid_energies[i+1]<=0.0:
-            n_electrons = ados[i] - grid_energies[i]/(grid_energies[i+1]-grid_energies[i])*(ados[i+1]-ados[i])
-            break
+    n_electrons_at_fermi_level = _electrons_at_fermi_level(grid_energies, ados)
+    if n_electrons_at_fermi_level is not None:
+        n_electrons = n_electrons_at_fermi_level
 
     return n_electrons, dF, grid_energies, grid_dos
 
@@ -217,10 +263,374 @@ def calculate_entropy(mu_el, energy, density, beta):
     return -s*k_B
 
 
-def calculate_thermal_electronic_contribution(dos, t0=0, t1=2000, td=5, xdn=-100, xup=100, ndosmx=10001, dope=0.0, natom=1, gaussian=1000):
+def _trapz_weights(x):
+    """Weights w such that np.dot(y, w) is the trapezoidal rule integral of y over x"""
+    half_steps = np.diff(x)/2.0
+    weights = np.zeros(x.size)
+    weights[:-1] += half_steps
+    weights[1:] += half_steps
+    return weights
+
+
+def _block_size(n_rows, n_points, memory_budget, n_buffers):
+    """
+    Number of rows per block so that n_buffers float64 buffers of shape (rows, n_points) fit in
+    memory_budget (in MB). At least one row, all rows if memory_budget is None.
+    """
+    n_rows = max(n_rows, 1)
+    if memory_budget is None:
+        return n_rows
+    rows = int(memory_budget*1024**2 // (n_buffers*n_points*8))
+    return min(max(rows, 1), n_rows)
+
+
+def _grid_runs(grid_index):
+    """Slices of the runs of equal values in grid_index and the grid index of each run"""
+    boundaries = np.flatnonzero(np.diff(grid_index)) + 1
+    starts = np.concatenate(([0], boundaries))
+    stops = np.concatenate((boundaries, [grid_index.size]))
+    return [(slice(run_start, run_stop), grid_index[run_start]) for run_start, run_stop in zip(starts, stops)]
+
+
+def _stacked_grids(energy, density, n_rows, grid_index):
+    """Energy and DOS as 2D stacks of grids and the grid index of each row"""
+    energy = np.atleast_2d(energy)
+    density = np.atleast_2d(density)
+    if grid_index is None:
+        if energy.shape[0] != 1:
+            raise ValueError('grid_index is required for more than one energy grid')
+        grid_index = np.zeros(n_rows, dtype=int)
+    grid_index = np.asarray(grid_index, dtype=int)
+    if np.any(np.diff(grid_index) < 0):
+        raise ValueError('The rows must be sorted by grid_index')
+    return energy, density, grid_index
+
+
+def calculate_internal_energy_and_entropy(mu_el, energy, density, beta, memory_budget=None, grid_index=None):
+    """
+    Calculate the electronic internal energy and entropy for many temperatures
+
+    Equivalent to ``calculate_internal_energy`` and ``calculate_entropy`` with broadcasting,
+    but the Fermi-Dirac occupations are computed once and shared between U and S. The
+    temperatures are streamed in blocks through preallocated buffers, which bounds the
+    memory of the temporary arrays.
+
+    Parameters
+    ----------
+    mu_el : numpy.ndarray
+        Chemical potential at each temperature
+    energy : numpy.ndarray
+        Energy grid or a 2D array of energy grids of the same size, e.g. for several volumes
+    density : numpy.ndarray
+        DOS on the energy grid(s)
+    beta : numpy.ndarray
+        1/(k_B T) at each temperature
+    memory_budget : float
+        Approximate memory in MB to use for the temporary arrays. If None (the default), all
+        temperatures are evaluated in one block.
+    grid_index : numpy.ndarray
+        Index of the energy grid for each temperature, sorted in increasing order. Only
+        required for a 2D array of energy grids.
+
+    Returns
+    -------
+    tuple
+        Tuple of (internal energy, entropy) arrays with one value per temperature
+    """
+    mu_el = np.atleast_1d(mu_el)
+    beta = np.atleast_1d(beta)
+    energy, density, grid_index = _stacked_grids(energy, density, mu_el.size, grid_index)
+    n_T, n_e = mu_el.size, energy.shape[1]
+    weights = np.array([_trapz_weights(x) for x in energy])
+    energy_density = density*energy
+    u = np.empty(n_T)
+    s = np.empty(n_T)
+
+    # 4 float buffers and 2 boolean masks
+    block = _block_size(n_T, n_e, memory_budget, 5)
+    tc_buffer = np.empty((block, n_e))
+    tf_buffer = np.empty((block, n_e))
+    tf1_buffer = np.empty((block, n_e))
+    fn_buffer = np.empty((block, n_e))
+    hot_buffer = np.empty((block, n_e), dtype=bool)
+    frozen_buffer = np.empty((block, n_e), dtype=bool)
+    for start in range(0, n_T, block):
+        stop = min(start + block, n_T)
+        rows = stop - start
+        runs = _grid_runs(grid_index[start:stop])
+        tc, tf, tf1, fn = tc_buffer[:rows], tf_buffer[:rows], tf1_buffer[:rows], fn_buffer[:rows]
+        hot, frozen = hot_buffer[:rows], frozen_buffer[:rows]
+        u_block, s_block = u[start:stop], s[start:stop]
+        for run, grid in runs:
+            np.subtract(energy[grid], mu_el[start:stop][run, np.newaxis], out=tc[run])
+        tc *= beta[start:stop, np.newaxis]
+        np.greater(tc, 200, out=hot)
+        np.less(tc, -200, out=frozen)
+        frozen |= hot
+        with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+            # Fermi-Dirac occupations, shared by U and S
+            np.exp(tc, out=tf)
+            tf += 1.0
+            np.reciprocal(tf, out=tf)
+            # internal energy
+            for run, grid in runs:
+                np.multiply(tf[run], energy_density[grid], out=fn[run])
+            np.copyto(fn, 0.0, where=hot)
+            for run, grid in runs:
+                u_block[run] = np.dot(fn[run], weights[grid])
+            # entropy, tc is no longer needed and is reused as scratch space
+            np.subtract(1.0, tf, out=tf1)
+            tf1 += 1.e-60
+            np.log(tf, out=fn)
+            fn *= tf
+            np.log(tf1, out=tc)
+            tc *= tf1
+            fn += tc
+            for run, grid in runs:
+                fn[run] *= density[grid]
+            np.copyto(fn, 0.0, where=frozen)
+            for run, grid in runs:
+                s_block[run] = np.dot(fn[run], weights[grid])
+    return u, -s*k_B
+
+
+# every _COARSE_STRIDE-th temperature is solved first to seed the others
+_COARSE_STRIDE = 8
+
+
+def _safeguarded_newton(func, mu, bracket, xtol, maxiter):
+    """
+    Roots of increasing functions by Newton steps that bisect the bracket when they leave it
+
+    func(mu, rows) returns the function values and derivatives at mu for the given rows. Each
+    row is iterated until it converges, starting from the guesses in mu.
+    """
+    lower = np.full(mu.size, float(bracket[0]))
+    upper = np.full(mu.size, float(bracket[1]))
+    mu = np.clip(mu, lower, upper)
+    roots = mu.copy()
+    rows = np.arange(mu.size)
+    for _ in range(maxiter):
+        value, derivative = func(mu, rows)
+        # shrink the bracket
+        lower = np.where(value < 0, mu, lower)
+        upper = np.where(value > 0, mu, upper)
+        new_mu = mu - value/derivative
+        # safeguard: bisect when Newton leaves the bracket
+        outside = ~((new_mu > lower) & (new_mu < upper))
+        new_mu[outside] = 0.5*(lower[outside] + upper[outside])
+        converged = (value == 0) | (np.abs(new_mu - mu) <= xtol) | (upper - lower <= xtol)
+        new_mu = np.where(value == 0, mu, new_mu)
+        if np.any(converged):
+            roots[rows[converged]] = new_mu[converged]
+            keep = ~converged
+            if not np.any(keep):
+                return roots
+            rows, mu, lower, upper = rows[keep], new_mu[keep], lower[keep], upper[keep]
+        else:
+            mu = new_mu
+    raise RuntimeError('The chemical potential failed to converge in {} iterations'.format(maxiter))
+
+
+def calculate_chemical_potential(energy, density, n_electrons, beta, mu_guess=0.0, bracket=(-5.0, 5.0),
+                                 xtol=2e-12, maxiter=100, memory_budget=None, grid_index=None):
+    """
+    Solve for the electronic chemical potential at many temperatures at once
+
+    Solves the same equation as ``gfind`` with a safeguarded Newton iteration that is
+    vectorized over temperatures. Every 8th temperature of each energy grid is solved first,
+    and their chemical potentials are interpolated in temperature to seed the others, which
+    then converge in a few iterations. Newton steps that leave the bracket of the root fall
+    back to bisection, so every temperature converges at least as reliably as with brentq.
+
+    Parameters
+    ----------
+    energy : numpy.ndarray
+        Energy grid or a 2D array of energy grids of the same size, e.g. for several volumes
+    density : numpy.ndarray
+        DOS on the energy grid(s)
+    n_electrons : float
+        Number of electrons, or an array with the number of electrons for each energy grid
+    beta : numpy.ndarray
+        1/(k_B T) at each temperature
+    mu_guess : float
+        Starting chemical potential of the temperatures that seed the others
+    bracket : tuple
+        Lower and upper bounds of the chemical potential
+    xtol : float
+        Absolute tolerance of the chemical potential
+    maxiter : int
+        Maximum number of iterations per block
+    memory_budget : float
+        Approximate memory in MB for the temporary (temperature, energy) arrays. If None (the
+        default), the seeding and the remaining temperatures are each solved in one block.
+    grid_index : numpy.ndarray
+        Index of the energy grid for each temperature, sorted in increasing order. Only
+        required for a 2D array of energy grids.
+
+    Returns
+    -------
+    numpy.ndarray
+        Chemical potential at each temperature
+    """
+    beta = np.atleast_1d(beta)
+    energy, density, grid_index = _stacked_grids(energy, density, beta.size, grid_index)
+    n_electrons = np.atleast_1d(n_electrons)
+    n_T, n_e = beta.size, energy.shape[1]
+    # the DOS is folded into the trapezoid weights, so the integrals are dot products with the occupations
+    weighted_density = np.array([_trapz_weights(x) for x in energy])*density
+
+    # 2 float buffers
+    block = _block_size(n_T, n_e, memory_budget, 2)
+    tc_buffer = np.empty((block, n_e))
+    tf_buffer = np.empty((block, n_e))
+
+    def electron_count(mu, beta_rows, grid_rows):
+        """Excess number of electrons and its derivative wrt mu for each row"""
+        rows = mu.size
+        runs = _grid_runs(grid_rows)
+        tc, tf = tc_buffer[:rows], tf_buffer[:rows]
+        for run, grid in runs:
+            np.subtract(energy[grid], mu[run, np.newaxis], out=tc[run])
+        tc *= beta_rows[:, np.newaxis]
+        # the occupations of states with tc > 200 (which gfind skips) are below 1e-86
+        np.exp(tc, out=tf)
+        tf += 1.0
+        np.reciprocal(tf, out=tf)
+        # dN/dmu = beta * int(dos * f * (1 - f))
+        np.multiply(tf, tf, out=tc)
+        np.subtract(tf, tc, out=tc)
+        count = np.empty(rows)
+        derivative = np.empty(rows)
+        # the rows of each grid share its weights, no per-row copies are needed
+        for run, grid in runs:
+            np.dot(tf[run], weighted_density[grid], out=count[run])
+            np.dot(tc[run], weighted_density[grid], out=derivative[run])
+        count -= n_electrons[grid_rows]
+        derivative *= beta_rows
+        return count, derivative
+
+    def solve(rows, seed):
+        """Chemical potentials of the rows from their starting values, in blocks of rows"""
+        mu = np.empty(rows.size)
+        for start in range(0, rows.size, block):
+            stop = min(start + block, rows.size)
+            beta_block = beta[rows[start:stop]]
+            grid_block = grid_index[rows[start:stop]]
+            mu_block = _safeguarded_newton(lambda x, i: electron_count(x, beta_block[i], grid_block[i]),
+                                           seed[start:stop], bracket, xtol, maxiter)
+            # a solution at the edge of the bracket means that there may be no root in the bracket
+            at_edge = np.flatnonzero((mu_block - bracket[0] <= xtol) | (bracket[1] - mu_block <= xtol))
+            if at_edge.size > 0:
+                lower_count = electron_count(np.full(at_edge.size, float(bracket[0])), beta_block[at_edge], grid_block[at_edge])[0]
+                upper_count = electron_count(np.full(at_edge.size, float(bracket[1])), beta_block[at_edge], grid_block[at_edge])[0]
+                if np.any(lower_count*upper_count > 0):
+                    raise ValueError('The chemical potential is not within the bracket {}'.format(bracket))
+            mu[start:stop] = mu_block
+        return mu
+
+    if n_T == 0:
+        return np.empty(0)
+    # the temperatures are seeded by interpolating a solve of every _COARSE_STRIDE-th temperature in k_B T
+    kT = 1.0/beta
+    coarse = np.zeros(n_T, dtype=bool)
+    for run, grid in _grid_runs(grid_index):
+        order = run.start + np.argsort(kT[run])
+        coarse[order[::_COARSE_STRIDE]] = True
+        coarse[order[-1]] = True
+    mu_el = np.empty(n_T)
+    # overflows of exp(tc) give zero occupations and a zero derivative gives a bisection step
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        mu_el[coarse] = solve(np.flatnonzero(coarse), np.full(np.count_nonzero(coarse), float(mu_guess)))
+        seed = np.empty(n_T)
+        for run, grid in _grid_runs(grid_index):
+            coarse_rows = run.start + np.flatnonzero(coarse[run])
+            coarse_rows = coarse_rows[np.argsort(kT[coarse_rows])]
+            seed[run] = np.interp(kT[run], kT[coarse_rows], mu_el[coarse_rows])
+        fine = np.flatnonzero(~coarse)
+        mu_el[fine] = solve(fine, seed[fine])
+    return mu_el
+
+
+# half width (eV) of the energy window used to fit the DOS around the Fermi level for the Sommerfeld expansion
+_SOMMERFELD_WINDOW = 0.2
+# the Sommerfeld integrals are converged within about 10 kT of the Fermi level
+_SOMMERFELD_WINDOW_KT = 10.0
+
+
+def sommerfeld_coefficients(energy, density, window=_SOMMERFELD_WINDOW):
+    """
+    Fit the DOS and its first two derivatives at the Fermi level
+
+    A quadratic is fit to the DOS within ``window`` of the Fermi level (energy zero). The
+    Sommerfeld expansion only applies to metals, so None is returned if the DOS vanishes
+    anywhere in the window.
+
+    Parameters
+    ----------
+    energy : numpy.ndarray
+        Energy grid, relative to the Fermi level
+    density : numpy.ndarray
+        DOS on the energy grid
+    window : float
+        Half width of the fitting window in eV
+
+    Returns
+    -------
+    tuple
+        Tuple of (g, dg/dE, d2g/dE2) at the Fermi level or None if the DOS is not metallic
+    """
+    in_window = np.abs(energy) <= window
+    if np.count_nonzero(in_window) < 3 or np.any(density[in_window] <= 0):
+        return None
+    c2, c1, c0 = np.polyfit(energy[in_window], density[in_window], 2)
+    if c0 <= 0:
+        return None
+    return c0, c1, 2.0*c2
+
+
+def sommerfeld_temperature(coefficients, tolerance, window=_SOMMERFELD_WINDOW):
+    """
+    Highest temperature where the leading Sommerfeld terms are within a relative tolerance
+
+    The relative error of the leading order terms is estimated from the next order of the
+    expansion, which scales as (k_B T)^2 times a combination of g'/g and g''/g. The estimate
+    is for the heat capacity, whose correction is 2, 3 and 6 times larger than those of
+    U(T)-U(0), S(T) and F(T)-U(0). The temperature is also limited so that 10 k_B T stays
+    within the fitting window.
+
+    Parameters
+    ----------
+    coefficients : tuple
+        Tuple of (g, dg/dE, d2g/dE2) at the Fermi level, see ``sommerfeld_coefficients``
+    tolerance : float
+        Relative tolerance of the thermal electronic properties
+    window : float
+        Half width of the window in eV that the DOS was fit in
+
+    Returns
+    -------
+    float
+        Temperature in K
+    """
+    g, dg, d2g = coefficients
+    r1, r2 = dg/g, d2g/g
+    error_coefficient = math.pi**2*abs(0.7*r2 - 0.5*r1**2)
+    window_temperature = window/(_SOMMERFELD_WINDOW_KT*k_B)
+    if error_coefficient == 0:
+        return window_temperature
+    return min(math.sqrt(tolerance/error_coefficient)/k_B, window_temperature)
+
+
+def calculate_thermal_electronic_contribution(dos, t0=0, t1=2000, td=5, xdn=-100, xup=100, ndosmx=10001, dope=0.0, natom=1, gaussian=1000, memory_budget=None,
+                                              sommerfeld_tolerance=None):
     """
     Calculate thermal electronic contribution from pymatgen Dos objects
 
+    With ``sommerfeld_tolerance``, metals are evaluated with the low temperature Sommerfeld
+    expansion up to the temperature where its estimated relative error reaches the tolerance
+    and with the numerical Fermi-Dirac integrals above it.
+
     Parameters
     ----------
     dos : pymatgen.electronic_structure.dos.Dos
@@ -243,36 +653,204 @@ def calculate_thermal_electronic_contribution(dos, t0=0, t1=2000, td=5, xdn=-100
         Number of atoms in the cell
     gaussian : int
         Number of grid points in the Gaussian mesh near the Fermi energy
+    memory_budget : float
+        Approximate memory in MB for the temporary (temperature, energy) arrays. The
+        temperatures are evaluated in blocks that fit in the budget. If None (the default),
+        all temperatures are evaluated at once.
+    sommerfeld_tolerance : float
+        Relative tolerance of the Sommerfeld expansion. If None (the default), all temperatures
+        are integrated numerically.
+
+    Returns
+    -------
+    dict
+        Thermal electronic properties at each temperature. The boolean 'sommerfeld' array marks
+        the temperatures evaluated with the Sommerfeld expansion.
+    """
+    results = calculate_thermal_electronic_contribution_batch([dos], t0=t0, t1=t1, td=td, xdn=xdn, xup=xup, ndosmx=ndosmx,
+                                                              dope=dope, natom=natom, gaussian=gaussian,
+                                                              memory_budget=memory_budget,
+                                                              sommerfeld_tolerance=sommerfeld_tolerance)
+    return {key: value if key == 'temperature' else value[0] for key, value in results.items()}
+
+
+def _thermal_electronic_batch_worker(args):
+    """Evaluate one chunk of DOS objects in a process pool"""
+    dos_objects, kwargs = args
+    return calculate_thermal_electronic_contribution_batch(dos_objects, **kwargs)
+
+
+def thermal_electronic_cache_key(dos, **params):
+    """
+    Cache key of the thermal electronic properties of a DOS
+
+    Parameters
+    ----------
+    dos : pymatgen.electronic_structure.dos.Dos
+        DOS object
+    params : dict
+        Parameters of ``calculate_thermal_electronic_contribution`` that change the results
 
     Returns
     -------
+    str
+        Hash of the DOS arrays, the parameters and ``THERMAL_ELECTRONIC_CACHE_VERSION``
+    """
+    spins = sorted(dos.densities.keys(), key=str)
+    arrays = [[dos.efermi], dos.energies] + [dos.densities[spin] for spin in spins]
+    params = {name: None if value is None else float(value) for name, value in params.items()}
+    params['spins'] = [str(spin) for spin in spins]
+    params['version'] = THERMAL_ELECTRONIC_CACHE_VERSION
+    return hash_arrays(arrays, params)
+
+
+def _cached_thermal_electronic_contribution_batch(cache, dos_objects, kwargs):
+    """Look up each DOS in the cache and only calculate the missing ones"""
+    key_params = {name: value for name, value in kwargs.items() if name not in ('memory_budget', 'processes')}
+    keys = [thermal_electronic_cache_key(dos, **key_params) for dos in dos_objects]
+    entries = [cache.get(key) for key in keys]
+    missing = [idx for idx, entry in enumerate(entries) if entry is None]
+    if missing:
+        results = calculate_thermal_electronic_contribution_batch([dos_objects[idx] for idx in missing], **kwargs)
+        for row, idx in enumerate(missing):
+            entries[idx] = {name: value if name == 'temperature' else value[row] for name, value in results.items()}
+            cache.put(keys[idx], entries[idx])
+    results = {name: np.array([entry[name] for entry in entries]) for name in entries[0] if name != 'temperature'}
+    results['temperature'] = entries[0]['temperature']
+    return results
+
+
+def calculate_thermal_electronic_contribution_batch(dos_objects, t0=0, t1=2000, td=5, xdn=-100, xup=100, ndosmx=10001,
+                                                    dope=0.0, natom=1, gaussian=1000, memory_budget=None,
+                                                    sommerfeld_tolerance=None, processes=None, cache=None):
+    """
+    Calculate thermal electronic contributions for many DOS objects at once, e.g. all volumes of an E-V curve
+
+    Each DOS is interpolated on its own grid of ``ndosmx`` points around its Fermi level (see
+    ``getdos``). The grids are stacked and the chemical potentials, internal energies and
+    entropies of all (volume, temperature) pairs are solved together.
 
+    Parameters
+    ----------
+    dos_objects : list
+        List of pymatgen.electronic_structure.dos.Dos objects
+    t0 : float
+        Start temperature
+    t1 : float
+        Final temperature
+    td : float
+        Temperature step size
+    xdn : float
+        Minimum energy of the DOS to consider
+    xup : float
+        Maximum energy of the DOS to consider
+    ndosmx : int
+        Size of grid to interpolate the DOS on
+    dope : float
+        Doping level
+    natom : int
+        Number of atoms in the cell
+    gaussian : int
+        Number of grid points in the Gaussian mesh near the Fermi energy
+    memory_budget : float
+        Approximate memory in MB for the temporary (row, energy) arrays of each process. If
+        None (the default), all rows are evaluated at once.
+    sommerfeld_tolerance : float
+        Relative tolerance of the Sommerfeld expansion. If None (the default), all temperatures
+        are integrated numerically.
+    processes : int
+        Number of processes to split the DOS objects between. If None (the default), all DOS
+        objects are evaluated in the current process.
+    cache : prlworkflows.analysis.cache.ArrayCache
+        Cache of previous results, keyed by the DOS arrays and the parameters that change the
+        results (see ``thermal_electronic_cache_key``). Only the DOS objects that are not in
+        the cache are calculated and then stored in it. If None (the default), nothing is cached.
+
+    Returns
+    -------
+    dict
+        Thermal electronic properties as arrays of shape (len(dos_objects), len(temperatures)),
+        except for the 'temperature' and 'n_electrons' arrays. The 'free_energy' array can be
+        passed directly to ``Quasiharmonic``.
     """
-    n_electrons, fermi_shift, e, dos = getdos(dos, xdn, xup, dope, ndosmx, gaussian)
+    kwargs = dict(t0=t0, t1=t1, td=td, xdn=xdn, xup=xup, ndosmx=ndosmx, dope=dope, natom=natom, gaussian=gaussian,
+                  memory_budget=memory_budget, sommerfeld_tolerance=sommerfeld_tolerance)
+    if cache is not None:
+        kwargs['processes'] = processes
+        return _cached_thermal_electronic_contribution_batch(cache, dos_objects, kwargs)
+    if processes is not None and processes > 1 and len(dos_objects) > 1:
+        chunks = [chunk for chunk in np.array_split(np.arange(len(dos_objects)), processes) if chunk.size > 0]
+        pool = multiprocessing.Pool(len(chunks))
+        try:
+            chunk_results = pool.map(_thermal_electronic_batch_worker,
+                                     [([dos_objects[i] for i in chunk], kwargs) for chunk in chunks])
+        finally:
+            pool.close()
+            pool.join()
+        results = {key: np.concatenate([r[key] for r in chunk_results]) for key in chunk_results[0] if key != 'temperature'}
+        results['temperature'] = chunk_results[0]['temperature']
+        return results
+
+    grids = [getdos(dos, xdn, xup, dope, ndosmx, gaussian) for dos in dos_objects]
+    n_electrons = np.array([grid[0] for grid in grids])
+    e = np.array([grid[2] for grid in grids])
+    dos = np.array([grid[3] for grid in grids])
 
     # for all temperatures
-    nT = int(np.round((t1-t0)/td+1.0))
     T = np.arange(t0,t1+td,td)
-    chemical_potential = np.zeros(nT)
     gmu0 = 0.0
     beta = 1.0/(T*k_B)
     beta[0] = 1.0e30
-    for i, t in enumerate(T):
-        chemical_potential[i] = brentq(gfind, gmu0-5.0, gmu0+5.0, args=(e, dos, n_electrons, beta[i]), maxiter=10000)
-    U_el = calculate_internal_energy(chemical_potential[:, np.newaxis], e[np.newaxis, :], dos[np.newaxis, :], beta[:, np.newaxis])
-    S_el = calculate_entropy(chemical_potential[:, np.newaxis], e[np.newaxis, :], dos[np.newaxis, :], beta[:, np.newaxis])
-    C_el = np.gradient(U_el, td, edge_order=2)
-    C_el[0] = 0
+    n_V, n_T = len(dos_objects), T.size
+
+    # the first temperature is the T=0 reference and is always integrated numerically
+    sommerfeld = np.zeros((n_V, n_T), dtype=bool)
+    coefficients = [None]*n_V
+    if sommerfeld_tolerance is not None:
+        for v in range(n_V):
+            coefficients[v] = sommerfeld_coefficients(e[v], dos[v])
+            if coefficients[v] is not None:
+                sommerfeld[v] = T <= sommerfeld_temperature(coefficients[v], sommerfeld_tolerance)
+                sommerfeld[v, 0] = False
+    numerical = ~sommerfeld
+    # rows of (volume, temperature) pairs, sorted by volume
+    grid_index, temperature_index = np.nonzero(numerical)
+
+    chemical_potential = np.empty((n_V, n_T))
+    U_el = np.empty((n_V, n_T))
+    S_el = np.empty((n_V, n_T))
+    chemical_potential[numerical] = calculate_chemical_potential(e, dos, n_electrons, beta[temperature_index], mu_guess=gmu0,
+                                                                 bracket=(gmu0-5.0, gmu0+5.0), memory_budget=memory_budget,
+                                                                 grid_index=grid_index)
+    U_el[numerical], S_el[numerical] = calculate_internal_energy_and_entropy(chemical_potential[numerical], e, dos,
+                                                                             beta[temperature_index], memory_budget=memory_budget,
+                                                                             grid_index=grid_index)
+    for v in np.flatnonzero(np.any(sommerfeld, axis=1)):
+        g, dg, d2g = coefficients[v]
+        kT = k_B*T[sommerfeld[v]]
+        chemical_potential[v, sommerfeld[v]] = -math.pi**2/6*kT**2*dg/g
+        U_el[v, sommerfeld[v]] = U_el[v, 0] + math.pi**2/6*kT**2*g
+        S_el[v, sommerfeld[v]] = math.pi**2/3*k_B*kT*g
+    C_el = np.gradient(U_el, td, axis=1, edge_order=2)
+    for v in np.flatnonzero(np.any(sommerfeld, axis=1)):
+        # to leading order C = S in the Sommerfeld regime. Above it, the finite differences only
+        # use the numerical U so that the error of the expansion is not amplified at the switch.
+        C_el[v, sommerfeld[v]] = S_el[v, sommerfeld[v]]
+        switch = np.flatnonzero(sommerfeld[v])[-1] + 1
+        if n_T - switch > 2:
+            C_el[v, switch:] = np.gradient(U_el[v, switch:], td, edge_order=2)
+    C_el[:, 0] = 0
 
     # construct a dictionary of results
     results = {
         'temperature': T,
         'internal_energy': U_el/natom,
-        'free_energy': (U_el-T*S_el-U_el[0])/natom,
+        'free_energy': (U_el-T*S_el-U_el[:, :1])/natom,
         'entropy': S_el/natom,
         'heat_capacity': C_el/natom,
         'chemical_potential': chemical_potential,
         'n_electrons': n_electrons,
+        'sommerfeld': sommerfeld,
     }
 
     return results
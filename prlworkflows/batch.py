@@ -0,0 +1,173 @@
+"""
+Batch construction and submission of workflows for many structures
+
+Workflows are built in parallel worker processes and inserted into the LaunchPad in bulk,
+e.g. for all the SQS configurations of a set of sublattice models.
+"""
+
+import multiprocessing
+import time
+
+from pymatgen import Structure
+from fireworks import Workflow
+
+from prlworkflows.prl_workflows import get_wf_gibbs
+from prlworkflows.utils import recursive_glob
+
+
+def get_structures(structures=None, directory=None, pattern='*POSCAR*', collection=None, query=None,
+                   structure_field='output.structure'):
+    """
+    Structures from a list, the files in a directory or a database query
+
+    Parameters
+    ----------
+    structures : list
+        List of pymatgen Structures or their dictionaries
+    directory : str
+        Directory to recursively search for structure files in
+    pattern : str
+        Filename pattern of the structure files in directory. Defaults to '*POSCAR*'.
+    collection : pymongo.collection.Collection
+        Collection to query for structures
+    query : dict
+        Query of the documents in collection. Defaults to all documents.
+    structure_field : str
+        Dot separated field of the structure in the documents. Defaults to 'output.structure'.
+
+    Returns
+    -------
+    list
+        pymatgen Structures from all the passed sources
+    """
+    result = []
+    for structure in structures or []:
+        result.append(Structure.from_dict(structure) if isinstance(structure, dict) else structure)
+    if directory is not None:
+        result.extend(Structure.from_file(filename) for filename in recursive_glob(directory, pattern))
+    if collection is not None:
+        for doc in collection.find(query or {}, {structure_field: 1}):
+            for key in structure_field.split('.'):
+                doc = doc[key]
+            result.append(Structure.from_dict(doc))
+    return result
+
+
+def _build_workflow(args):
+    """Dictionary of a Gibbs workflow of one structure, for the process pool"""
+    structure_dict, wf_kwargs = args
+    return get_wf_gibbs(Structure.from_dict(structure_dict), **wf_kwargs).to_dict()
+
+
+def build_gibbs_workflows(structures, processes=None, chunksize=4, metadata=None, **wf_kwargs):
+    """
+    Build Gibbs workflows for many structures in parallel
+
+    Parameters
+    ----------
+    structures : list
+        pymatgen Structures
+    processes : int
+        Number of processes. If None, all CPUs are used.
+    chunksize : int
+        Number of structures sent to a worker process at once. Defaults to 4.
+    metadata : dict
+        Metadata of every workflow. Each workflow gets its own tag. If the metadata has a tag,
+        the tags are the tag followed by the index of the structure, e.g. 'sqs-0', 'sqs-1'.
+    wf_kwargs :
+        Keyword arguments to pass to ``get_wf_gibbs``
+
+    Yields
+    ------
+    fireworks.Workflow
+        Workflows in the order of the structures
+    """
+    metadata = metadata or {}
+    tasks = []
+    for i, structure in enumerate(structures):
+        # get_wf_gibbs adds a tag to the metadata, so every workflow needs its own copy
+        wf_metadata = dict(metadata)
+        if 'tag' in metadata:
+            wf_metadata['tag'] = '{}-{}'.format(metadata['tag'], i)
+        tasks.append((structure.as_dict(), dict(wf_kwargs, metadata=wf_metadata)))
+    if processes == 1:
+        for task in tasks:
+            yield Workflow.from_dict(_build_workflow(task))
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for wf_dict in pool.imap(_build_workflow, tasks, chunksize=chunksize):
+            yield Workflow.from_dict(wf_dict)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def add_workflows(launchpad, workflows, batch_size=100):
+    """
+    Add workflows to a LaunchPad in batches with bulk writes
+
+    Falls back to adding the workflows one at a time for LaunchPads without ``bulk_add_wfs``.
+
+    Returns
+    -------
+    int
+        Number of workflows added
+    """
+    num_added = 0
+    batch = []
+    for wf in workflows:
+        batch.append(wf)
+        if len(batch) >= batch_size:
+            num_added += _add_batch(launchpad, batch)
+            batch = []
+    if batch:
+        num_added += _add_batch(launchpad, batch)
+    return num_added
+
+
+def _add_batch(launchpad, workflows):
+    if hasattr(launchpad, 'bulk_add_wfs'):
+        launchpad.bulk_add_wfs(workflows)
+    else:
+        for wf in workflows:
+            launchpad.add_wf(wf)
+    return len(workflows)
+
+
+def submit_gibbs_workflows(launchpad, structures, processes=None, batch_size=100, metadata=None, **wf_kwargs):
+    """
+    Build Gibbs workflows for many structures in parallel and add them to a LaunchPad in bulk
+
+    Workflows are inserted in batches while the next ones are being built.
+
+    Parameters
+    ----------
+    launchpad : fireworks.LaunchPad
+        LaunchPad to add the workflows to
+    structures : list
+        pymatgen Structures, e.g. from ``get_structures``
+    processes : int
+        Number of processes to build workflows with. If None, all CPUs are used.
+    batch_size : int
+        Number of workflows per bulk insert. Defaults to 100.
+    metadata : dict
+        Metadata of every workflow, see ``build_gibbs_workflows``
+    wf_kwargs :
+        Keyword arguments to pass to ``get_wf_gibbs``
+
+    Returns
+    -------
+    dict
+        Dictionary of the number of workflows added ('num_workflows'), the total time in
+        seconds ('time') and the throughput ('workflows_per_second')
+    """
+    start = time.time()
+    workflows = build_gibbs_workflows(structures, processes=processes, metadata=metadata, **wf_kwargs)
+    num_workflows = add_workflows(launchpad, workflows, batch_size=batch_size)
+    elapsed = time.time() - start
+    return {
+        'num_workflows': num_workflows,
+        'time': elapsed,
+        'workflows_per_second': num_workflows/elapsed if elapsed > 0 else float('inf'),
+    }
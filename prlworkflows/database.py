@@ -0,0 +1,445 @@
+"""
+Helpers for storing numpy arrays in MongoDB documents and for reading calculations in bulk
+
+Arrays are stored as compressed binary data instead of nested lists of numbers. Small arrays
+are stored inline in the document as BSON ``Binary`` with their dtype and shape. Arrays larger
+than a threshold are stored in GridFS and the document only keeps a reference, so documents
+stay far below MongoDB's 16 MB limit regardless of the size of the array.
+"""
+
+import json
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import gridfs
+from bson.binary import Binary
+from pymatgen.electronic_structure.dos import CompleteDos
+
+# arrays with more (compressed) bytes than this are stored in GridFS instead of inline
+GRIDFS_THRESHOLD = 8*1024**2
+
+# indexes for the queries of this package, {collection: [index key specifications]}
+# An index with options is a tuple of (key specification, dictionary of options).
+# The unique task_id index of the tasks and the (files_id, n) index of GridFS chunks are
+# created by atomate and GridFS and are not managed here.
+INDEXES = {
+    'tasks': [[('metadata.tag', 1)], [('fingerprint', 1), ('fingerprint_volume', 1)]],
+    'phonon': [[('metadata.tag', 1)]],
+    'qha': [[('metadata.tag', 1)],
+            # one incremental QHA result per tag, see prlworkflows.analysis.incremental_qha
+            ([('metadata.tag', 1), ('incremental', 1)], {'unique': True, 'partialFilterExpression': {'incremental': True}})],
+    'eos': [[('metadata.tag', 1)]],
+    # one column per task, see prlworkflows.analysis.incremental_qha
+    'qha_columns': [([('metadata.tag', 1), ('task_id', 1)], {'unique': True})],
+}
+
+
+def encode_array(array, db=None, gridfs_collection='arrays_fs', gridfs_threshold=GRIDFS_THRESHOLD, compress=True):
+    """
+    Encode a numpy array as a BSON-serializable dictionary
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+        Array to encode
+    db : pymongo.database.Database
+        Database to store large arrays in with GridFS. If None, arrays are always stored inline.
+    gridfs_collection : str
+        Name of the GridFS collection for large arrays
+    gridfs_threshold : int
+        Arrays with more bytes than this (after compression) are stored in GridFS if a database
+        is given
+    compress : bool
+        Compress the data with zlib. Defaults to True.
+
+    Returns
+    -------
+    dict
+        Dictionary with the dtype, shape and compression of the array and either the binary
+        data ('data') or the GridFS file id ('gridfs_id' and 'gridfs_collection')
+    """
+    array = np.ascontiguousarray(array)
+    data = array.tobytes()
+    if compress:
+        data = zlib.compress(data)
+    encoded = {
+        'dtype': array.dtype.str,
+        'shape': list(array.shape),
+        'compression': 'zlib' if compress else None,
+    }
+    if db is not None and len(data) > gridfs_threshold:
+        fs = gridfs.GridFS(db, gridfs_collection)
+        encoded['gridfs_id'] = fs.put(data)
+        encoded['gridfs_collection'] = gridfs_collection
+    else:
+        encoded['data'] = Binary(data)
+    return encoded
+
+
+def is_encoded_array(value):
+    """True if value is an array encoded by ``encode_array``"""
+    return isinstance(value, dict) and 'dtype' in value and 'shape' in value and \
+        ('data' in value or 'gridfs_id' in value)
+
+
+def decode_array(value, db=None, copy=True):
+    """
+    Decode an array stored by ``encode_array``
+
+    Values that are not encoded arrays, e.g. the nested lists of documents written before the
+    arrays were stored as binary, are converted with ``numpy.array``.
+
+    Parameters
+    ----------
+    value : dict or list
+        Encoded array or array-like value
+    db : pymongo.database.Database
+        Database that the array was stored in. Required for arrays stored in GridFS.
+    copy : bool
+        If False, uncompressed arrays are returned as read-only views of the document's binary
+        data instead of copies. Defaults to True.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if not is_encoded_array(value):
+        return np.array(value)
+    if 'gridfs_id' in value:
+        if db is None:
+            raise ValueError('A database is required to decode arrays stored in GridFS')
+        data = gridfs.GridFS(db, value['gridfs_collection']).get(value['gridfs_id']).read()
+    else:
+        data = value['data']
+    if value.get('compression') == 'zlib':
+        data = zlib.decompress(data)
+    elif value.get('compression') is not None:
+        raise ValueError('Unknown array compression {}'.format(value['compression']))
+    array = np.frombuffer(data, dtype=np.dtype(value['dtype'])).reshape(value['shape'])
+    # copy, because arrays backed by bytes are read-only
+    return array.copy() if copy else array
+
+
+def delete_array(value, db):
+    """Remove the GridFS file of an encoded array, if it has one"""
+    if is_encoded_array(value) and 'gridfs_id' in value:
+        gridfs.GridFS(db, value['gridfs_collection']).delete(value['gridfs_id'])
+
+
+def read_gridfs_files(db, file_ids, gridfs_collection):
+    """
+    Read several GridFS files with a single query of their chunks
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database of the GridFS collection
+    file_ids : list
+        GridFS file ids to read
+    gridfs_collection : str
+        Name of the GridFS collection, e.g. 'dos_fs'
+
+    Returns
+    -------
+    list
+        Contents (bytes) of each file, in the order of file_ids
+    """
+    chunks = {}
+    query = {'files_id': {'$in': list(file_ids)}}
+    for chunk in db['{}.chunks'.format(gridfs_collection)].find(query, {'files_id': 1, 'n': 1, 'data': 1}):
+        chunks.setdefault(chunk['files_id'], []).append((chunk['n'], chunk['data']))
+    contents = []
+    for file_id in file_ids:
+        if file_id not in chunks:
+            raise gridfs.errors.NoFile('No file with id {} in GridFS collection {}'.format(file_id, gridfs_collection))
+        contents.append(b''.join(bytes(data) for n, data in sorted(chunks[file_id], key=lambda chunk: chunk[0])))
+    return contents
+
+
+def _decode_dos(data):
+    """CompleteDos from the zlib compressed JSON written by atomate"""
+    return CompleteDos.from_dict(json.loads(zlib.decompress(data).decode()))
+
+
+def get_dos_objects(db, dos_fs_ids, gridfs_collection='dos_fs', threads=None):
+    """
+    Fetch several densities of states from GridFS at once and decode them concurrently
+
+    This is the bulk version of ``VaspCalcDb.get_dos``. All the DOS are read with one query and
+    decompressed and parsed in a thread pool, instead of one GridFS round trip per DOS.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database of the calculations, e.g. ``VaspCalcDb.db``
+    dos_fs_ids : list
+        GridFS ids of the DOS (``calcs_reversed.0.dos_fs_id`` of the task documents)
+    gridfs_collection : str
+        Name of the GridFS collection of the DOS. Defaults to 'dos_fs'.
+    threads : int
+        Number of threads to decode with. If None, the number of CPUs is used.
+
+    Returns
+    -------
+    list
+        pymatgen CompleteDos objects, in the order of dos_fs_ids
+    """
+    contents = read_gridfs_files(db, dos_fs_ids, gridfs_collection)
+    if len(contents) < 2 or threads == 1:
+        return [_decode_dos(data) for data in contents]
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(_decode_dos, contents)
+    finally:
+        pool.close()
+
+
+def _static_calculations_query(tag, dos=True, task_ids=None, all_structures=False):
+    """Query and projection of the task documents read by ``get_static_calculations``"""
+    structure_field = 'output.structure' if all_structures else 'output.structure.lattice.volume'
+    projection = {'task_id': 1, 'output.energy': 1, structure_field: 1}
+    if dos:
+        projection['calcs_reversed.dos_fs_id'] = 1
+    query = {'metadata.tag': tag}
+    if task_ids is not None:
+        query['task_id'] = {'$in': list(task_ids)}
+    return query, projection
+
+
+def get_static_calculations(db, tag, collection='tasks', dos=True, threads=None, task_ids=None, all_structures=False):
+    """
+    Energies, volumes and DOS of all the calculations with a tag, sorted by volume
+
+    Only the needed fields of the task documents are fetched and all the DOS are read at once
+    (see ``get_dos_objects``), so the number of database round trips does not grow with the
+    number of calculations. Only the volume of each structure is fetched, plus one full
+    structure for the composition, unless all_structures is True.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database of the calculations, e.g. ``VaspCalcDb.db``
+    tag : str
+        Tag of the calculations (``metadata.tag``)
+    collection : str
+        Name of the task collection. Defaults to 'tasks'.
+    dos : bool
+        Whether to fetch the DOS. Defaults to True.
+    threads : int
+        Number of threads to decode the DOS with. If None, the number of CPUs is used.
+    task_ids : list
+        Only fetch the calculations with these task ids. Defaults to all calculations with the tag.
+    all_structures : bool
+        Whether to fetch the structures of all the calculations. Defaults to False.
+
+    Returns
+    -------
+    dict
+        Dictionary of 'task_ids', 'energies', 'volumes', 'structure' (the dictionary of the
+        structure with the smallest volume) and, if dos is True, 'dos_objects' and, if
+        all_structures is True, 'structures' (as dictionaries), each sorted by increasing volume
+    """
+    query, projection = _static_calculations_query(tag, dos=dos, task_ids=task_ids, all_structures=all_structures)
+    calculations = sorted(db[collection].find(query, projection),
+                          key=lambda calc: calc['output']['structure']['lattice']['volume'])
+    result = {
+        'task_ids': [calc.get('task_id') for calc in calculations],
+        'energies': [calc['output']['energy'] for calc in calculations],
+        'volumes': [calc['output']['structure']['lattice']['volume'] for calc in calculations],
+    }
+    if all_structures:
+        result['structures'] = [calc['output']['structure'] for calc in calculations]
+        result['structure'] = result['structures'][0] if calculations else None
+    elif calculations:
+        result['structure'] = db[collection].find_one({'_id': calculations[0]['_id']},
+                                                      {'output.structure': 1})['output']['structure']
+    else:
+        result['structure'] = None
+    if dos:
+        dos_fs_ids = [calc['calcs_reversed'][0]['dos_fs_id'] for calc in calculations]
+        result['dos_objects'] = get_dos_objects(db, dos_fs_ids, threads=threads)
+    return result
+
+
+def load_qha_results(db, query=None, model='phonon', collection='qha'):
+    """
+    G(T) and V(T) of many QHA documents as stacked arrays
+
+    Documents with binary arrays (see the ``array_dtype`` option of ``QHAAnalysis``) are read
+    directly into the stacked arrays without going through Python lists. Documents with lists
+    are also supported.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database of the QHA documents, e.g. ``VaspCalcDb.db``
+    query : dict
+        Query of the documents to load, e.g. ``{'formula_pretty': {'$in': ['Al', 'Ni']}}``.
+        Defaults to all documents.
+    model : str
+        Vibrational model of the results, either 'phonon' or 'debye'. Documents without results
+        for the model are skipped.
+    collection : str
+        Name of the QHA collection. Defaults to 'qha'.
+
+    Returns
+    -------
+    dict
+        Dictionary of 'temperatures' with shape (n_temperatures,), 'gibbs_free_energy' and
+        'optimum_volumes' with shape (n_documents, n_temperatures) and the 'formulas' and
+        'tags' of the documents.
+
+    Raises
+    ------
+    ValueError
+        If the documents do not have the same temperatures
+    """
+    projection = {'formula_pretty': 1, 'metadata.tag': 1, model: 1}
+    query = dict(query or {})
+    query[model] = {'$exists': True}
+    docs = list(db[collection].find(query, projection))
+    if not docs:
+        return {'temperatures': np.empty(0), 'gibbs_free_energy': np.empty((0, 0)),
+                'optimum_volumes': np.empty((0, 0)), 'formulas': [], 'tags': []}
+    temperatures = decode_array(docs[0][model]['temperatures'])
+    gibbs_free_energy = np.empty((len(docs), temperatures.size))
+    optimum_volumes = np.empty((len(docs), temperatures.size))
+    for i, doc in enumerate(docs):
+        if not np.allclose(decode_array(doc[model]['temperatures'], copy=False), temperatures):
+            raise ValueError('QHA document {} has different temperatures'.format(doc['_id']))
+        gibbs_free_energy[i] = decode_array(doc[model]['gibbs_free_energy'], copy=False)
+        optimum_volumes[i] = decode_array(doc[model]['optimum_volumes'], copy=False)
+    return {
+        'temperatures': temperatures,
+        'gibbs_free_energy': gibbs_free_energy,
+        'optimum_volumes': optimum_volumes,
+        'formulas': [doc.get('formula_pretty', '') for doc in docs],
+        'tags': [doc.get('metadata', {}).get('tag', '') for doc in docs],
+    }
+
+
+def save_qha_results(path, results):
+    """Save QHA results from ``load_qha_results`` to an uncompressed NPZ bundle"""
+    np.savez(path, **{name: np.asarray(value) for name, value in results.items()})
+
+
+def load_qha_results_npz(path):
+    """Load a NPZ bundle written by ``save_qha_results`` as a dictionary of arrays"""
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def _rename_tasks_collection(indexes, tasks_collection):
+    indexes = dict(indexes)
+    if tasks_collection != 'tasks' and 'tasks' in indexes:
+        indexes[tasks_collection] = indexes.pop('tasks')
+    return indexes
+
+
+def _index_spec(index):
+    """Key specification and options of an index of ``INDEXES``"""
+    if isinstance(index, tuple):
+        return index
+    return index, {}
+
+
+def _index_key_patterns(collection):
+    """Key patterns of the existing indexes of a collection, as lists of (key, direction) tuples"""
+    return [[tuple(key) for key in info['key']] for info in collection.index_information().values()]
+
+
+def ensure_indexes(db, indexes=None, tasks_collection='tasks'):
+    """
+    Create the indexes needed by the queries of this package, if they do not exist
+
+    Indexes whose key pattern already exists are skipped, whatever their options (e.g. unique
+    indexes created by atomate), so this is safe to call before every analysis. New indexes are
+    built in the background so that other clients are not blocked.
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database of the calculations, e.g. ``VaspCalcDb.db``
+    indexes : dict
+        Dictionary of {collection name: list of indexes} like ``INDEXES``. Defaults to ``INDEXES``.
+    tasks_collection : str
+        Name of the task collection, if it is not 'tasks'
+
+    Returns
+    -------
+    dict
+        Dictionary of {collection name: list of the names of the created indexes}
+    """
+    indexes = _rename_tasks_collection(indexes or INDEXES, tasks_collection)
+    index_names = {}
+    for collection, keys_list in indexes.items():
+        existing = _index_key_patterns(db[collection])
+        index_names[collection] = []
+        for keys, options in map(_index_spec, keys_list):
+            if [tuple(key) for key in keys] not in existing:
+                index_names[collection].append(db[collection].create_index(keys, background=True, **options))
+    return index_names
+
+
+def missing_indexes(db, indexes=None, tasks_collection='tasks'):
+    """
+    Indexes of ``ensure_indexes`` that do not exist in the database
+
+    Returns
+    -------
+    dict
+        Dictionary of {collection name: list of missing index key specifications}. Empty if
+        all the indexes exist.
+    """
+    indexes = _rename_tasks_collection(indexes or INDEXES, tasks_collection)
+    missing = {}
+    for collection, keys_list in indexes.items():
+        existing = _index_key_patterns(db[collection])
+        collection_missing = [keys for keys, options in map(_index_spec, keys_list)
+                              if [tuple(key) for key in keys] not in existing]
+        if collection_missing:
+            missing[collection] = collection_missing
+    return missing
+
+
+def query_plan_stages(plan):
+    """Stages of a MongoDB query plan, from the outermost to the innermost, e.g. ['FETCH', 'IXSCAN']"""
+    stages = [plan['stage']]
+    inputs = [plan['inputStage']] if 'inputStage' in plan else plan.get('inputStages', [])
+    for input_stage in inputs:
+        stages.extend(query_plan_stages(input_stage))
+    return stages
+
+
+def explain_queries(db, tag=None, tasks_collection='tasks'):
+    """
+    Winning query plans of the package's queries by tag
+
+    Parameters
+    ----------
+    db : pymongo.database.Database
+        Database of the calculations, e.g. ``VaspCalcDb.db``
+    tag : str
+        Tag to query for. Only the plan matters, so the tag does not need to exist.
+    tasks_collection : str
+        Name of the task collection, if it is not 'tasks'
+
+    Returns
+    -------
+    dict
+        Dictionary of {collection name: list of stages of the winning plan}. A 'COLLSCAN' stage
+        means the query scans the whole collection.
+    """
+    tag = tag or 'explain'
+    queries = {
+        tasks_collection: _static_calculations_query(tag),
+        'phonon': ({'metadata.tag': tag}, None),
+        'qha': ({'metadata.tag': tag}, None),
+        'eos': ({'metadata.tag': tag}, None),
+    }
+    plans = {}
+    for collection, (query, projection) in queries.items():
+        explanation = db[collection].find(query, projection).explain()
+        plans[collection] = query_plan_stages(explanation['queryPlanner']['winningPlan'])
+    return plans
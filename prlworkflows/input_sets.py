@@ -1,5 +1,6 @@
 import six
 
+from monty.json import MontyDecoder
 from pymatgen.io.vasp.inputs import Kpoints, Incar
 from pymatgen.io.vasp.sets import DictSet, get_vasprun_outcar, get_structure_from_prev_run, _load_yaml_config
 
@@ -369,3 +370,24 @@ class PRLRoughStaticSet(DictSet):
 
         return PRLRoughStaticSet(structure=prev_structure, prev_incar=prev_incar,
             prev_kpoints=prev_kpoints, grid_density=grid_density, **kwargs)
+
+
+def input_set_for_structure(vasp_input_set, structure):
+    """
+    Copy of a VASP input set with the same settings for another structure
+
+    Parameters
+    ----------
+    vasp_input_set : pymatgen.io.vasp.sets.VaspInputSet
+        Input set to copy, or its dictionary from ``as_dict``
+    structure : pymatgen.Structure
+        Structure of the new input set
+
+    Returns
+    -------
+    pymatgen.io.vasp.sets.VaspInputSet
+        Input set of the same class and parameters as vasp_input_set for the structure
+    """
+    vis_dict = vasp_input_set if isinstance(vasp_input_set, dict) else vasp_input_set.as_dict()
+    vis_dict = dict(vis_dict, structure=structure.as_dict())
+    return MontyDecoder().process_decoded(vis_dict)
@@ -7,8 +7,15 @@ from pymatgen.analysis.eos import EOS
 from fireworks import explicit_serialize, FiretaskBase, FWAction
 from atomate.utils.utils import load_class, env_chk
 from atomate.vasp.database import VaspCalcDb
-from prlworkflows.analysis.phonon import get_f_vib_phonopy
+from prlworkflows.analysis.cache import ArrayCache
+from prlworkflows.analysis.phonon import get_phonopy, get_phonon_thermal_properties_dict, read_force_constants_vasprun, \
+    recalculate_phonon_thermal_properties, interpolate_phonon_f_vib
 from prlworkflows.analysis.quasiharmonic import Quasiharmonic
+from prlworkflows.analysis.incremental_qha import update_incremental_qha
+from prlworkflows.analysis.adaptive_eos import next_eos_volumes
+from prlworkflows.database import encode_array, ensure_indexes, get_static_calculations
+from prlworkflows.registry import fingerprint_from_directory, write_fingerprint, read_fingerprint, find_registered_task, \
+    register_task, reuse_task
 from prlworkflows.utils import sort_x_by_y
 import numpy as np
 
@@ -76,10 +83,20 @@ class CalculatePhononThermalProperties(FiretaskBase):
 
     This requires that a vasprun.xml from a force constants run and
     a POSCAR-unitcell be present in the current directory.
+
+    Optional params
+    ---------------
+    metadata : dict
+        Metadata about this workflow. Defaults to an empty dictionary
+    qpoint_mesh_tolerance : float
+        If passed, the thermal properties are calculated on a q-point mesh that is made denser
+        until F_vib changes by less than this tolerance in eV/atom at all temperatures. The
+        default (None) uses a fixed 50x50x50 mesh. The mesh and the error estimate are stored
+        as 'qpoint_mesh' and 'qpoint_mesh_error'.
     """
 
     required_params = ['supercell_matrix', 't_min', 't_max', 't_step', 'db_file', 'tag']
-    optional_params = ['metadata']
+    optional_params = ['metadata', 'qpoint_mesh_tolerance']
 
     def run_task(self, fw_spec):
 
@@ -89,27 +106,73 @@ class CalculatePhononThermalProperties(FiretaskBase):
 
         unitcell = Structure.from_file('POSCAR-unitcell')
         supercell_matrix = self['supercell_matrix']
-        temperatures, f_vib, s_vib, cv_vib, force_constants = get_f_vib_phonopy(unitcell, supercell_matrix, vasprun_path='vasprun.xml', t_min=self['t_min'], t_max=self['t_max'], t_step=self['t_step'])
+        force_constants, elements = read_force_constants_vasprun('vasprun.xml')
+        ph = get_phonopy(unitcell, supercell_matrix, force_constants)
+        thermal_props_dict = get_phonon_thermal_properties_dict(ph, t_min=self['t_min'], t_max=self['t_max'],
+                                                                t_step=self['t_step'],
+                                                                qpoint_mesh_tolerance=self.get('qpoint_mesh_tolerance'))
         if isinstance(supercell_matrix, np.ndarray):
             supercell_matrix = supercell_matrix.tolist()  # make serializable
-        thermal_props_dict = {
+
+        db_file = env_chk(self["db_file"], fw_spec)
+        vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
+        thermal_props_dict.update({
             'volume': unitcell.volume,
-            'F_vib': f_vib.tolist(),
-            'CV_vib': cv_vib.tolist(),
-            'S_vib': s_vib.tolist(),
-            'temperatures': temperatures.tolist(),
-            'force_constants': force_constants.tolist(),
+            # compressed binary, in GridFS for large supercells. Read with prlworkflows.database.decode_array
+            'force_constants': encode_array(ph.force_constants, db=vasp_db.db, gridfs_collection='phonon_fs'),
             'metadata': metadata,
             'unitcell': unitcell.as_dict(),
             'supercell_matrix': supercell_matrix,
-        }
+        })
 
         # insert into database
-        db_file = env_chk(self["db_file"], fw_spec)
-        vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
         vasp_db.db['phonon'].insert_one(thermal_props_dict)
 
 
+@explicit_serialize
+class RecalculatePhononThermalProperties(FiretaskBase):
+    """
+    Recalculate the phonon thermal properties of all volumes with a tag from the stored force constants.
+
+    The Phonopy objects are rebuilt from the 'unitcell', 'supercell_matrix' and 'force_constants'
+    of the documents in the ``phonon`` collection, so no VASP files are needed. The documents
+    are updated in place.
+
+    Required params
+    ---------------
+    tag : str
+        Tag of the phonon documents to recalculate.
+    db_file : str
+        Points to the database JSON file. If None (the default) is passed, the path will be looked up in the FWorker.
+    t_min : float
+        Minimum temperature
+    t_step : float
+        Temperature step size
+    t_max : float
+        Maximum temperature (inclusive)
+
+    Optional params
+    ---------------
+    qpoint_mesh : list
+        Mesh of q-points. Defaults to [50, 50, 50]. Ignored if qpoint_mesh_tolerance is passed.
+    qpoint_mesh_tolerance : float
+        Converge the q-point mesh until F_vib changes by less than this tolerance in eV/atom.
+    processes : int
+        Number of processes to use. Defaults to the number of CPUs.
+    """
+
+    required_params = ['tag', 'db_file', 't_min', 't_max', 't_step']
+    optional_params = ['qpoint_mesh', 'qpoint_mesh_tolerance', 'processes']
+
+    def run_task(self, fw_spec):
+        db_file = env_chk(self.get("db_file"), fw_spec)
+        vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
+        ensure_indexes(vasp_db.db, tasks_collection=vasp_db.collection.name)
+        recalculate_phonon_thermal_properties(vasp_db.db, self['tag'], t_min=self['t_min'], t_max=self['t_max'],
+                                              t_step=self['t_step'], qpoint_mesh=self.get('qpoint_mesh', [50, 50, 50]),
+                                              qpoint_mesh_tolerance=self.get('qpoint_mesh_tolerance'),
+                                              processes=self.get('processes'))
+
 
 @explicit_serialize
 class QHAAnalysis(FiretaskBase):
@@ -138,15 +201,37 @@ class QHAAnalysis(FiretaskBase):
     bp2gru : float
         Debye model fitting parameter for dBdP in the Gruneisen parameter. 2/3 is the high temperature
         value and 1 is the low temperature value. Defaults to 1.
+    el_cache_dir : str
+        Directory of an on-disk cache of the thermal electronic contributions, so that re-running
+        the analysis of the same DOS skips the electronic calculations. Supports env_chk.
+        If None (the default), no cache is used.
+    el_cache_size : float
+        Maximum size of the thermal electronic cache in MB. The least recently used results are
+        evicted first. Defaults to 1024.
+    phonon_interpolation_degree : int
+        Degree of the polynomial in volume used to interpolate the force constants when there are
+        fewer phonon calculations than volumes. Defaults to 2.
+    vib_models : list
+        Vibrational models to evaluate, any of 'phonon' and 'debye'. Defaults to ['phonon', 'debye']
+        if phonon is True and ['debye'] otherwise. The models share the electronic free energy.
+    array_dtype : str
+        If passed, e.g. 'float64' or 'float32', the temperatures, Gibbs energies and optimum volumes
+        are stored as uncompressed binary arrays of this dtype instead of lists. They can be read
+        in bulk with ``prlworkflows.database.load_qha_results``.
 
     Notes
     -----
     Heterogeneity in the sources of E_0/F_el and F_vib is solved by sorting them according to increasing volume.
+
+    If phonons were only calculated at some of the volumes, F_vib at the other volumes is found
+    by interpolating the force constants in volume. The interpolation and its leave-one-out
+    error estimate are stored in 'phonon_interpolation' of the QHA document.
     """
 
     required_params = ["phonon", "db_file", "t_min", "t_max", "t_step", "tag"]
 
-    optional_params = ["poisson", "bp2gru", "metadata"]
+    optional_params = ["poisson", "bp2gru", "metadata", "el_cache_dir", "el_cache_size", "phonon_interpolation_degree", "vib_models",
+                       "array_dtype"]
 
     def run_task(self, fw_spec):
         # handle arguments and database setup
@@ -154,28 +239,30 @@ class QHAAnalysis(FiretaskBase):
         tag = self["tag"]
 
         vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
-
-        # get the energies, volumes and DOS objects by searching for the tag
-        static_calculations = vasp_db.collection.find({"metadata.tag": tag})
-
-        energies = []
-        volumes = []
-        dos_objs = []  # pymatgen.electronic_structure.dos.Dos objects
-        structure = None  # single Structure for QHA calculation
-        for calc in static_calculations:
-            energies.append(calc['output']['energy'])
-            volumes.append(calc['output']['structure']['lattice']['volume'])
-            dos_objs.append(vasp_db.get_dos(calc['task_id']))
-            # get a Structure. We only need one for the masses and number of atoms in the unit cell.
-            if structure is None:
-                structure = Structure.from_dict(calc['output']['structure'])
-
-        # sort everything in volume order
-        # note that we are doing volume last because it is the thing we are sorting by!
-
-        energies = sort_x_by_y(energies, volumes)
-        dos_objs = sort_x_by_y(dos_objs, volumes)
-        volumes = sorted(volumes)
+        # metadata.tag lookups scan the whole collection without an index
+        ensure_indexes(vasp_db.db, tasks_collection=vasp_db.collection.name)
+        el_cache_dir = env_chk(self.get("el_cache_dir"), fw_spec)
+        el_kwargs = {}
+        if el_cache_dir:
+            el_kwargs['cache'] = ArrayCache(el_cache_dir, max_size=self.get("el_cache_size", 1024))
+
+        # vibrational models
+        vib_models = self.get('vib_models') or (['phonon', 'debye'] if self['phonon'] else ['debye'])
+        unknown_models = set(vib_models) - {'phonon', 'debye'}
+        if unknown_models:
+            raise ValueError('Unknown vibrational models: {}'.format(', '.join(sorted(unknown_models))))
+        if 'phonon' in vib_models and not self['phonon']:
+            raise ValueError("The 'phonon' vibrational model requires phonon=True")
+
+        # get the energies, volumes and DOS objects by searching for the tag, sorted by volume
+        # the structures of all the volumes are only needed to interpolate the phonons
+        static_calculations = get_static_calculations(vasp_db.db, tag, collection=vasp_db.collection.name,
+                                                      all_structures='phonon' in vib_models)
+        energies = static_calculations['energies']
+        volumes = static_calculations['volumes']
+        dos_objs = static_calculations['dos_objects']  # pymatgen.electronic_structure.dos.Dos objects
+        # single Structure for QHA calculation. We only need one for the masses and number of atoms in the unit cell.
+        structure = Structure.from_dict(static_calculations['structure'])
 
 
         qha_result = {}
@@ -184,38 +271,119 @@ class QHAAnalysis(FiretaskBase):
         qha_result['metadata'] = self.get('metadata', {})
         qha_result['has_phonon'] = self['phonon']
 
-        # phonon properties
-        if self['phonon']:
+        qha_kwargs = dict(t_min=self['t_min'], t_max=self['t_max'], t_step=self['t_step'], eos='vinet',
+                          poisson=self.get('poisson', 0.25), bp2gru=self.get('bp2gru', 1), el_kwargs=el_kwargs)
+        # the cold curve is fit once, stored and shared with the Debye model
+        ev_eos_fit = EOS(qha_kwargs['eos']).fit(volumes, energies)
+        qha_result['eos'] = {'e0': float(ev_eos_fit.e0), 'v0': float(ev_eos_fit.v0),
+                             'b0_GPa': float(ev_eos_fit.b0_GPa), 'b1': float(ev_eos_fit.b1)}
+        # F_el and G_0 (E_0 + F_el + PV) are calculated by the first model and shared with the others
+        f_el = None
+        g_0 = None
+        if 'phonon' in vib_models:
             # get the vibrational properties from the FW spec
             phonon_calculations = list(vasp_db.db['phonon'].find({'metadata.tag': tag}))
-            vol_vol = [calc['volume'] for calc in phonon_calculations]  # these are just used for sorting and will be thrown away
-            vol_f_vib = [calc['F_vib'] for calc in phonon_calculations]
-            # sort them order of the unit cell volumes
-            vol_f_vib = sort_x_by_y(vol_f_vib, vol_vol)
-            f_vib = np.vstack(vol_f_vib)
-            qha = Quasiharmonic(energies, volumes, structure, dos_objects=dos_objs, F_vib=f_vib,
-                                t_min=self['t_min'], t_max=self['t_max'], t_step=self['t_step'],
-                                poisson=self.get('poisson', 0.25), bp2gru=self.get('bp2gru', 1))
+            if len(phonon_calculations) < len(volumes):
+                structures = [Structure.from_dict(s) for s in static_calculations['structures']]
+                f_vib, phonon_interpolation = interpolate_phonon_f_vib(
+                    phonon_calculations, structures, t_min=self['t_min'], t_max=self['t_max'], t_step=self['t_step'],
+                    degree=self.get('phonon_interpolation_degree', 2), db=vasp_db.db)
+                qha_result['phonon_interpolation'] = phonon_interpolation
+            else:
+                vol_vol = [calc['volume'] for calc in phonon_calculations]  # these are just used for sorting and will be thrown away
+                vol_f_vib = [calc['F_vib'] for calc in phonon_calculations]
+                # sort them order of the unit cell volumes
+                vol_f_vib = sort_x_by_y(vol_f_vib, vol_vol)
+                f_vib = np.vstack(vol_f_vib)
+            qha = Quasiharmonic(energies, volumes, structure, dos_objects=dos_objs, F_vib=f_vib, F_el=f_el, **qha_kwargs)
+            f_el = qha.F_el
+            g_0 = qha.G_0
             qha_result['phonon'] = qha.get_summary_dict()
             qha_result['phonon']['temperatures'] = qha_result['phonon']['temperatures'].tolist()
 
-        # calculate the Debye model results no matter what
-        qha_debye = Quasiharmonic(energies, volumes, structure, dos_objects=dos_objs, F_vib=None,
-                                  t_min=self['t_min'], t_max=self['t_max'], t_step=self['t_step'],
-                                  poisson=self.get('poisson', 0.25), bp2gru=self.get('bp2gru', 1))
-
-
-        qha_result['debye'] = qha_debye.get_summary_dict()
-        qha_result['debye']['temperatures'] = qha_result['debye']['temperatures'].tolist()
+        if 'debye' in vib_models:
+            qha_debye = Quasiharmonic(energies, volumes, structure, dos_objects=dos_objs, F_vib=None, F_el=f_el, G_0=g_0,
+                                      vib_kwargs={'ev_eos_fit': ev_eos_fit}, **qha_kwargs)
+            qha_result['debye'] = qha_debye.get_summary_dict()
+            qha_result['debye']['temperatures'] = qha_result['debye']['temperatures'].tolist()
 
         # write to JSON for debugging purposes
         import json
         with open('qha_summary.json', 'w') as fp:
             json.dump(qha_result, fp)
 
+        if self.get('array_dtype'):
+            for model in vib_models:
+                for key in ('temperatures', 'gibbs_free_energy', 'optimum_volumes'):
+                    qha_result[model][key] = encode_array(np.asarray(qha_result[model][key], dtype=self['array_dtype']),
+                                                          compress=False)
+
         vasp_db.db['qha'].insert_one(qha_result)
 
 
+@explicit_serialize
+class IncrementalQHAAnalysis(FiretaskBase):
+    """
+    Add the finished volumes to a partial QHA and publish a provisional result once enough exist
+
+    This task is meant to run at the end of every static (Debye) or phonon Firework of a
+    workflow, instead of a single QHAAnalysis that waits for all of the volumes. See
+    ``prlworkflows.analysis.incremental_qha.update_incremental_qha``.
+
+    Required params
+    ---------------
+    tag : str
+        Tag to search the database for static calculations (energies, volumes, eDOS) from this job.
+    db_file : str
+        Points to the database JSON file. If None (the default) is passed, the path will be looked up in the FWorker.
+    phonon : bool
+        True if f_vib comes from phonon calculations. If False, it is calculated by the Debye model.
+    num_volumes : int
+        Total number of volumes of the workflow. The QHA result is provisional until all are included.
+    t_min : float
+        Minimum temperature
+    t_step : float
+        Temperature step size
+    t_max : float
+        Maximum temperature (inclusive)
+
+    Optional params
+    ---------------
+    min_volumes : int
+        Number of volumes needed to publish a provisional QHA result. Defaults to 5.
+    poisson : float
+        Poisson ratio, defaults to 0.25. Only used in Debye
+    bp2gru : float
+        Debye model fitting parameter for dBdP in the Gruneisen parameter. 2/3 is the high temperature
+        value and 1 is the low temperature value. Defaults to 1.
+    metadata : dict
+        Metadata about this workflow. Defaults to an empty dictionary
+    el_cache_dir : str
+        Directory of an on-disk cache of the thermal electronic contributions. Supports env_chk.
+    el_cache_size : float
+        Maximum size of the thermal electronic cache in MB. Defaults to 1024.
+    """
+
+    required_params = ["tag", "db_file", "phonon", "num_volumes", "t_min", "t_max", "t_step"]
+
+    optional_params = ["min_volumes", "poisson", "bp2gru", "metadata", "el_cache_dir", "el_cache_size"]
+
+    def run_task(self, fw_spec):
+        db_file = env_chk(self.get("db_file"), fw_spec)
+        vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
+        ensure_indexes(vasp_db.db, tasks_collection=vasp_db.collection.name)
+        el_cache_dir = env_chk(self.get("el_cache_dir"), fw_spec)
+        el_kwargs = {}
+        if el_cache_dir:
+            el_kwargs['cache'] = ArrayCache(el_cache_dir, max_size=self.get("el_cache_size", 1024))
+
+        update_incremental_qha(vasp_db.db, self['tag'], self['num_volumes'], t_min=self['t_min'], t_step=self['t_step'],
+                               t_max=self['t_max'], phonon=self['phonon'], min_volumes=self.get('min_volumes', 5),
+                               poisson=self.get('poisson', 0.25), bp2gru=self.get('bp2gru', 1),
+                               metadata=self.get('metadata'), tasks_collection=vasp_db.collection.name,
+                               el_kwargs=el_kwargs)
+
+
 @explicit_serialize
 class EOSAnalysis(FiretaskBase):
     """
@@ -244,16 +412,15 @@ class EOSAnalysis(FiretaskBase):
         db_file = env_chk(self.get("db_file"), fw_spec)
         tag = self["tag"]
         vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
-        static_calculations = vasp_db.collection.find({"metadata.tag": tag})
+        ensure_indexes(vasp_db.db, tasks_collection=vasp_db.collection.name)
+        static_calculations = get_static_calculations(vasp_db.db, tag, collection=vasp_db.collection.name, dos=False)
+        self.store_eos_analysis(vasp_db, static_calculations)
 
-        energies = []
-        volumes = []
-        structure = None  # single Structure for QHA calculation
-        for calc in static_calculations:
-            energies.append(calc['output']['energy'])
-            volumes.append(calc['output']['structure']['lattice']['volume'])
-            if structure is None:
-                structure = Structure.from_dict(calc['output']['structure'])
+    def store_eos_analysis(self, vasp_db, static_calculations, additional_fields=None):
+        """Fit the EOS to the static calculations and insert the results into the eos collection"""
+        energies = static_calculations['energies']
+        volumes = static_calculations['volumes']
+        structure = Structure.from_dict(static_calculations['structure'])
 
         eos = EOS(self.get('eos'))
         ev_eos_fit = eos.fit(volumes, energies)
@@ -268,6 +435,7 @@ class EOSAnalysis(FiretaskBase):
         analysis_result['metadata'] = self.get('metadata', {})
         analysis_result['energies'] = energies
         analysis_result['volumes'] = volumes
+        analysis_result.update(additional_fields or {})
 
 
         # write to JSON for debugging purposes
@@ -276,3 +444,208 @@ class EOSAnalysis(FiretaskBase):
             json.dump(analysis_result, fp)
 
         vasp_db.db['eos'].insert_one(analysis_result)
+
+
+@explicit_serialize
+class GibbsFromEOS(FiretaskBase):
+    """
+    Add a Gibbs free energy workflow centred on the equilibrium volume of an EOS analysis
+
+    The structure of the most recent EOS document with the tag, which is scaled to the
+    equilibrium volume, is used as the input structure of ``get_wf_gibbs``.
+
+    Required params
+    ---------------
+    eos_tag : str
+        Tag (metadata.tag) of the EOS document, e.g. of a rough E-V curve.
+    db_file : str
+        Points to the database JSON file. If None (the default) is passed, the path will be looked up in the FWorker.
+
+    Optional params
+    ---------------
+    gibbs_kwargs : dict
+        Keyword arguments to pass to ``get_wf_gibbs``
+    """
+
+    required_params = ["eos_tag", "db_file"]
+    optional_params = ["gibbs_kwargs"]
+
+    def run_task(self, fw_spec):
+        # imported here, because the workflows module imports this one
+        from prlworkflows.prl_workflows import get_wf_gibbs
+
+        db_file = env_chk(self.get("db_file"), fw_spec)
+        vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
+        eos_doc = vasp_db.db['eos'].find_one({'metadata.tag': self['eos_tag']}, sort=[('_id', -1)])
+        if eos_doc is None:
+            raise ValueError('No EOS analysis with tag {}'.format(self['eos_tag']))
+        structure = Structure.from_dict(eos_doc['structure'])
+        wf = get_wf_gibbs(structure, **self.get('gibbs_kwargs', {}))
+        return FWAction(additions=wf)
+
+
+@explicit_serialize
+class AdaptiveEOSAnalysis(EOSAnalysis):
+    """
+    Add volumes to an E-V curve until the EOS fit is converged, then fit and store the EOS
+
+    After each batch of static calculations, the volumes to add are chosen by
+    ``prlworkflows.analysis.adaptive_eos.next_eos_volumes``: beyond the end of the curve if the
+    minimum is not bracketed, otherwise close to the minimum until the relative standard errors
+    of v0 and b0 are below their tolerances. The new static calculations and another
+    AdaptiveEOSAnalysis are added to the workflow. When the fit is converged or max_iterations
+    batches were added, the EOS is stored like EOSAnalysis, with the errors and whether it converged.
+
+    Required params
+    ---------------
+    eos : str
+        String name of the equation of state to use. See ``pymatgen.analysis.eos.EOS.MODELS`` for options.
+    tag : str
+        Tag to search the database for the volumetric calculations (energies, volumes) from this job.
+    db_file : str
+        Points to the database JSON file. If None (the default) is passed, the path will be looked up in the FWorker.
+
+    Optional params
+    ---------------
+    metadata : dict
+        Metadata about this workflow. Defaults to an empty dictionary
+    v0_tolerance : float
+        Target relative standard error of the equilibrium volume. Defaults to 1e-3.
+    b0_tolerance : float
+        Target relative standard error of the bulk modulus. Defaults to 1e-2.
+    num_new : int
+        Number of volumes to add per batch. Defaults to 2.
+    max_iterations : int
+        Maximum number of batches to add. Defaults to 5.
+    iteration : int
+        Number of batches added so far. Defaults to 0.
+    vasp_cmd : str
+        Command to run VASP for the new static calculations. Defaults to VASP_CMD.
+    vasp_input_set : pymatgen.io.vasp.sets.VaspInputSet
+        Input set of the existing static calculations. The new static calculations use the same
+        class and settings, so that all the energies in the fit are consistent. Defaults to
+        PRLStaticSet.
+    """
+
+    required_params = ["eos", "db_file", "tag"]
+    optional_params = ["metadata", "v0_tolerance", "b0_tolerance", "num_new", "max_iterations", "iteration",
+                       "vasp_cmd", "vasp_input_set"]
+
+    def run_task(self, fw_spec):
+        # imported here, because the Fireworks module imports this one
+        from atomate.vasp.config import VASP_CMD
+        from fireworks import Firework, Workflow
+        from prlworkflows.input_sets import PRLStaticSet, input_set_for_structure
+        from prlworkflows.prl_fireworks import PRLStaticFW
+
+        db_file = env_chk(self.get("db_file"), fw_spec)
+        tag = self["tag"]
+        vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
+        ensure_indexes(vasp_db.db, tasks_collection=vasp_db.collection.name)
+        static_calculations = get_static_calculations(vasp_db.db, tag, collection=vasp_db.collection.name, dos=False)
+
+        iteration = self.get('iteration', 0)
+        new_volumes, status = next_eos_volumes(static_calculations['volumes'], static_calculations['energies'],
+                                               eos=self['eos'], v0_tolerance=self.get('v0_tolerance', 1e-3),
+                                               b0_tolerance=self.get('b0_tolerance', 1e-2),
+                                               num_new=self.get('num_new', 2))
+        if not new_volumes or iteration >= self.get('max_iterations', 5):
+            status['converged'] = not new_volumes
+            status['iterations'] = iteration
+            self.store_eos_analysis(vasp_db, static_calculations, additional_fields=status)
+            return
+
+        metadata = self.get('metadata', {})
+        vasp_cmd = self.get('vasp_cmd') or VASP_CMD
+        fws = []
+        for volume in new_volumes:
+            struct = Structure.from_dict(static_calculations['structure'])
+            struct.scale_lattice(volume)
+            if self.get('vasp_input_set') is not None:
+                vis = input_set_for_structure(self['vasp_input_set'], struct)
+            else:
+                vis = PRLStaticSet(struct)
+            fws.append(PRLStaticFW(struct, name='structure_{:.3f}-static'.format(volume),
+                                   vasp_input_set=vis, vasp_cmd=vasp_cmd, db_file=db_file,
+                                   metadata=metadata, prev_calc_loc=False))
+        params = dict(self)
+        params['iteration'] = iteration + 1
+        fws.append(Firework(AdaptiveEOSAnalysis(**params), parents=fws[:],
+                            name="{}-eos_analysis-{}".format(struct.composition.reduced_formula, iteration + 1)))
+        return FWAction(additions=Workflow(fws, metadata=metadata))
+
+
+@explicit_serialize
+class ReuseRegisteredCalculation(FiretaskBase):
+    """
+    Reuse a completed task with the same structure and VASP inputs instead of running VASP
+
+    Must run after the VASP inputs are written in the current directory. If a completed task
+    with the same fingerprint (see ``prlworkflows.registry``) exists, a copy of it with this
+    Firework's task_label and metadata is inserted and the rest of the Firework is skipped.
+    Otherwise the fingerprint of the inputs is saved for ``RegisterCalculation``.
+    Since no VASP outputs are written, this must not be used for Fireworks whose children copy
+    their outputs (e.g. a phonon calculation with prev_calc_loc).
+
+    Required params
+    ---------------
+    db_file : str
+        Points to the database JSON file. If None (the default) is passed, the path will be looked up in the FWorker.
+    task_label : str
+        Task label of the reused task
+    metadata : dict
+        Metadata of the reused task
+
+    Optional params
+    ---------------
+    tolerance : float
+        Tolerance of the lattice vectors (in Angstrom) and fractional coordinates of a matching
+        structure. Defaults to 1e-3.
+    """
+
+    required_params = ["db_file", "task_label", "metadata"]
+    optional_params = ["tolerance"]
+
+    def run_task(self, fw_spec):
+        db_file = env_chk(self.get("db_file"), fw_spec)
+        vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
+        ensure_indexes(vasp_db.db, tasks_collection=vasp_db.collection.name)
+        fingerprint, structure = fingerprint_from_directory('.')
+        # RegisterCalculation registers it after VASP ran and custodian may have changed the inputs
+        write_fingerprint(fingerprint, structure, '.')
+        task_doc = find_registered_task(vasp_db.collection, fingerprint, structure, tolerance=self.get('tolerance', 1e-3))
+        if task_doc is None:
+            return None
+        task_id = reuse_task(vasp_db.db, task_doc, additional_fields={'task_label': self['task_label'],
+                                                                     'metadata': self['metadata']},
+                             collection=vasp_db.collection.name)
+        return FWAction(stored_data={'task_id': task_id, 'reused_task_id': task_doc['task_id']}, exit=True)
+
+
+@explicit_serialize
+class RegisterCalculation(FiretaskBase):
+    """
+    Register the fingerprint of the task inserted by this Firework so other workflows can reuse it
+
+    Must run after VaspToDb, in the directory of the calculation. The fingerprint saved by
+    ``ReuseRegisteredCalculation`` before VASP ran is registered, because custodian may have
+    corrected the inputs since.
+
+    Required params
+    ---------------
+    db_file : str
+        Points to the database JSON file. If None (the default) is passed, the path will be looked up in the FWorker.
+    task_label : str
+        Task label of the inserted task
+    tag : str
+        Tag (metadata.tag) of the inserted task
+    """
+
+    required_params = ["db_file", "task_label", "tag"]
+
+    def run_task(self, fw_spec):
+        db_file = env_chk(self.get("db_file"), fw_spec)
+        vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
+        fingerprint, structure = read_fingerprint('.')
+        register_task(vasp_db.collection, fingerprint, structure,
+                      {'task_label': self['task_label'], 'metadata.tag': self['tag']})
@@ -8,7 +8,8 @@ from atomate.common.firetasks.glue_tasks import PassCalcLocs
 from atomate.vasp.firetasks.glue_tasks import CopyVaspOutputs
 from atomate.vasp.firetasks.run_calc import RunVaspCustodian
 from prlworkflows.input_sets import PRLRelaxSet, PRLStaticSet, PRLForceConstantsSet
-from prlworkflows.prl_firetasks import WriteVaspFromIOSetPrevStructure, SupercellTransformation, CalculatePhononThermalProperties
+from prlworkflows.prl_firetasks import WriteVaspFromIOSetPrevStructure, SupercellTransformation, CalculatePhononThermalProperties, \
+    ReuseRegisteredCalculation, RegisterCalculation
 
 
 class PRLOptimizeFW(Firework):
@@ -82,11 +83,16 @@ class PRLStaticFW(Firework):
         Path to file specifying db credentials.
     parents : Firework
         Parents of this particular Firework. FW or list of FWS.
+    reuse_calculations : bool
+        If True, a completed task with the same structure and VASP inputs is reused instead of
+        running VASP, and the task of this Firework is registered for reuse by others. Reused
+        calculations write no outputs, so this must be False if children copy the outputs.
+        Defaults to False.
     \*\*kwargs : dict
         Other kwargs that are passed to Firework.__init__.
     """
     def __init__(self, structure, name="static", vasp_input_set=None, vasp_cmd="vasp", metadata=None,
-                 prev_calc_loc=True, db_file=None, parents=None, **kwargs):
+                 prev_calc_loc=True, db_file=None, parents=None, reuse_calculations=False, **kwargs):
 
         # TODO: @computron - I really don't like how you need to set the structure even for
         # prev_calc_loc jobs. Sometimes it makes appending new FWs to an existing workflow
@@ -103,9 +109,13 @@ class PRLStaticFW(Firework):
         else:
             t.append(WriteVaspFromIOSet(structure=structure, vasp_input_set=vasp_input_set))
 
+        if reuse_calculations:
+            t.append(ReuseRegisteredCalculation(db_file=db_file, task_label=name, metadata=metadata))
         t.append(RunVaspCustodian(vasp_cmd=vasp_cmd, auto_npar=">>auto_npar<<", gzip_output=False))
         t.append(PassCalcLocs(name=name))
         t.append(VaspToDb(db_file=db_file, parse_dos=True, additional_fields={"task_label": name, "metadata": metadata},))
+        if reuse_calculations:
+            t.append(RegisterCalculation(db_file=db_file, task_label=name, tag=metadata.get('tag')))
         super(PRLStaticFW, self).__init__(t, parents=parents, name="{}-{}".format(
             structure.composition.reduced_formula, name), **kwargs)
 
@@ -136,13 +146,16 @@ class PRLPhononFW(Firework):
         Path to file specifying db credentials.
     parents : Firework
         Parents of this particular Firework. FW or list of FWS.
+    qpoint_mesh_tolerance : float
+        Converge the q-point mesh until F_vib changes by less than this tolerance in eV/atom.
+        If None (the default), a fixed 50x50x50 mesh is used.
     \*\*kwargs : dict
         Other kwargs that are passed to Firework.__init__.
     """
     def __init__(self, structure, supercell_matrix, t_min=5, t_max=2000, t_step=5,
                  name="phonon", vasp_input_set=None,
                  vasp_cmd="vasp", metadata=None, tag=None,
-                 prev_calc_loc=True, db_file=None, parents=None,
+                 prev_calc_loc=True, db_file=None, parents=None, qpoint_mesh_tolerance=None,
                  **kwargs):
 
         metadata = metadata or {}
@@ -171,7 +184,8 @@ class PRLPhononFW(Firework):
         t.append(WriteVaspFromIOSetPrevStructure(vasp_input_set=vasp_input_set))
         t.append(RunVaspCustodian(vasp_cmd=vasp_cmd, auto_npar=">>auto_npar<<", gzip_output=False))
         t.append(PassCalcLocs(name=name))
-        t.append(CalculatePhononThermalProperties(supercell_matrix=supercell_matrix, t_min=t_min, t_max=t_max, t_step=t_step, db_file=db_file, tag=tag, metadata=metadata))
+        t.append(CalculatePhononThermalProperties(supercell_matrix=supercell_matrix, t_min=t_min, t_max=t_max, t_step=t_step, db_file=db_file, tag=tag, metadata=metadata,
+                                                   qpoint_mesh_tolerance=qpoint_mesh_tolerance))
 
         super(PRLPhononFW, self).__init__(t, parents=parents, name="{}-{}".format(
             structure.composition.reduced_formula, name), **kwargs)
@@ -7,12 +7,13 @@ from uuid import uuid4
 from fireworks import Workflow, Firework
 from atomate.vasp.config import VASP_CMD, DB_FILE
 
-from prlworkflows.prl_firetasks import QHAAnalysis, EOSAnalysis
+from prlworkflows.prl_firetasks import QHAAnalysis, EOSAnalysis, IncrementalQHAAnalysis, AdaptiveEOSAnalysis, GibbsFromEOS
 from prlworkflows.prl_fireworks import PRLOptimizeFW, PRLStaticFW, PRLPhononFW
 from prlworkflows.input_sets import PRLRelaxSet, PRLStaticSet, PRLForceConstantsSet, PRLRoughStaticSet
 
 
-def get_wf_ev_curve(structure, num_deformations=7, deformation_fraction=0.1, vasp_cmd=None, db_file=None, vasp_input_set=None, metadata=None, name='EV_Curve', eos="birch_murnaghan"):
+def get_wf_ev_curve(structure, num_deformations=7, deformation_fraction=0.1, vasp_cmd=None, db_file=None, vasp_input_set=None, metadata=None, name='EV_Curve', eos="birch_murnaghan",
+                    adaptive=False, v0_tolerance=1e-3, b0_tolerance=1e-2, max_iterations=5, reuse_calculations=False):
     """
     Rough E - V curve workflow that can determine approximate minimum volumes
 
@@ -32,6 +33,20 @@ def get_wf_ev_curve(structure, num_deformations=7, deformation_fraction=0.1, vas
         Metadata to include
     eos : str
         String of the equation of state to use, see ``pymatgen.analysis.eos.EOS.MODELS`` for options.
+    adaptive : bool
+        If True, the deformations are only a seed set. Volumes are added after each batch until
+        the minimum is bracketed and the EOS parameters are converged, see ``AdaptiveEOSAnalysis``.
+        A small seed, e.g. 4 deformations, is enough. Added volumes use the class and settings of
+        vasp_input_set, or PRLStaticSet if it is None. Defaults to False.
+    v0_tolerance : float
+        Target relative standard error of the equilibrium volume for adaptive sampling. Defaults to 1e-3.
+    b0_tolerance : float
+        Target relative standard error of the bulk modulus for adaptive sampling. Defaults to 1e-2.
+    max_iterations : int
+        Maximum number of batches of volumes added by adaptive sampling. Defaults to 5.
+    reuse_calculations : bool
+        If True, completed static calculations of other workflows with the same structure and
+        VASP inputs are reused instead of running VASP, see ``prlworkflows.registry``. Defaults to False.
     """
     vasp_cmd = vasp_cmd or VASP_CMD
     db_file = db_file or DB_FILE
@@ -48,10 +63,17 @@ def get_wf_ev_curve(structure, num_deformations=7, deformation_fraction=0.1, vas
         struct = structure.copy()
         struct.scale_lattice(struct.volume*deformation)
         vis = vasp_input_set or PRLStaticSet(struct)
-        static = PRLStaticFW(structure, name='structure_{}-static'.format(i), vasp_input_set=vis, vasp_cmd=vasp_cmd, db_file=db_file, metadata=metadata)
+        static = PRLStaticFW(structure, name='structure_{}-static'.format(i), vasp_input_set=vis, vasp_cmd=vasp_cmd, db_file=db_file, metadata=metadata,
+                             reuse_calculations=reuse_calculations)
         fws.append(static)
 
-    eos_fw = Firework(EOSAnalysis(eos=eos, db_file=db_file, tag=tag), parents=fws[:], name="{}-eos_analysis".format(structure.composition.reduced_formula))
+    if adaptive:
+        eos_task = AdaptiveEOSAnalysis(eos=eos, db_file=db_file, tag=tag, metadata=metadata, vasp_cmd=vasp_cmd,
+                                       v0_tolerance=v0_tolerance, b0_tolerance=b0_tolerance, max_iterations=max_iterations,
+                                       vasp_input_set=vasp_input_set)
+    else:
+        eos_task = EOSAnalysis(eos=eos, db_file=db_file, tag=tag)
+    eos_fw = Firework(eos_task, parents=fws[:], name="{}-eos_analysis".format(structure.composition.reduced_formula))
     fws.append(eos_fw)
 
     wfname = "{}:{}".format(tag, name)
@@ -60,9 +82,10 @@ def get_wf_ev_curve(structure, num_deformations=7, deformation_fraction=0.1, vas
 
 
 def get_wf_gibbs(structure, num_deformations=7, deformation_fraction=(-0.05, 0.1),
-                 phonon=False, phonon_supercell_matrix=None,
-                 t_min=5, t_max=2000, t_step=5,
-                 vasp_cmd=None, db_file=None, metadata=None, name='EV_QHA'):
+                 phonon=False, phonon_supercell_matrix=None, num_phonon_volumes=None, vib_models=None,
+                 t_min=5, t_max=2000, t_step=5, incremental=False, min_volumes=5,
+                 rough_volume_search=False, num_rough_deformations=7, rough_deformation_fraction=0.1,
+                 reuse_calculations=False, vasp_cmd=None, db_file=None, metadata=None, name='EV_QHA'):
     """
     E - V
     curve
@@ -80,12 +103,41 @@ def get_wf_gibbs(structure, num_deformations=7, deformation_fraction=(-0.05, 0.1
         Whether to do a phonon calculation. Defaults to False, meaning the Debye model.
     phonon_supercell_matrix : list
         3x3 array of the supercell matrix, e.g. [[2,0,0],[0,2,0],[0,0,2]]. Must be specified if phonon is specified.
+    num_phonon_volumes : int
+        Number of volumes to calculate phonons at, evenly spread over the deformations and always
+        including the smallest and largest volume, e.g. 3 for the two extremes and the center.
+        F_vib at the other volumes is interpolated from the force constants in the QHA analysis.
+        If None (the default), phonons are calculated at every volume.
+    vib_models : list
+        Vibrational models to evaluate in the QHA analysis, any of 'phonon' and 'debye'. If None
+        (the default), the phonon model (if phonon is True) and the Debye model are evaluated.
     t_min : float
         Minimum temperature
     t_step : float
         Temperature step size
     t_max : float
         Maximum temperature (inclusive)
+    incremental : bool
+        If True, every static (Debye) or phonon Firework updates the QHA with its volume as soon
+        as it finishes, instead of one QHA analysis after all the volumes. A provisional result
+        is published once min_volumes volumes are done. Only the phonon model is evaluated for
+        phonon workflows and the phonon volumes are not interpolated. Defaults to False.
+    min_volumes : int
+        Number of volumes needed for the first provisional result of an incremental QHA. Defaults to 5.
+    rough_volume_search : bool
+        If True, the equilibrium volume is first found from an E-V curve of cheap PRLRoughStaticSet
+        static calculations (tagged '<tag>-rough'). The relaxations, statics and phonons are then
+        added to the workflow with the deformations centred on that volume instead of the volume
+        of the input structure. Defaults to False.
+    num_rough_deformations : int
+        Number of volumes of the rough E-V curve. Defaults to 7.
+    rough_deformation_fraction : float
+        Plus/minus fraction of the volume spanned by the rough E-V curve. Defaults to 0.1.
+    reuse_calculations : bool
+        If True, completed static calculations of other workflows with the same structure and
+        VASP inputs are reused instead of running VASP, see ``prlworkflows.registry``. A reused
+        static writes no outputs and skips the rest of its Firework, so statics followed by a
+        phonon calculation or an incremental QHA update always run. Defaults to False.
     vasp_cmd : str
         Command to run VASP. If None (the default) is passed, the command will be looked up in the FWorker.
     db_file : str
@@ -103,11 +155,40 @@ def get_wf_gibbs(structure, num_deformations=7, deformation_fraction=(-0.05, 0.1
     if 'tag' not in metadata.keys():
         metadata['tag'] = tag
 
+    if rough_volume_search:
+        rough_tag = '{}-rough'.format(tag)
+        rough_metadata = dict(metadata, tag=rough_tag)
+        fws = []
+        for i, deformation in enumerate(np.linspace(1-rough_deformation_fraction, 1+rough_deformation_fraction, num_rough_deformations)):
+            struct = structure.copy()
+            struct.scale_lattice(struct.volume*deformation)
+            fws.append(PRLStaticFW(struct, name='structure_{}-rough_static'.format(i), vasp_input_set=PRLRoughStaticSet(struct),
+                                   vasp_cmd=vasp_cmd, db_file=db_file, metadata=rough_metadata,
+                                   reuse_calculations=reuse_calculations))
+        eos_fw = Firework(EOSAnalysis(eos='vinet', db_file=db_file, tag=rough_tag, metadata=rough_metadata), parents=fws[:],
+                          name="{}-rough_eos_analysis".format(structure.composition.reduced_formula))
+        fws.append(eos_fw)
+        gibbs_kwargs = dict(num_deformations=num_deformations, deformation_fraction=deformation_fraction, phonon=phonon,
+                            phonon_supercell_matrix=phonon_supercell_matrix, num_phonon_volumes=num_phonon_volumes,
+                            vib_models=vib_models, t_min=t_min, t_max=t_max, t_step=t_step, incremental=incremental,
+                            min_volumes=min_volumes, reuse_calculations=reuse_calculations, vasp_cmd=vasp_cmd, db_file=db_file, metadata=metadata, name=name)
+        gibbs_fw = Firework(GibbsFromEOS(eos_tag=rough_tag, db_file=db_file, gibbs_kwargs=gibbs_kwargs), parents=eos_fw,
+                            name="{}-gibbs_from_rough_eos".format(structure.composition.reduced_formula))
+        fws.append(gibbs_fw)
+        return Workflow(fws, name="{}:{}".format(structure.composition.reduced_formula, name), metadata=metadata)
+
     if isinstance(deformation_fraction, (list, tuple)):
         deformations = np.linspace(1+deformation_fraction[0], 1+deformation_fraction[1], num_deformations)
     else:
         deformations = np.linspace(1-deformation_fraction, 1+deformation_fraction, num_deformations)
 
+    if phonon and num_phonon_volumes is not None:
+        if num_phonon_volumes < 2:
+            raise ValueError('At least 2 phonon volumes are needed to interpolate the force constants.')
+        phonon_indices = set(np.round(np.linspace(0, num_deformations-1, min(num_phonon_volumes, num_deformations))).astype(int))
+    else:
+        phonon_indices = set(range(num_deformations))
+
     # follow a scheme of
     # 1. ISIF 2
     # 2. ISIF 4
@@ -128,10 +209,14 @@ def get_wf_gibbs(structure, num_deformations=7, deformation_fraction=(-0.05, 0.1
         fws.append(isif_4_fw)
 
         vis = PRLStaticSet(struct)
-        static = PRLStaticFW(structure, name='structure_{}-static'.format(i), vasp_input_set=vis, vasp_cmd=vasp_cmd, db_file=db_file, metadata=metadata, parents=isif_4_fw)
+        # phonon calculations copy the outputs of the static and incremental QHA updates run in the
+        # static Firework, neither of which happen for a reused static
+        reuse_static = reuse_calculations and not (phonon and i in phonon_indices) and not (incremental and not phonon)
+        static = PRLStaticFW(structure, name='structure_{}-static'.format(i), vasp_input_set=vis, vasp_cmd=vasp_cmd, db_file=db_file, metadata=metadata, parents=isif_4_fw,
+                             reuse_calculations=reuse_static)
         fws.append(static)
 
-        if phonon:
+        if phonon and i in phonon_indices:
             vis = PRLForceConstantsSet(struct)
             phonon_fw = PRLPhononFW(structure, phonon_supercell_matrix, t_min=t_min, t_max=t_max, t_step=t_step,
                      name='structure_{}-phonon'.format(i), vasp_input_set=vis,
@@ -142,8 +227,16 @@ def get_wf_gibbs(structure, num_deformations=7, deformation_fraction=(-0.05, 0.1
         else:
             qha_calcs.append(static)
 
-    qha_fw = Firework(QHAAnalysis(phonon=phonon, t_min=t_min, t_max=t_max, t_step=t_step, db_file=db_file, tag=tag), parents=qha_calcs, name="{}-qha_analysis".format(structure.composition.reduced_formula))
-    fws.append(qha_fw)
+    if incremental:
+        # with phonons, only the volumes with phonon calculations are used
+        volume_fws = [qha_calcs[i] for i in sorted(phonon_indices)] if phonon else qha_calcs
+        for fw in volume_fws:
+            fw.tasks.append(IncrementalQHAAnalysis(phonon=phonon, num_volumes=len(volume_fws), min_volumes=min_volumes,
+                                                   t_min=t_min, t_max=t_max, t_step=t_step, db_file=db_file, tag=tag,
+                                                   metadata=metadata))
+    else:
+        qha_fw = Firework(QHAAnalysis(phonon=phonon, t_min=t_min, t_max=t_max, t_step=t_step, db_file=db_file, tag=tag, vib_models=vib_models), parents=qha_calcs, name="{}-qha_analysis".format(structure.composition.reduced_formula))
+        fws.append(qha_fw)
 
     wfname = "{}:{}".format(structure.composition.reduced_formula, name)
 
@@ -0,0 +1,235 @@
+"""
+Registry of completed calculations by a fingerprint of their composition and VASP inputs
+
+Calculations with the same composition, INCAR, KPOINTS and POTCARs have the same fingerprint.
+If their lattices and positions also agree within a tolerance, they give the same results, so
+a completed task can be reused by other workflows instead of running VASP again.
+"""
+
+from __future__ import division
+
+import copy
+import hashlib
+import json
+import os
+
+import numpy as np
+from pymongo import ReturnDocument
+
+# file of the fingerprint and structure of the inputs, written before VASP runs
+FINGERPRINT_FILE = 'fingerprint.json'
+
+# INCAR tags that only control parallelization, restarting or which files are written
+IGNORED_INCAR_TAGS = {'SYSTEM', 'NPAR', 'NCORE', 'KPAR', 'NSIM', 'LPLANE', 'ISTART', 'LWAVE', 'LCHARG',
+                      'LVTOT', 'LVHAR', 'LAECHG', 'LELF'}
+
+
+def calculation_fingerprint(species, incar, kpoints=None, potcar=None):
+    """
+    Hash of the composition and the VASP input settings of a calculation
+
+    Calculations with the same fingerprint are candidates for reuse. The positions are not part
+    of the hash, because positions rounded to a tolerance hash differently on either side of a
+    rounding boundary. Candidates are confirmed with ``structures_match`` instead.
+
+    Parameters
+    ----------
+    species : list
+        Species of each site, as strings. The order does not matter.
+    incar : dict
+        INCAR settings. Tags in ``IGNORED_INCAR_TAGS`` do not change the fingerprint.
+    kpoints : dict
+        Dictionary of the KPOINTS, e.g. ``Kpoints.as_dict()``. The comment is ignored.
+    potcar : list
+        POTCAR symbols or titles of each species
+
+    Returns
+    -------
+    str
+        Hex digest of the SHA-256 hash
+    """
+    kpoints = {key: value for key, value in (kpoints or {}).items() if key not in ('comment', '@module', '@class')}
+    data = {
+        'species': sorted(str(s) for s in species),
+        'incar': {key: value for key, value in incar.items() if key not in IGNORED_INCAR_TAGS},
+        'kpoints': kpoints,
+        'potcar': list(potcar or []),
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def structures_match(structure, other, tolerance=1e-3):
+    """
+    Whether two structures have the same lattice and sites within a tolerance
+
+    The structures are dictionaries of the 'lattice' (3x3 matrix), 'species' and 'frac_coords',
+    as returned by ``fingerprint_from_directory``. The sites can be in any order and periodic
+    images are the same site.
+
+    Parameters
+    ----------
+    structure : dict
+        First structure
+    other : dict
+        Second structure
+    tolerance : float
+        Absolute tolerance of the lattice vectors in Angstrom and of the fractional coordinates.
+        Defaults to 1e-3.
+
+    Returns
+    -------
+    bool
+    """
+    species = np.asarray(structure['species'])
+    other_species = np.asarray(other['species'])
+    if species.shape != other_species.shape:
+        return False
+    if not np.allclose(structure['lattice'], other['lattice'], rtol=0, atol=tolerance):
+        return False
+    frac_coords = np.asarray(structure['frac_coords'], dtype=float)
+    other_frac_coords = np.asarray(other['frac_coords'], dtype=float)
+    diff = frac_coords[:, None, :] - other_frac_coords[None, :, :]
+    diff -= np.round(diff)
+    close = np.all(np.abs(diff) <= tolerance, axis=2) & (species[:, None] == other_species[None, :])
+    # every site has a match in the other structure and vice versa
+    return bool(np.all(np.any(close, axis=1)) and np.all(np.any(close, axis=0)))
+
+
+def fingerprint_from_directory(directory='.'):
+    """
+    Fingerprint and structure of the VASP inputs (POSCAR, INCAR, KPOINTS, POTCAR) in a directory
+
+    See ``calculation_fingerprint``. A missing KPOINTS file, e.g. with KSPACING, is allowed.
+
+    Returns
+    -------
+    tuple
+        Tuple of (fingerprint, structure). The structure is a dictionary of the 'lattice',
+        'species' and 'frac_coords', see ``structures_match``.
+    """
+    from pymatgen import Structure
+    from pymatgen.io.vasp.inputs import Incar, Kpoints, Potcar
+
+    structure = Structure.from_file(os.path.join(directory, 'POSCAR'))
+    incar = Incar.from_file(os.path.join(directory, 'INCAR'))
+    kpoints_path = os.path.join(directory, 'KPOINTS')
+    kpoints = Kpoints.from_file(kpoints_path).as_dict() if os.path.exists(kpoints_path) else None
+    potcar = Potcar.from_file(os.path.join(directory, 'POTCAR'))
+    species = [str(site.specie) for site in structure]
+    fingerprint = calculation_fingerprint(species, dict(incar), kpoints=kpoints,
+                                          potcar=[p.keywords['TITEL'] for p in potcar])
+    return fingerprint, {'lattice': structure.lattice.matrix.tolist(), 'species': species,
+                         'frac_coords': structure.frac_coords.tolist()}
+
+
+def write_fingerprint(fingerprint, structure, directory='.'):
+    """
+    Save the fingerprint and structure of the inputs in a directory, see ``read_fingerprint``
+
+    Custodian can correct the INCAR in place while VASP runs (e.g. ALGO or POTIM), which
+    changes the fingerprint of the directory. The fingerprint of the original inputs is the
+    one that an identical new calculation computes before it runs, so it is saved before VASP
+    runs and registered from this file afterwards.
+    """
+    with open(os.path.join(directory, FINGERPRINT_FILE), 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'structure': structure}, f)
+
+
+def read_fingerprint(directory='.'):
+    """
+    Fingerprint and structure saved by ``write_fingerprint`` in a directory
+
+    Returns
+    -------
+    tuple
+        Tuple of (fingerprint, structure)
+    """
+    with open(os.path.join(directory, FINGERPRINT_FILE)) as f:
+        data = json.load(f)
+    return data['fingerprint'], data['structure']
+
+
+def _volume_window(lattice, tolerance):
+    """
+    Bound on the volume change of a lattice when every component of its vectors changes by at
+    most the tolerance, so that structures matching within the tolerance are never excluded
+    """
+    shift = np.sqrt(3)*tolerance
+    # lengths of the vectors of either lattice are at most the lengths of this one plus the shift
+    a, b, c = np.linalg.norm(lattice, axis=1) + shift
+    return shift*(a*b + b*c + a*c) + shift**2*(a + b + c) + shift**3
+
+
+def find_registered_task(collection, fingerprint, structure, tolerance=1e-3):
+    """
+    Most recent completed task with the fingerprint and a matching structure, or None
+
+    The candidates are the tasks with the fingerprint whose volume could match within the
+    tolerance. Only their structures are read to compare them and the full task document is
+    only fetched for the match.
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+        Task collection
+    fingerprint : str
+        Fingerprint of the composition and inputs, see ``calculation_fingerprint``
+    structure : dict
+        Structure of the calculation, see ``structures_match``
+    tolerance : float
+        Tolerance of ``structures_match``. Defaults to 1e-3.
+
+    Returns
+    -------
+    dict
+        Task document, or None if no registered task matches
+    """
+    volume = abs(np.linalg.det(structure['lattice']))
+    window = _volume_window(structure['lattice'], tolerance)
+    query = {'fingerprint': fingerprint, 'state': 'successful',
+             'fingerprint_volume': {'$gte': volume - window, '$lte': volume + window}}
+    for candidate in collection.find(query, {'fingerprint_structure': 1}, sort=[('_id', -1)]):
+        registered = candidate.get('fingerprint_structure')
+        if registered is not None and structures_match(structure, registered, tolerance=tolerance):
+            return collection.find_one({'_id': candidate['_id']})
+    return None
+
+
+def register_task(collection, fingerprint, structure, query):
+    """
+    Set the fingerprint, structure and volume of the most recent task matching the query
+
+    Returns
+    -------
+    int
+        task_id of the registered task, or None if no task matches
+    """
+    volume = abs(np.linalg.det(structure['lattice']))
+    task = collection.find_one_and_update(query, {'$set': {'fingerprint': fingerprint,
+                                                           'fingerprint_structure': structure,
+                                                           'fingerprint_volume': volume}},
+                                          sort=[('_id', -1)], projection={'task_id': 1})
+    return task['task_id'] if task is not None else None
+
+
+def reuse_task(db, task_doc, additional_fields=None, collection='tasks'):
+    """
+    Insert a copy of a task document as a new task, e.g. with the metadata of another workflow
+
+    The copy gets a new task_id from the atomate task counter and 'reused_task_id' refers to
+    the original task. Large outputs in GridFS (e.g. the DOS) are shared with the original.
+
+    Returns
+    -------
+    int
+        task_id of the new task
+    """
+    new_doc = copy.deepcopy(task_doc)
+    new_doc.pop('_id', None)
+    new_doc['reused_task_id'] = task_doc.get('task_id')
+    new_doc.update(additional_fields or {})
+    counter = db['counter'].find_one_and_update({'_id': 'taskid'}, {'$inc': {'c': 1}}, upsert=True,
+                                                return_document=ReturnDocument.AFTER)
+    new_doc['task_id'] = counter['c']
+    db[collection].insert_one(new_doc)
+    return new_doc['task_id']
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+from prlworkflows.batch import get_structures, submit_gibbs_workflows
+from prlworkflows.utils import get_launchpad
+
+################################################################################
+#                                CONFIGURATION                                 #
+################################################################################
+
+# Structure sources. All the configured sources are combined.
+structure_directory = None  # directory to recursively search for structure files, e.g. 'sqs'
+structure_pattern = '*POSCAR*'  # filename pattern of the structure files
+db_file = None  # path to a database JSON file to query structures from
+structure_collection = 'tasks'  # collection to query structures from
+structure_query = None  # query of the documents, e.g. {'metadata.tag': 'my-tag'}
+structure_field = 'output.structure'  # field of the structure in the documents
+
+# Optional configuration
+launchpad_file_path = None  # absolute path to LaunchPad. If None, will load from FW_CONFIG_FILE variable
+processes = None  # number of processes to build workflows with. If None, all CPUs are used
+batch_size = 100  # number of workflows per bulk insert
+metadata = None  # metadata of every workflow. A tag is suffixed by the index of the structure
+
+# workflow settings, passed to get_wf_gibbs
+wf_settings = {
+    'num_deformations': 7,
+    'phonon': False,
+    't_max': 2000,
+}
+
+
+################################################################################
+#                                     RUN                                      #
+################################################################################
+
+def main():
+    collection = None
+    if db_file is not None:
+        from atomate.vasp.database import VaspCalcDb
+        collection = VaspCalcDb.from_db_file(db_file, admin=True).db[structure_collection]
+    structures = get_structures(directory=structure_directory, pattern=structure_pattern, collection=collection,
+                                query=structure_query, structure_field=structure_field)
+    if not structures:
+        raise ValueError('No structures found. Set structure_directory or db_file.')
+    launchpad = get_launchpad(launchpad_file=launchpad_file_path)
+    report = submit_gibbs_workflows(launchpad, structures, processes=processes, batch_size=batch_size,
+                                    metadata=metadata, **wf_settings)
+    print('Added {num_workflows} workflows in {time:.1f} s ({workflows_per_second:.1f} workflows/s)'.format(**report))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+from atomate.vasp.database import VaspCalcDb
+from prlworkflows.analysis.phonon import recalculate_phonon_thermal_properties
+
+################################################################################
+#                                CONFIGURATION                                 #
+################################################################################
+
+# Required configuration
+db_file = 'db.json'  # path to the database JSON file
+tag = None  # tag (metadata.tag) of the phonon calculations to recalculate
+
+# thermal property settings
+t_min = 5  # minimum temperature
+t_step = 5  # temperature step size
+t_max = 2000  # maximum temperature (inclusive)
+qpoint_mesh = (50, 50, 50)  # fixed q-point mesh, ignored if qpoint_mesh_tolerance is set
+qpoint_mesh_tolerance = None  # converge the q-point mesh until F_vib changes by less than this, in eV/atom
+
+# Optional configuration
+processes = None  # number of processes. If None, all CPUs are used
+
+
+################################################################################
+#                                     RUN                                      #
+################################################################################
+
+def main():
+    if tag is None:
+        raise ValueError('Set the tag of the phonon calculations to recalculate.')
+    vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
+    n_updated = recalculate_phonon_thermal_properties(vasp_db.db, tag, t_min=t_min, t_step=t_step, t_max=t_max,
+                                                      qpoint_mesh=qpoint_mesh,
+                                                      qpoint_mesh_tolerance=qpoint_mesh_tolerance,
+                                                      processes=processes)
+    print('Updated {} phonon documents with tag {}'.format(n_updated, tag))
+
+if __name__ == '__main__':
+    main()
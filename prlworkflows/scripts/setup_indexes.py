@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+from atomate.vasp.database import VaspCalcDb
+from prlworkflows.database import ensure_indexes, missing_indexes, explain_queries
+
+################################################################################
+#                                CONFIGURATION                                 #
+################################################################################
+
+# Required configuration
+db_file = 'db.json'  # path to the database JSON file
+
+# Optional configuration
+create_indexes = True  # set to False to only check the indexes and the query plans
+tag = None  # tag to explain the queries with. If None, a placeholder tag is used
+
+
+################################################################################
+#                                     RUN                                      #
+################################################################################
+
+def main():
+    vasp_db = VaspCalcDb.from_db_file(db_file, admin=True)
+    tasks_collection = vasp_db.collection.name
+    if create_indexes:
+        for collection, index_names in sorted(ensure_indexes(vasp_db.db, tasks_collection=tasks_collection).items()):
+            print('{}: {}'.format(collection, ', '.join(index_names)))
+    missing = missing_indexes(vasp_db.db, tasks_collection=tasks_collection)
+    for collection, keys_list in sorted(missing.items()):
+        print('Missing index on {}: {}'.format(collection, ', '.join(str(keys) for keys in keys_list)))
+    if not missing:
+        print('All indexes exist')
+    print('Query plans:')
+    for collection, stages in sorted(explain_queries(vasp_db.db, tag=tag, tasks_collection=tasks_collection).items()):
+        warning = ' (collection scan!)' if 'COLLSCAN' in stages else ''
+        print('  {}: {}{}'.format(collection, ' <- '.join(stages), warning))
+
+if __name__ == '__main__':
+    main()
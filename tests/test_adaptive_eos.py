@@ -0,0 +1,64 @@
+"""
+Tests for the adaptive sampling of E-V curves
+"""
+
+import numpy as np
+from pymatgen.analysis.eos import EOS
+
+from prlworkflows.analysis.adaptive_eos import eos_parameter_errors, next_eos_volumes
+
+
+def _energies(volumes, noise=1e-4):
+    """Birch-Murnaghan E(V) with v0=66 and b0=0.47 eV/A^3 plus deterministic noise"""
+    volumes = np.asarray(volumes)
+    eta = (66./volumes)**(2./3)
+    exact = -14.9 + 9.*0.47*66./16.*((eta - 1)**3*4.5 + (eta - 1)**2*(6. - 4.*eta))
+    return exact + noise*np.sin(1e3*volumes)
+
+
+def test_eos_parameter_errors_scale_with_noise():
+    """Parameter errors should vanish for exact energies and be larger for noisier ones"""
+    volumes = np.linspace(60., 72., 9)
+    errors = [eos_parameter_errors(EOS('birch_murnaghan').fit(volumes, _energies(volumes, noise=noise)))
+              for noise in (0., 1e-4, 1e-3)]
+    assert np.all(errors[0] < 1e-6)
+    assert np.all(errors[1] < errors[2])
+    # as many volumes as parameters
+    assert np.all(np.isinf(eos_parameter_errors(EOS('birch_murnaghan').fit(volumes[1::2], _energies(volumes[1::2])))))
+
+
+def test_adaptive_sampling_brackets_and_converges():
+    """A seed entirely below the minimum should be extended past it and refined until converged"""
+    volumes = list(np.linspace(56., 62., 4))
+    history = []
+    for iteration in range(20):
+        new_volumes, status = next_eos_volumes(volumes, _energies(volumes, noise=3e-3), eos='birch_murnaghan',
+                                               v0_tolerance=7.5e-4, b0_tolerance=3e-2)
+        history.append(status)
+        if not new_volumes:
+            break
+        volumes.extend(new_volumes)
+    assert not new_volumes
+    assert not history[0]['bracketed']
+    # refined at least once after bracketing the minimum
+    assert sum(status['bracketed'] for status in history) > 1
+    assert status['v0_relative_error'] <= 7.5e-4 and status['b0_relative_error'] <= 3e-2
+    assert np.isclose(status['v0'], 66., rtol=1e-3)
+    assert len(volumes) < 20
+
+
+def test_input_set_for_structure_keeps_settings():
+    """Input sets of added volumes should have the settings of the original input set"""
+    from pymatgen import Lattice, Structure
+    from pymatgen.io.vasp.sets import MPStaticSet
+    from prlworkflows.input_sets import input_set_for_structure
+    structure = Structure(Lattice.cubic(4.04), ['Al']*4, [[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]])
+    vis = MPStaticSet(structure, user_incar_settings={'ENCUT': 300})
+    scaled = structure.copy()
+    scaled.scale_lattice(70.)
+    for original in (vis, vis.as_dict()):
+        new_vis = input_set_for_structure(original, scaled)
+        assert isinstance(new_vis, MPStaticSet)
+        assert np.isclose(new_vis.structure.volume, 70.)
+        assert new_vis.incar['ENCUT'] == 300
+    assert np.isclose(vis.structure.volume, 4.04**3)
@@ -0,0 +1,46 @@
+"""
+Tests for the batch construction and submission of workflows
+"""
+
+import pytest
+from pymatgen import Lattice, Structure
+
+from prlworkflows.batch import get_structures, build_gibbs_workflows, submit_gibbs_workflows
+
+STRUCTURES = [Structure(Lattice.cubic(a), ['Al'], [[0, 0, 0]]) for a in (2.5, 2.6, 2.7)]
+
+
+class RecordingLaunchPad(object):
+    """Records the bulk inserts of workflows"""
+    def __init__(self):
+        self.batches = []
+
+    def bulk_add_wfs(self, wfs):
+        self.batches.append(list(wfs))
+
+
+def test_get_structures_from_directory(tmpdir):
+    """Structure files should be found recursively"""
+    for i, structure in enumerate(STRUCTURES):
+        structure.to(filename=str(tmpdir.mkdir('sqs-{}'.format(i)).join('POSCAR')))
+    structures = get_structures(structures=[STRUCTURES[0].as_dict()], directory=str(tmpdir))
+    assert len(structures) == 4
+    assert all(isinstance(structure, Structure) for structure in structures)
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_submit_gibbs_workflows_in_batches(processes):
+    """Every structure should get a workflow with its own tag, inserted in bulk"""
+    launchpad = RecordingLaunchPad()
+    report = submit_gibbs_workflows(launchpad, STRUCTURES, processes=processes, batch_size=2,
+                                    metadata={'tag': 'al'}, num_deformations=3)
+    assert report['num_workflows'] == 3
+    assert [len(batch) for batch in launchpad.batches] == [2, 1]
+    tags = [wf.metadata['tag'] for batch in launchpad.batches for wf in batch]
+    assert tags == ['al-0', 'al-1', 'al-2']
+
+
+def test_build_gibbs_workflows_unique_generated_tags():
+    """Without a tag in the metadata, each workflow should get its own generated tag"""
+    workflows = list(build_gibbs_workflows(STRUCTURES, processes=1, num_deformations=3))
+    assert len(set(wf.metadata['tag'] for wf in workflows)) == 3
@@ -0,0 +1,88 @@
+"""
+Tests for the on-disk array cache
+"""
+
+import os
+import time
+
+import numpy as np
+from pymatgen import Spin
+from pymatgen.electronic_structure.dos import Dos
+
+from prlworkflows.analysis.cache import ArrayCache, hash_arrays
+from prlworkflows.analysis.thermal_electronic import calculate_thermal_electronic_contribution_batch, \
+    thermal_electronic_cache_key
+
+
+def test_hash_arrays_depends_on_data_and_params():
+    """The hash should change with the array data, shape, dtype and the parameters"""
+    x = np.linspace(0., 1., 6)
+    reference = hash_arrays([x], {'a': 1})
+    assert hash_arrays([x.copy()], {'a': 1}) == reference
+    assert hash_arrays([x + 1e-15], {'a': 1}) != reference
+    assert hash_arrays([x.reshape(2, 3)], {'a': 1}) != reference
+    assert hash_arrays([x.astype(np.float32)], {'a': 1}) != reference
+    assert hash_arrays([x], {'a': 2}) != reference
+
+
+def test_array_cache_evicts_least_recently_used(tmpdir):
+    """Entries beyond the size limit should be evicted in least recently used order"""
+    entry = {'x': np.zeros(64*1024)}  # 0.5 MB
+    cache = ArrayCache(str(tmpdir), max_size=1.2)
+    cache.put('first', entry)
+    cache.put('second', entry)
+    # reading the first entry makes it the most recently used
+    past = time.time() - 100
+    os.utime(cache._path('second'), (past, past))
+    os.utime(cache._path('first'), (past - 100, past - 100))
+    assert np.array_equal(cache.get('first')['x'], entry['x'])
+    cache.put('third', entry)
+    assert cache.get('second') is None
+    assert cache.get('first') is not None
+    assert cache.get('third') is not None
+    assert cache.get('missing') is None
+
+
+def test_thermal_electronic_batch_uses_cache(tmpdir):
+    """Cached results should match the calculation and only depend on parameters that change the results"""
+    energies = np.linspace(-10., 10., 2001)
+    dos_objects = [Dos(0.0, energies, {Spin.up: 1.0 + slope*(energies + 10.)}) for slope in (0.05, 0.1)]
+    cache = ArrayCache(str(tmpdir))
+    expected = calculate_thermal_electronic_contribution_batch(dos_objects, t0=0, t1=500, td=10)
+    first = calculate_thermal_electronic_contribution_batch(dos_objects[:1], t0=0, t1=500, td=10, cache=cache)
+    assert len(os.listdir(str(tmpdir))) == 1
+    # one cached and one new DOS
+    cached = calculate_thermal_electronic_contribution_batch(dos_objects, t0=0, t1=500, td=10, memory_budget=1.0,
+                                                             cache=cache)
+    assert len(os.listdir(str(tmpdir))) == 2
+    assert np.array_equal(cached['free_energy'][0], first['free_energy'][0])
+    for key in ('free_energy', 'entropy', 'heat_capacity', 'n_electrons'):
+        assert np.allclose(cached[key], expected[key], rtol=1e-9, atol=1e-10)
+    assert np.array_equal(cached['temperature'], expected['temperature'])
+    key = thermal_electronic_cache_key(dos_objects[0], t0=0, t1=500, td=10)
+    assert key != thermal_electronic_cache_key(dos_objects[0], t0=0, t1=500, td=5)
+
+
+def test_array_cache_corrupt_entries_are_misses(tmpdir):
+    """Truncated or corrupt entries should be removed and treated as missing"""
+    cache = ArrayCache(str(tmpdir))
+    cache.put('truncated', {'x': np.arange(1000.)})
+    with open(cache._path('truncated'), 'rb') as fp:
+        data = fp.read()
+    with open(cache._path('truncated'), 'wb') as fp:
+        fp.write(data[:len(data)//2])
+    with open(cache._path('garbage'), 'wb') as fp:
+        fp.write(b'PK\x03\x04 not a zip file')
+    assert cache.get('truncated') is None
+    assert cache.get('garbage') is None
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_thermal_electronic_cache_key_depends_on_version(monkeypatch):
+    """Changing the algorithm version should invalidate the cached results"""
+    from prlworkflows.analysis import thermal_electronic
+    dos = Dos(0.0, np.linspace(-10., 10., 11), {Spin.up: np.ones(11)})
+    key = thermal_electronic_cache_key(dos, t0=0, t1=500, td=10)
+    monkeypatch.setattr(thermal_electronic, 'THERMAL_ELECTRONIC_CACHE_VERSION',
+                        thermal_electronic.THERMAL_ELECTRONIC_CACHE_VERSION + 1)
+    assert thermal_electronic_cache_key(dos, t0=0, t1=500, td=10) != key
@@ -0,0 +1,179 @@
+"""
+Tests for storing arrays in MongoDB documents
+"""
+
+import numpy as np
+import pytest
+
+from prlworkflows.database import encode_array, decode_array, delete_array, is_encoded_array
+
+FORCE_CONSTANTS = np.random.RandomState(0).uniform(-1., 1., (8, 8, 3, 3))
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_inline_array_round_trip(compress):
+    """Inline binary arrays should decode to exactly the original array"""
+    encoded = encode_array(FORCE_CONSTANTS, compress=compress)
+    assert is_encoded_array(encoded)
+    assert 'gridfs_id' not in encoded
+    decoded = decode_array(encoded)
+    assert decoded.dtype == FORCE_CONSTANTS.dtype
+    assert np.array_equal(decoded, FORCE_CONSTANTS)
+    decoded[0, 0, 0, 0] = 1.0  # decoded arrays are writeable
+
+
+def test_decode_legacy_nested_lists():
+    """Documents written before binary storage have nested lists"""
+    assert np.array_equal(decode_array(FORCE_CONSTANTS.tolist()), FORCE_CONSTANTS)
+
+
+def test_large_arrays_are_stored_in_gridfs():
+    """Arrays above the threshold should be stored in GridFS and decoded from it"""
+    mongomock = pytest.importorskip('mongomock')
+    pytest.importorskip('mongomock.gridfs').enable_gridfs_integration()
+    db = mongomock.MongoClient().db
+    encoded = encode_array(FORCE_CONSTANTS, db=db, gridfs_collection='phonon_fs', gridfs_threshold=1024)
+    assert 'data' not in encoded
+    db['phonon'].insert_one({'force_constants': encoded})
+    stored = db['phonon'].find_one()['force_constants']
+    assert np.array_equal(decode_array(stored, db=db), FORCE_CONSTANTS)
+    with pytest.raises(ValueError):
+        decode_array(stored)
+    delete_array(stored, db)
+    assert db['phonon_fs.files'].count_documents({}) == 0
+
+
+def test_static_calculations_bulk_read():
+    """Calculations should be read sorted by volume with their DOS from GridFS"""
+    mongomock = pytest.importorskip('mongomock')
+    pytest.importorskip('mongomock.gridfs').enable_gridfs_integration()
+    import gridfs
+    import json
+    import zlib
+    from pymatgen import Lattice, Structure, Spin
+    from pymatgen.electronic_structure.dos import CompleteDos, Dos
+    from prlworkflows.database import get_static_calculations
+    db = mongomock.MongoClient().db
+    fs = gridfs.GridFS(db, 'dos_fs')
+    for volume in [12., 10., 11.]:
+        structure = Structure(Lattice.cubic(volume**(1./3)), ['Al'], [[0, 0, 0]])
+        dos = CompleteDos(structure, Dos(volume, [0., 1.], {Spin.up: np.array([volume, volume])}), {})
+        # small chunks, so each DOS is split across several chunks
+        dos_fs_id = fs.put(zlib.compress(json.dumps(dos.as_dict()).encode()), chunkSize=16)
+        db['tasks'].insert_one({'task_id': int(volume), 'metadata': {'tag': 'al'},
+                                'output': {'energy': -volume, 'structure': structure.as_dict()},
+                                'calcs_reversed': [{'dos_fs_id': dos_fs_id, 'output': {'large': list(range(100))}}]})
+    db['tasks'].insert_one({'task_id': 0, 'metadata': {'tag': 'other'}})
+    calculations = get_static_calculations(db, 'al', threads=2)
+    assert np.allclose(calculations['volumes'], [10., 11., 12.])
+    assert calculations['energies'] == [-10., -11., -12.]
+    assert calculations['task_ids'] == [10, 11, 12]
+    assert [dos.efermi for dos in calculations['dos_objects']] == [10., 11., 12.]
+    # one full structure, of the smallest volume
+    assert 'structures' not in calculations
+    assert np.isclose(Structure.from_dict(calculations['structure']).volume, 10.)
+    assert 'dos_objects' not in get_static_calculations(db, 'al', dos=False)
+    assert len(get_static_calculations(db, 'al', dos=False, all_structures=True)['structures']) == 3
+
+
+def test_ensure_indexes():
+    """Missing indexes should be created and found afterwards"""
+    mongomock = pytest.importorskip('mongomock')
+    from prlworkflows.database import ensure_indexes, missing_indexes, INDEXES
+    db = mongomock.MongoClient().db
+    assert set(missing_indexes(db).keys()) == set(INDEXES.keys())
+    ensure_indexes(db)
+    assert missing_indexes(db) == {}
+    ensure_indexes(db)  # existing indexes are fine
+    assert 'metadata.tag_1' in db['tasks'].index_information()
+
+
+def test_ensure_indexes_with_existing_atomate_and_gridfs_indexes():
+    """Indexes that already exist with other options or names should be skipped, not recreated"""
+    mongomock = pytest.importorskip('mongomock')
+    pytest.importorskip('mongomock.gridfs').enable_gridfs_integration()
+    import gridfs
+    from prlworkflows.database import ensure_indexes, missing_indexes
+    db = mongomock.MongoClient().db
+    # like VaspCalcDb.build_indexes and GridFS
+    db['tasks'].create_index('task_id', unique=True)
+    db['phonon'].create_index('metadata.tag', name='tag')
+    gridfs.GridFS(db, 'dos_fs').put(b'dos')
+    created = ensure_indexes(db)
+    assert missing_indexes(db) == {}
+    assert created['phonon'] == []
+    assert db['tasks'].index_information()['task_id_1']['unique']
+    assert 'metadata.tag_1' not in db['phonon'].index_information()
+
+
+def test_query_plan_stages():
+    """Nested input stages should be flattened from the outermost stage"""
+    from prlworkflows.database import query_plan_stages
+    plan = {'stage': 'PROJECTION_SIMPLE', 'inputStage': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}}
+    assert query_plan_stages(plan) == ['PROJECTION_SIMPLE', 'FETCH', 'IXSCAN']
+    assert query_plan_stages({'stage': 'COLLSCAN'}) == ['COLLSCAN']
+
+
+class _RecordingCursor(list):
+    """Empty cursor whose query plan is an index scan"""
+
+    def explain(self):
+        return {'queryPlanner': {'winningPlan': {'stage': 'IXSCAN'}}}
+
+
+class _RecordingDatabase(object):
+    """Database without documents that records the (collection, query, projection) of find calls"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __getitem__(self, collection):
+        database = self
+
+        class Collection(object):
+            def find(self, query, projection=None):
+                database.queries.append((collection, query, projection))
+                return _RecordingCursor()
+        return Collection()
+
+
+def test_explain_queries_explains_the_static_calculations_query():
+    """The explained tasks query should be the query of get_static_calculations"""
+    from prlworkflows.database import explain_queries, get_static_calculations
+    db = _RecordingDatabase()
+    get_static_calculations(db, 'al', collection='tasks')
+    static_query = db.queries[0]
+    plans = explain_queries(db, tag='al')
+    assert plans['tasks'] == ['IXSCAN']
+    assert [query for query in db.queries if query[0] == 'tasks'] == [static_query, static_query]
+    assert 'output.structure.lattice.volume' in static_query[2]
+
+
+def test_load_qha_results(tmpdir):
+    """Binary and list QHA documents should be stacked into one table per quantity"""
+    mongomock = pytest.importorskip('mongomock')
+    from prlworkflows.database import load_qha_results, save_qha_results, load_qha_results_npz
+    db = mongomock.MongoClient().db
+    temperatures = np.arange(5., 2005., 5.)
+    gibbs = -np.random.RandomState(0).rand(3, temperatures.size)
+    for i, formula in enumerate(['Al', 'Ni', 'Cu']):
+        phonon = {'temperatures': temperatures, 'gibbs_free_energy': gibbs[i], 'optimum_volumes': gibbs[i] + 20.}
+        if formula != 'Cu':
+            phonon = {key: encode_array(value, compress=False) for key, value in phonon.items()}
+        else:
+            phonon = {key: value.tolist() for key, value in phonon.items()}
+        db['qha'].insert_one({'formula_pretty': formula, 'metadata': {'tag': formula.lower()}, 'phonon': phonon})
+    db['qha'].insert_one({'formula_pretty': 'Fe', 'debye': {}})
+    results = load_qha_results(db)
+    assert results['formulas'] == ['Al', 'Ni', 'Cu']
+    assert results['tags'] == ['al', 'ni', 'cu']
+    assert np.array_equal(results['temperatures'], temperatures)
+    assert np.array_equal(results['gibbs_free_energy'], gibbs)
+    assert np.array_equal(results['optimum_volumes'], gibbs + 20.)
+    assert load_qha_results(db, query={'formula_pretty': 'Ni'})['gibbs_free_energy'].shape == (1, temperatures.size)
+
+    path = str(tmpdir.join('qha.npz'))
+    save_qha_results(path, results)
+    loaded = load_qha_results_npz(path)
+    assert np.array_equal(loaded['gibbs_free_energy'], gibbs)
+    assert loaded['formulas'].tolist() == ['Al', 'Ni', 'Cu']
@@ -0,0 +1,53 @@
+"""
+Tests for the Debye model vibrational free energies
+"""
+
+import numpy as np
+from scipy.integrate import quadrature
+from pymatgen import Lattice, Structure
+
+from prlworkflows.analysis.debye import DebyeModel, debye_function
+
+AL_STRUCT = Structure(Lattice.cubic(4.04), ['Al', 'Al', 'Al', 'Al'],
+                      [[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]])
+AL_VOLUMES = np.linspace(60., 72., 7)
+# Birch-Murnaghan E-V curve with E0=-14.9 eV, B0=0.47 eV/Ang^3, B'=4.5, V0=66 Ang^3
+_ETA = (66. / AL_VOLUMES) ** (2. / 3.)
+AL_ENERGIES = -14.9 + 9. * 0.47 * 66. / 16. * ((_ETA - 1.) ** 3 * 4.5 + (_ETA - 1.) ** 2 * (6. - 4. * _ETA))
+
+
+def _reference_debye_integral(y):
+    """Adaptive quadrature implementation of the Debye integral, evaluated point by point"""
+    if y < 155:
+        return quadrature(lambda x: x ** 3 / (np.exp(x) - 1.), 0, y)[0] * 3. / y ** 3
+    return 6.493939 * 3. / y ** 3
+
+
+def test_debye_F_vib_grid_matches_pointwise_quadrature():
+    """Vectorized F_vib(V, T) should match the per-point adaptive quadrature to 1e-7"""
+    debye = DebyeModel(AL_ENERGIES, AL_VOLUMES, AL_STRUCT, t_min=5, t_step=50, t_max=2005)
+    assert debye.F_vib.shape == (AL_VOLUMES.size, debye.temperatures.size)
+    for v_idx, vol in enumerate(AL_VOLUMES):
+        for t_idx, temp in enumerate(debye.temperatures):
+            y = debye.debye_temperature(vol) / temp
+            expected = debye.kb * debye.natoms * temp * (9. / 8. * y + 3 * np.log(1 - np.exp(-y)) - _reference_debye_integral(y))
+            assert np.isclose(debye.F_vib[v_idx, t_idx], expected, rtol=1e-7, atol=0)
+
+
+def test_debye_integral_accepts_scalars_and_arrays():
+    """The Debye integral should give the same values for scalars and arrays, including the y > 155 limit"""
+    y = np.array([1e-3, 0.5, 3.0, 40.0, 154.0, 200.0])
+    values = DebyeModel.debye_integral(y)
+    assert values.shape == y.shape
+    assert np.allclose(values, [DebyeModel.debye_integral(yy) for yy in y], rtol=1e-14)
+    assert np.allclose(values, [_reference_debye_integral(yy) for yy in y], rtol=1e-7)
+
+
+def test_debye_function_relative_error():
+    """The Debye function should match high precision reference values to 1e-14 on both sides of the series cutoff"""
+    # reference values from arbitrary precision quadrature
+    y = np.array([0.01, 1., 2., 5., 30., 200.])
+    expected = np.array([0.99625499999404763, 0.67441556407781468, 0.44112847372762418,
+                         0.11759741179993396, 0.00072154882216335666, 2.4352272758500609e-6])
+    assert np.allclose(debye_function(y), expected, rtol=1e-14, atol=0)
+    assert debye_function(np.inf) == 0.0
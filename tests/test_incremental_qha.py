@@ -0,0 +1,126 @@
+"""
+Tests for the incremental quasiharmonic analysis
+"""
+
+import json
+import zlib
+
+import numpy as np
+import pytest
+
+from prlworkflows.analysis.incremental_qha import update_incremental_qha
+from prlworkflows.analysis.quasiharmonic import Quasiharmonic
+
+VOLUMES = np.linspace(60., 72., 7)
+# Birch-Murnaghan cold curve of Al with 4 atoms
+ENERGIES = -14.9 + 9.*0.47*66./16.*(((66./VOLUMES)**(2./3) - 1)**3*4.5 +
+                                    ((66./VOLUMES)**(2./3) - 1)**2*(6. - 4.*(66./VOLUMES)**(2./3)))
+
+
+def _insert_volume(db, fs, i):
+    """Insert the static calculation and phonon document of the ith volume"""
+    from pymatgen import Lattice, Structure
+    structure = Structure(Lattice.cubic(VOLUMES[i]**(1./3)), ['Al']*4,
+                          [[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]])
+    from pymatgen import Spin
+    from pymatgen.electronic_structure.dos import CompleteDos, Dos
+    energies = np.linspace(-10., 10., 2001)
+    dos = CompleteDos(structure, Dos(0.0, energies, {Spin.up: 1. + 0.01*i + 0.05*energies**2}), {})
+    dos_fs_id = fs.put(zlib.compress(json.dumps(dos.as_dict()).encode()))
+    db['tasks'].insert_one({'task_id': i, 'metadata': {'tag': 'al'},
+                            'output': {'energy': ENERGIES[i], 'structure': structure.as_dict()},
+                            'calcs_reversed': [{'dos_fs_id': dos_fs_id}]})
+    db['phonon'].insert_one({'metadata': {'tag': 'al'}, 'volume': VOLUMES[i],
+                             'F_vib': (-1e-4*(1 + VOLUMES[i]/100.)*np.arange(5, 505, 50)).tolist()})
+
+
+def test_incremental_qha_matches_full_qha():
+    """Provisional results should appear at min_volumes and the final result should match a full QHA"""
+    mongomock = pytest.importorskip('mongomock')
+    pytest.importorskip('mongomock.gridfs').enable_gridfs_integration()
+    import gridfs
+    db = mongomock.MongoClient().db
+    fs = gridfs.GridFS(db, 'dos_fs')
+    kwargs = dict(t_min=5, t_step=50, t_max=455, phonon=True, min_volumes=5)
+    for n, i in enumerate([3, 0, 6, 1, 5, 2, 4]):
+        _insert_volume(db, fs, i)
+        result = update_incremental_qha(db, 'al', len(VOLUMES), **kwargs)
+        if n + 1 < 5:
+            assert result is None
+            assert db['qha'].count_documents({}) == 0
+        else:
+            assert db['qha'].count_documents({}) == 1
+            stored = db['qha'].find_one({'metadata.tag': 'al'})
+            assert stored['num_volumes'] == n + 1
+            assert stored['provisional'] == (n + 1 < len(VOLUMES))
+            assert stored['incremental']
+    assert db['qha_columns'].count_documents({'metadata.tag': 'al'}) == len(VOLUMES)
+
+    from pymatgen import Structure
+    calcs = sorted(db['tasks'].find(), key=lambda calc: calc['task_id'])
+    volumes = [calc['output']['structure']['lattice']['volume'] for calc in calcs]
+    f_el = np.vstack([np.frombuffer(zlib.decompress(column['F_el']['data']))
+                      for column in sorted(db['qha_columns'].find(), key=lambda column: column['volume'])])
+    f_vib = np.array([doc['F_vib'] for doc in sorted(db['phonon'].find(), key=lambda doc: doc['volume'])])
+    full = Quasiharmonic(ENERGIES, volumes, Structure.from_dict(calcs[0]['output']['structure']), F_vib=f_vib, F_el=f_el,
+                         t_min=5, t_step=50, t_max=455)
+    stored = db['qha'].find_one({'metadata.tag': 'al'})
+    assert np.allclose(stored['phonon']['optimum_volumes'], full.optimum_volumes, rtol=1e-8)
+    assert np.isclose(stored['eos']['v0'], 66., rtol=1e-3)
+
+
+def test_incremental_qha_keeps_one_document_per_tag():
+    """Late updates with fewer volumes and concurrent first inserts should not duplicate the result"""
+    mongomock = pytest.importorskip('mongomock')
+    pytest.importorskip('mongomock.gridfs').enable_gridfs_integration()
+    import gridfs
+    from pymongo.errors import DuplicateKeyError
+    db = mongomock.MongoClient().db
+    fs = gridfs.GridFS(db, 'dos_fs')
+    for i in range(5):
+        _insert_volume(db, fs, i)
+    # a concurrent update already published a result with more volumes
+    db['qha'].insert_one({'metadata': {'tag': 'al'}, 'incremental': True, 'num_volumes': 6})
+    update_incremental_qha(db, 'al', len(VOLUMES), t_min=5, t_step=50, t_max=455, phonon=True, min_volumes=5)
+    assert db['qha'].count_documents({'metadata.tag': 'al'}) == 1
+    assert db['qha'].find_one({'metadata.tag': 'al'})['num_volumes'] == 6
+    with pytest.raises(DuplicateKeyError):
+        db['qha'].insert_one({'metadata': {'tag': 'al'}, 'incremental': True, 'num_volumes': 5})
+    # results of the full QHA analysis are not affected by the unique index
+    db['qha'].insert_one({'metadata': {'tag': 'al'}})
+    db['qha'].insert_one({'metadata': {'tag': 'al'}})
+
+
+def test_concurrent_column_updates_store_each_volume_once(monkeypatch):
+    """Two updates that both read the stored task_ids before either writes should store one column per volume"""
+    mongomock = pytest.importorskip('mongomock')
+    pytest.importorskip('mongomock.gridfs').enable_gridfs_integration()
+    import gridfs
+    from pymongo.errors import DuplicateKeyError
+    from prlworkflows.analysis.incremental_qha import add_qha_columns
+    db = mongomock.MongoClient().db
+    fs = gridfs.GridFS(db, 'dos_fs')
+    _insert_volume(db, fs, 0)
+    add_qha_columns(db, 'al', t_min=5, t_step=50, t_max=455)
+
+    # the second update read the stored task_ids before the first one wrote its column, so its
+    # upsert races the insert of the first update
+    find, update_one = mongomock.collection.Collection.find, mongomock.collection.Collection.update_one
+
+    def stale_find(self, *args, **kwargs):
+        if self.name == 'qha_columns':
+            return iter([])
+        return find(self, *args, **kwargs)
+
+    def racing_update_one(self, query, update, upsert=False, **kwargs):
+        if self.name == 'qha_columns' and upsert and self.count_documents(query) > 0:
+            raise DuplicateKeyError('E11000 duplicate key error')
+        return update_one(self, query, update, upsert=upsert, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, 'find', stale_find)
+    monkeypatch.setattr(mongomock.collection.Collection, 'update_one', racing_update_one)
+    assert add_qha_columns(db, 'al', t_min=5, t_step=50, t_max=455) == 1
+    monkeypatch.undo()
+    assert db['qha_columns'].count_documents({'metadata.tag': 'al', 'task_id': 0}) == 1
+    with pytest.raises(DuplicateKeyError):
+        db['qha_columns'].insert_one({'metadata': {'tag': 'al'}, 'task_id': 0})
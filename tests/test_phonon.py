@@ -0,0 +1,183 @@
+"""
+Tests for the phonon analysis helpers
+"""
+
+import numpy as np
+import pytest
+from phonopy import Phonopy
+from phonopy.structure.atoms import PhonopyAtoms
+from pymatgen.io.phonopy import get_pmg_structure
+
+from prlworkflows.analysis.phonon import read_force_constants_vasprun, converge_qpoint_mesh, \
+    get_phonopy_thermal_properties, qpoint_mesh_from_length, recalculate_phonon_thermal_properties, \
+    get_phonopy_from_document, interpolate_force_constants, interpolate_phonon_f_vib
+from prlworkflows.database import encode_array
+
+ATOMTYPES = [(2, 'Al', 26.982), (1, 'Ni', 58.693)]
+
+
+def _write_vasprun(path, hessian, version='5.4.4'):
+    """Write a minimal vasprun.xml of a force constants run with the mass-normalized Hessian"""
+    atomtypes = ''.join('<rc><c>{}</c><c>{:2s}</c><c>{}</c><c>3.0</c><c>PAW_PBE {}</c></rc>\n'.format(n, el, m, el)
+                        for n, el, m in ATOMTYPES)
+    # VASP 5.2.8 writes a broken PRECFOCK tag
+    precfock = '<i type="string" name="PRECFOCK">Normal</i>' if version != '5.2.8' else '<i type="string" name="PRECFOCK">Normal<'
+    rows = ''.join('<v>' + ' '.join('{:.8f}'.format(x) for x in row) + ' </v>\n' for row in hessian)
+    with open(path, 'w') as fp:
+        fp.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n<modeling>\n'
+                 '<generator><i name="version" type="string">{} </i></generator>\n'
+                 '<incar>\n{}\n</incar>\n'
+                 '<atominfo><array name="atomtypes"><set>\n{}</set></array></atominfo>\n'
+                 '<calculation><dynmat><varray name="hessian">\n{}</varray>\n'
+                 '<v name="eigenvalues">1.0 2.0</v></dynmat></calculation>\n'
+                 '</modeling>\n'.format(version, precfock, atomtypes, rows))
+
+
+def _reference_force_constants(hessian):
+    """Force constants the way phonopy's Vasprun builds them, block by block"""
+    masses = [m for n, el, m in ATOMTYPES for _ in range(n)]
+    num_atom = len(masses)
+    force_constants = np.zeros((num_atom, num_atom, 3, 3))
+    for i in range(num_atom):
+        for j in range(num_atom):
+            force_constants[i, j] = hessian[i*3:(i+1)*3, j*3:(j+1)*3]*-np.sqrt(masses[i]*masses[j])
+    return force_constants
+
+
+@pytest.mark.parametrize('version', ['5.4.4', '5.2.8'])
+def test_streaming_force_constants_match_blockwise_reference(tmpdir, version):
+    """The vectorized streaming reader should give exactly the force constants of the phonopy algorithm"""
+    hessian = np.random.RandomState(0).uniform(-1., 1., (9, 9))
+    path = str(tmpdir.join('vasprun.xml'))
+    _write_vasprun(path, hessian, version=version)
+    # the reference uses the rounded values that are in the file
+    expected = _reference_force_constants(np.round(hessian, 8))
+    force_constants, elements = read_force_constants_vasprun(path)
+    assert elements == ['Al', 'Ni']
+    assert force_constants.flags['C_CONTIGUOUS']
+    assert np.array_equal(force_constants, expected)
+
+
+def test_streaming_force_constants_wrong_size(tmpdir):
+    """A Hessian that does not match the atom types should raise"""
+    path = str(tmpdir.join('vasprun.xml'))
+    _write_vasprun(path, np.zeros((6, 6)))
+    with pytest.raises(ValueError):
+        read_force_constants_vasprun(path)
+
+
+def _fcc_spring_phonopy(a=4.04, supercell=4, a_rest=None):
+    """Phonopy object of FCC Al with nearest neighbor springs, at rest for the lattice parameter a_rest"""
+    a_rest = a_rest or a
+    unitcell = PhonopyAtoms(symbols=['Al'], cell=np.array([[0, a/2, a/2], [a/2, 0, a/2], [a/2, a/2, 0]]),
+                            scaled_positions=[[0, 0, 0]])
+    ph = Phonopy(unitcell, np.diag([supercell]*3))
+    ph.generate_displacements(distance=0.01)
+    forces = []
+    for displaced in ph.get_supercells_with_displacements():
+        positions, lattice = displaced.get_positions(), displaced.get_cell()
+        supercell_forces = np.zeros_like(positions)
+        for i in range(len(positions)):
+            frac = np.linalg.solve(lattice.T, (positions - positions[i]).T).T
+            bonds = np.dot(frac - np.round(frac), lattice)
+            lengths = np.linalg.norm(bonds, axis=1)
+            neighbors = (lengths > 0) & (lengths < 3.0)
+            stretch = (lengths[neighbors] - a_rest/np.sqrt(2))/lengths[neighbors]
+            supercell_forces[i] = np.sum(stretch[:, np.newaxis]*bonds[neighbors], axis=0)
+        forces.append(supercell_forces)
+    ph.set_forces(forces)
+    ph.produce_force_constants()
+    return ph
+
+
+def test_qpoint_mesh_from_length():
+    """The mesh should scale with the reciprocal lattice vector lengths of the primitive cell"""
+    ph = _fcc_spring_phonopy(supercell=1)
+    # |b| = sqrt(3)/a for FCC
+    assert qpoint_mesh_from_length(ph, 20.) == [int(np.ceil(20.*np.sqrt(3)/4.04))]*3
+    assert qpoint_mesh_from_length(ph, 0.01) == [1, 1, 1]
+
+
+def test_converged_qpoint_mesh_error_estimate():
+    """The converged F_vib should be within the tolerance of a very dense mesh"""
+    ph = _fcc_spring_phonopy()
+    qpoint_mesh, error, (temperatures, f_vib, s_vib, cv_vib) = converge_qpoint_mesh(ph, 1e-4, t_min=5, t_step=50,
+                                                                                    t_max=2000)
+    assert error < 1e-4
+    assert np.prod(qpoint_mesh) < 50**3
+    reference = get_phonopy_thermal_properties(ph, [50, 50, 50], t_min=5, t_step=50, t_max=2000)
+    assert np.allclose(f_vib, reference[1], rtol=0, atol=1e-4)
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_recalculate_phonon_thermal_properties_by_tag(processes):
+    """Recalculating from the stored force constants should update every document with the tag"""
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    supercell_matrices = [np.diag([2]*3).tolist(), np.diag([3]*3).tolist()]
+    for supercell_matrix in supercell_matrices:
+        ph = _fcc_spring_phonopy(supercell=supercell_matrix[0][0])
+        db['phonon'].insert_one({'metadata': {'tag': 'al'}, 'F_vib': [], 'unitcell': get_pmg_structure(ph.get_unitcell()).as_dict(),
+                                 'supercell_matrix': supercell_matrix, 'force_constants': encode_array(ph.get_force_constants())})
+    db['phonon'].insert_one({'metadata': {'tag': 'other'}, 'F_vib': []})
+    n_updated = recalculate_phonon_thermal_properties(db, 'al', t_min=5, t_step=100, t_max=1005, qpoint_mesh=[8, 8, 8],
+                                                      processes=processes)
+    assert n_updated == 2
+    for doc, supercell_matrix in zip(db['phonon'].find({'metadata.tag': 'al'}), supercell_matrices):
+        expected = get_phonopy_thermal_properties(_fcc_spring_phonopy(supercell=supercell_matrix[0][0]), [8, 8, 8],
+                                                  t_min=5, t_step=100, t_max=1005)
+        assert np.allclose(doc['F_vib'], expected[1], rtol=1e-12)
+        assert doc['qpoint_mesh'] == [8, 8, 8]
+    assert db['phonon'].find_one({'metadata.tag': 'other'})['F_vib'] == []
+
+
+def test_phonopy_from_document_with_gridfs_force_constants():
+    """The Phonopy object rebuilt from a document should reproduce the original thermal properties"""
+    mongomock = pytest.importorskip('mongomock')
+    pytest.importorskip('mongomock.gridfs').enable_gridfs_integration()
+    db = mongomock.MongoClient().db
+    ph = _fcc_spring_phonopy(supercell=2)
+    doc = {'unitcell': get_pmg_structure(ph.get_unitcell()).as_dict(), 'supercell_matrix': np.diag([2]*3).tolist(),
+           'force_constants': encode_array(ph.get_force_constants(), db=db, gridfs_threshold=0)}
+    rebuilt = get_phonopy_from_document(doc, db=db)
+    assert np.array_equal(rebuilt.get_force_constants(), ph.get_force_constants())
+    expected = get_phonopy_thermal_properties(ph, [8, 8, 8], t_min=5, t_step=100, t_max=1005)
+    assert np.allclose(get_phonopy_thermal_properties(rebuilt, [8, 8, 8], t_min=5, t_step=100, t_max=1005)[1],
+                       expected[1], rtol=1e-12)
+
+
+def test_interpolate_force_constants_exact_for_polynomial():
+    """Force constants quadratic in volume should be reproduced exactly"""
+    volumes = np.array([60., 64., 68., 72.])
+    base = np.random.RandomState(0).rand(2, 2, 3, 3)
+    force_constants = [base*(1 + 0.1*(v - 64) - 0.01*(v - 64)**2) for v in volumes]
+    interpolated = interpolate_force_constants(volumes, force_constants, [62., 70.])
+    assert interpolated.shape == (2, 2, 2, 3, 3)
+    for v, fc in zip([62., 70.], interpolated):
+        assert np.allclose(fc, base*(1 + 0.1*(v - 64) - 0.01*(v - 64)**2), rtol=1e-10)
+    # the degree is limited by the number of volumes
+    assert np.allclose(interpolate_force_constants(volumes[:2], force_constants[:2], [62.])[0],
+                       (force_constants[0] + force_constants[1])/2)
+
+
+def test_interpolate_phonon_f_vib():
+    """F_vib from interpolated force constants should be close to a direct calculation"""
+    a_rest, supercell = 4.04, 2
+    docs = []
+    for a in [3.98, 4.04, 4.10]:
+        ph = _fcc_spring_phonopy(a=a, supercell=supercell, a_rest=a_rest)
+        docs.append({'volume': a**3/4, 'unitcell': get_pmg_structure(ph.get_unitcell()).as_dict(),
+                     'supercell_matrix': np.diag([supercell]*3).tolist(), 'qpoint_mesh': [8, 8, 8],
+                     'force_constants': encode_array(ph.get_force_constants()),
+                     'F_vib': get_phonopy_thermal_properties(ph, [8, 8, 8], t_min=5, t_step=100, t_max=1005)[1].tolist()})
+    structures = [get_pmg_structure(_fcc_spring_phonopy(a=a, supercell=1, a_rest=a_rest).get_unitcell())
+                  for a in [3.98, 4.01, 4.04, 4.07, 4.10]]
+    f_vib, interpolation = interpolate_phonon_f_vib(docs[::-1], structures, t_min=5, t_step=100, t_max=1005)
+    assert f_vib.shape == (5, 11)
+    assert np.array_equal(f_vib[[0, 2, 4]], np.array([doc['F_vib'] for doc in docs]))
+    assert np.allclose(interpolation['interpolated_volumes'], [4.01**3/4, 4.07**3/4])
+    assert len(interpolation['leave_one_out_errors']) == 1
+    for i, a in [(1, 4.01), (3, 4.07)]:
+        expected = get_phonopy_thermal_properties(_fcc_spring_phonopy(a=a, supercell=supercell, a_rest=a_rest), [8, 8, 8],
+                                                  t_min=5, t_step=100, t_max=1005)[1]
+        assert np.max(np.abs(f_vib[i] - expected)) < interpolation['max_error']
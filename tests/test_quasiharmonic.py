@@ -0,0 +1,117 @@
+"""
+Tests for the quasiharmonic approximation and its EOS fitting
+"""
+
+import numpy as np
+from pymatgen import Lattice, Structure
+
+from prlworkflows.analysis.quasiharmonic import Quasiharmonic, fit_polynomial_eos, minimize_polynomial_eos
+
+AL_STRUCT = Structure(Lattice.cubic(4.04), ['Al', 'Al', 'Al', 'Al'],
+                      [[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]])
+VOLUMES = np.linspace(60., 72., 7)
+TEMPERATURES = np.arange(5, 2005, 5)
+
+
+def _birch_murnaghan(volumes, e0, b0, b1, v0):
+    """Third order Birch-Murnaghan E(V), broadcasting over all arguments"""
+    eta = (v0 / volumes) ** (2. / 3.)
+    return e0 + 9. * b0 * v0 / 16. * ((eta - 1.) ** 3 * b1 + (eta - 1.) ** 2 * (6. - 4. * eta))
+
+
+def _synthetic_gibbs_energies():
+    """G(V,T) with an equilibrium volume and energy that change linearly in temperature"""
+    v0 = 66. + 0.002 * TEMPERATURES
+    e0 = -14.9 - 1e-4 * TEMPERATURES
+    return _birch_murnaghan(VOLUMES[:, np.newaxis], e0, 0.47, 4.5, v0), e0, v0
+
+
+def test_polynomial_eos_recovers_birch_murnaghan_minima():
+    """A third order polynomial fit of Birch-Murnaghan curves should recover the exact minima for all temperatures"""
+    G, e0, v0 = _synthetic_gibbs_energies()
+    coefficients, reference_volume = fit_polynomial_eos(VOLUMES, G, order=3)
+    assert coefficients.shape == (4, TEMPERATURES.size)
+    G_opt, V_opt = minimize_polynomial_eos(coefficients, reference_volume, VOLUMES[np.argmin(G, axis=0)])
+    assert np.allclose(V_opt, v0, rtol=1e-10)
+    assert np.allclose(G_opt, e0, rtol=1e-10)
+
+
+def test_polynomial_fit_mode_matches_eos_fit_mode():
+    """The batch polynomial fit should give the same results as fitting each temperature with pymatgen"""
+    G, e0, v0 = _synthetic_gibbs_energies()
+    energies = G[:, 0]
+    F_vib = G - energies[:, np.newaxis]
+    kwargs = dict(F_vib=F_vib, t_min=5, t_step=5, t_max=2000, eos='birch_murnaghan')
+    qha_eos = Quasiharmonic(energies, VOLUMES, AL_STRUCT, fit_mode='eos', **kwargs)
+    qha_poly = Quasiharmonic(energies, VOLUMES, AL_STRUCT, fit_mode='polynomial', **kwargs)
+    assert np.allclose(qha_poly.optimum_volumes, qha_eos.optimum_volumes, rtol=1e-4)
+    assert np.allclose(qha_poly.gibbs_free_energy, qha_eos.gibbs_free_energy, rtol=1e-8)
+
+
+def test_warm_started_sweep_matches_cold_start():
+    """Seeding each temperature from the previous one should give the same results as fitting from scratch"""
+    G, e0, v0 = _synthetic_gibbs_energies()
+    energies = G[:, 0]
+    F_vib = G - energies[:, np.newaxis]
+    kwargs = dict(F_vib=F_vib, t_min=5, t_step=5, t_max=2000, eos='birch_murnaghan')
+    qha_cold = Quasiharmonic(energies, VOLUMES, AL_STRUCT, **kwargs)
+    qha_warm = Quasiharmonic(energies, VOLUMES, AL_STRUCT, warm_start=True, **kwargs)
+    assert np.allclose(qha_warm.optimum_volumes, qha_cold.optimum_volumes, rtol=1e-4)
+    assert np.allclose(qha_warm.gibbs_free_energy, qha_cold.gibbs_free_energy, rtol=1e-8)
+
+
+def test_shared_electronic_free_energy():
+    """Splitting the same G(V,T) between F_vib and a precomputed F_el should give the same minima"""
+    G, e0, v0 = _synthetic_gibbs_energies()
+    energies = G[:, 0]
+    F_thermal = G - energies[:, np.newaxis]
+    kwargs = dict(t_min=5, t_step=5, t_max=2000, fit_mode='polynomial')
+    qha_vib = Quasiharmonic(energies, VOLUMES, AL_STRUCT, F_vib=F_thermal, **kwargs)
+    qha_el = Quasiharmonic(energies, VOLUMES, AL_STRUCT, F_vib=F_thermal/2, F_el=F_thermal/2, **kwargs)
+    assert np.array_equal(qha_el.F_el, F_thermal/2)
+    assert np.allclose(qha_el.G_0, energies[:, np.newaxis] + F_thermal/2)
+    assert np.allclose(qha_el.optimum_volumes, qha_vib.optimum_volumes, rtol=1e-10)
+    assert np.allclose(qha_el.gibbs_free_energy, qha_vib.gibbs_free_energy, rtol=1e-10)
+
+
+def test_shared_gibbs_energy_and_cold_curve_fit():
+    """A Debye QHA with the G_0 and cold curve fit of another QHA should match one computing them itself"""
+    from pymatgen.analysis.eos import EOS
+    G, e0, v0 = _synthetic_gibbs_energies()
+    energies = G[:, 0]
+    F_el = 1e-3*(G - energies[:, np.newaxis])
+    kwargs = dict(t_min=5, t_step=5, t_max=2000, fit_mode='polynomial')
+    reference = Quasiharmonic(energies, VOLUMES, AL_STRUCT, F_el=F_el, **kwargs)
+    ev_eos_fit = EOS('vinet').fit(VOLUMES, energies)
+    shared = Quasiharmonic(energies, VOLUMES, AL_STRUCT, G_0=reference.G_0, vib_kwargs={'ev_eos_fit': ev_eos_fit},
+                           **kwargs)
+    assert shared.F_el is None
+    assert np.array_equal(shared.G_0, reference.G_0)
+    assert np.allclose(shared.F_vib, reference.F_vib, rtol=1e-12)
+    assert np.allclose(shared.optimum_volumes, reference.optimum_volumes, rtol=1e-10)
+
+
+def test_warm_started_sweep_needs_fewer_evaluations(monkeypatch):
+    """The warm started EOS fits should evaluate the EOS fewer times than cold started fits"""
+    import scipy.optimize
+    import pymatgen.analysis.eos
+    import prlworkflows.analysis.quasiharmonic as quasiharmonic
+    evaluations = [0]
+
+    def counting_leastsq(func, x0, args=(), **kwargs):
+        def counted(*func_args):
+            evaluations[0] += 1
+            return func(*func_args)
+        return scipy.optimize.leastsq(counted, x0, args=args, **kwargs)
+
+    monkeypatch.setattr(pymatgen.analysis.eos, 'leastsq', counting_leastsq)
+    monkeypatch.setattr(quasiharmonic, 'leastsq', counting_leastsq)
+    G, e0, v0 = _synthetic_gibbs_energies()
+    energies = G[:, 0]
+    kwargs = dict(F_vib=G - energies[:, np.newaxis], t_min=5, t_step=5, t_max=2000, eos='birch_murnaghan')
+    Quasiharmonic(energies, VOLUMES, AL_STRUCT, **kwargs)
+    cold_evaluations = evaluations[0]
+    evaluations[0] = 0
+    Quasiharmonic(energies, VOLUMES, AL_STRUCT, warm_start=True, **kwargs)
+    # about 22% fewer evaluations for this smooth sweep
+    assert evaluations[0] < 0.85*cold_evaluations
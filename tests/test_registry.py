@@ -0,0 +1,132 @@
+"""
+Tests for the registry of calculations by fingerprint
+"""
+
+import numpy as np
+import pytest
+
+from prlworkflows.registry import calculation_fingerprint, structures_match, find_registered_task, register_task, \
+    reuse_task, write_fingerprint, read_fingerprint
+
+SPECIES = ['Al', 'Al', 'Al', 'Ni']
+STRUCTURE = {'lattice': (4.04*np.eye(3)).tolist(), 'species': SPECIES,
+             'frac_coords': [[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]]}
+INCAR = {'ENCUT': 520, 'ISMEAR': -5, 'EDIFF': 1e-6, 'NPAR': 4}
+KPOINTS = {'comment': 'Automatic mesh', 'generation_style': 'Gamma', 'kpoints': [[11, 11, 11]]}
+POTCAR = ['PAW_PBE Al 04Jan2001', 'PAW_PBE Ni 02Aug2007']
+
+
+def _fingerprint(species=SPECIES, incar=INCAR, kpoints=KPOINTS):
+    return calculation_fingerprint(species, incar, kpoints=kpoints, potcar=POTCAR)
+
+
+def _structure(**changes):
+    return dict(STRUCTURE, **changes)
+
+
+def test_fingerprint_depends_on_composition_and_inputs():
+    """Site order and parallelization tags should not matter, the composition and settings should"""
+    reference = _fingerprint()
+    assert _fingerprint(species=SPECIES[::-1]) == reference
+    assert _fingerprint(incar=dict(INCAR, NPAR=8, LWAVE=False)) == reference
+    assert _fingerprint(kpoints=dict(KPOINTS, comment='other')) == reference
+    assert _fingerprint(species=['Al', 'Al', 'Ni', 'Ni']) != reference
+    assert _fingerprint(incar=dict(INCAR, ENCUT=400)) != reference
+    assert _fingerprint(kpoints=dict(KPOINTS, kpoints=[[9, 9, 9]])) != reference
+
+
+def test_structures_match_within_tolerance():
+    """Structures should match up to site order, periodic images and noise below the tolerance"""
+    frac_coords = np.array(STRUCTURE['frac_coords'], dtype=float)
+    order = [2, 0, 3, 1]
+    assert structures_match(STRUCTURE, _structure(species=[SPECIES[i] for i in order],
+                                                  frac_coords=frac_coords[order].tolist()))
+    shifted = frac_coords.copy()
+    shifted[0] = [1.0, -1.0, 0.99999]
+    assert structures_match(STRUCTURE, _structure(frac_coords=shifted.tolist()))
+    # close values on either side of a rounding boundary of the tolerance
+    near_boundary = frac_coords.copy()
+    near_boundary[1, 0] = 0.50049
+    other = frac_coords.copy()
+    other[1, 0] = 0.50051
+    assert structures_match(_structure(frac_coords=near_boundary.tolist()), _structure(frac_coords=other.tolist()))
+    assert structures_match(STRUCTURE, _structure(lattice=(4.04*np.eye(3) + 2e-4).tolist()))
+
+    displaced = frac_coords.copy()
+    displaced[1, 0] += 0.01
+    assert not structures_match(STRUCTURE, _structure(frac_coords=displaced.tolist()))
+    assert not structures_match(STRUCTURE, _structure(lattice=(4.1*np.eye(3)).tolist()))
+    # the Ni site moved onto an Al site
+    assert not structures_match(STRUCTURE, _structure(species=['Ni', 'Al', 'Al', 'Al']))
+    assert not structures_match(STRUCTURE, _structure(species=SPECIES[:3], frac_coords=frac_coords[:3].tolist()))
+
+
+def test_register_and_reuse_task():
+    """A registered successful task with a matching structure should be found and copied"""
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    db['counter'].insert_one({'_id': 'taskid', 'c': 2})
+    db['tasks'].insert_one({'task_id': 1, 'state': 'successful', 'task_label': 'static', 'metadata': {'tag': 'a'},
+                            'output': {'energy': -14.9}})
+    db['tasks'].insert_one({'task_id': 2, 'state': 'successful', 'task_label': 'static', 'metadata': {'tag': 'b'}})
+    fingerprint = _fingerprint()
+    assert find_registered_task(db['tasks'], fingerprint, STRUCTURE) is None
+    assert register_task(db['tasks'], fingerprint, STRUCTURE, {'task_label': 'static', 'metadata.tag': 'a'}) == 1
+    assert register_task(db['tasks'], fingerprint, STRUCTURE, {'metadata.tag': 'missing'}) is None
+    expanded = _structure(lattice=(4.1*np.eye(3)).tolist())
+    assert find_registered_task(db['tasks'], fingerprint, expanded) is None
+
+    task_doc = find_registered_task(db['tasks'], fingerprint, STRUCTURE)
+    assert task_doc['task_id'] == 1
+    task_id = reuse_task(db, task_doc, additional_fields={'task_label': 'static', 'metadata': {'tag': 'c'}})
+    assert task_id == 3
+    reused = db['tasks'].find_one({'metadata.tag': 'c'})
+    assert reused['task_id'] == 3
+    assert reused['reused_task_id'] == 1
+    assert reused['output']['energy'] == -14.9
+    assert db['tasks'].find_one({'task_id': 1})['metadata']['tag'] == 'a'
+
+
+class _RecordingCollection(object):
+    """Task collection that records the projections of its queries"""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.projections = []
+
+    def find(self, query, projection=None, **kwargs):
+        self.projections.append(dict(projection) if projection is not None else None)
+        return self.collection.find(query, projection, **kwargs)
+
+    def find_one(self, query, projection=None, **kwargs):
+        self.projections.append(dict(projection) if projection is not None else None)
+        return self.collection.find_one(query, projection, **kwargs)
+
+
+def test_candidates_are_filtered_by_volume_and_projected():
+    """Candidates should be limited to matching volumes and only the match should be read in full"""
+    mongomock = pytest.importorskip('mongomock')
+    db = mongomock.MongoClient().db
+    fingerprint = _fingerprint()
+    for task_id, scale in enumerate([1.0, 1.05, 0.95]):
+        db['tasks'].insert_one({'task_id': task_id, 'state': 'successful', 'metadata': {'tag': 'a'},
+                                'output': {'energy': -14.9*scale}})
+        register_task(db['tasks'], fingerprint, _structure(lattice=(4.04*scale*np.eye(3)).tolist()),
+                      {'task_id': task_id})
+    tasks = _RecordingCollection(db['tasks'])
+    # every lattice component is off by almost the tolerance, so the volumes differ
+    perturbed = _structure(lattice=(4.04*np.eye(3) + 9e-4).tolist())
+    task_doc = find_registered_task(tasks, fingerprint, perturbed, tolerance=1e-3)
+    assert task_doc['task_id'] == 0
+    assert task_doc['output']['energy'] == -14.9
+    assert tasks.projections == [{'fingerprint_structure': 1}, None]
+    # the other volumes are not candidates
+    volume = np.linalg.det(4.04*np.eye(3))
+    candidates = db['tasks'].find({'fingerprint': fingerprint, 'fingerprint_volume': {'$gte': volume - 1, '$lte': volume + 1}})
+    assert [candidate['task_id'] for candidate in candidates] == [0]
+
+
+def test_fingerprint_file_round_trip(tmpdir):
+    """The fingerprint of the inputs before VASP runs should be read back unchanged"""
+    write_fingerprint(_fingerprint(), STRUCTURE, str(tmpdir))
+    assert read_fingerprint(str(tmpdir)) == (_fingerprint(), STRUCTURE)
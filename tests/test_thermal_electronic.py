@@ -0,0 +1,122 @@
+"""
+Tests for the thermal electronic contributions calculated from the electronic DOS
+"""
+
+import numpy as np
+import pytest
+from scipy.optimize import brentq
+from pymatgen import Spin
+from pymatgen.electronic_structure.dos import Dos
+
+from prlworkflows.analysis.thermal_electronic import getdos, calculate_internal_energy, calculate_entropy, \
+    calculate_internal_energy_and_entropy, calculate_chemical_potential, calculate_thermal_electronic_contribution, \
+    calculate_thermal_electronic_contribution_batch, gfind, k_B
+
+# constant DOS of 2 states/eV from 10 eV below to 10 eV above the Fermi level
+CONSTANT_DOS = Dos(1.0, np.linspace(-9., 11., 2001), {Spin.up: np.full(2001, 2.0)})
+
+
+@pytest.mark.parametrize('dope', [0.0, 0.5, -0.5])
+def test_getdos_constant_dos_electrons_and_doping_shift(dope):
+    """Electrons below the Fermi level and the doping shift of a constant DOS should be exact"""
+    n_electrons, fermi_shift, energies, densities = getdos(CONSTANT_DOS, -100, 100, dope, 10001, 1000)
+    assert np.isclose(n_electrons, 20.0 + dope, rtol=1e-12)
+    assert np.isclose(fermi_shift, dope / 2.0, rtol=1e-12, atol=1e-12)
+    assert energies.size == densities.size == 10001
+    assert np.isclose(energies[0], -10.0 - dope / 2.0)
+    assert np.all(np.diff(energies) > 0)
+    assert np.allclose(densities, 2.0)
+
+
+@pytest.mark.parametrize('memory_budget', [None, 1.0, 1e-9])
+def test_blocked_internal_energy_and_entropy_match_broadcast_calculation(memory_budget):
+    """Streaming the temperatures in blocks should match the fully broadcast U and S for any memory budget"""
+    n_electrons, fermi_shift, energies, densities = getdos(CONSTANT_DOS, -100, 100, 0.0, 10001, 1000)
+    temperatures = np.arange(0, 2005, 5.0)
+    beta = 1.0/(temperatures*k_B)
+    beta[0] = 1.0e30
+    mu_el = np.zeros(temperatures.size)
+    expected_u = calculate_internal_energy(mu_el[:, np.newaxis], energies[np.newaxis, :], densities[np.newaxis, :], beta[:, np.newaxis])
+    expected_s = calculate_entropy(mu_el[:, np.newaxis], energies[np.newaxis, :], densities[np.newaxis, :], beta[:, np.newaxis])
+    u, s = calculate_internal_energy_and_entropy(mu_el, energies, densities, beta, memory_budget=memory_budget)
+    assert np.allclose(u, expected_u, rtol=1e-12, atol=1e-12)
+    assert np.allclose(s, expected_s, rtol=1e-12, atol=1e-15)
+
+
+@pytest.mark.parametrize('memory_budget', [None, 1.0])
+def test_vectorized_chemical_potential_matches_brentq(memory_budget):
+    """The vectorized chemical potential solver should find the same roots as brentq for each temperature"""
+    # linearly increasing DOS, so that the chemical potential shifts with temperature
+    dos = Dos(0.0, np.linspace(-10., 10., 2001), {Spin.up: np.linspace(0.5, 2.5, 2001)})
+    n_electrons, fermi_shift, energies, densities = getdos(dos, -100, 100, 0.0, 10001, 1000)
+    temperatures = np.arange(5, 2005, 50.0)
+    beta = 1.0/(temperatures*k_B)
+    expected = [brentq(gfind, -5.0, 5.0, args=(energies, densities, n_electrons, b)) for b in beta]
+    mu_el = calculate_chemical_potential(energies, densities, n_electrons, beta, memory_budget=memory_budget)
+    assert np.allclose(mu_el, expected, rtol=0, atol=1e-10)
+    assert np.all(np.diff(mu_el) < 0)
+
+
+@pytest.mark.parametrize('memory_budget', [None, 1.0, 1e-9])
+def test_seeded_chemical_potential_matches_brentq(memory_budget):
+    """Seeding from a coarse solve should find the same roots as brentq when mu shifts with temperature"""
+    # the chemical potential of a steep DOS shifts by about 0.1 eV up to 2000 K
+    x = np.linspace(-10., 10., 2001)
+    dos = Dos(0.0, x, {Spin.up: 0.1 + 4.0*np.clip(x + 1.0, 0, None)**2})
+    n_electrons, fermi_shift, energies, densities = getdos(dos, -100, 100, 0.0, 10001, 1000)
+    temperatures = np.arange(5, 2005, 5.0)
+    beta = 1.0/(temperatures*k_B)
+    mu_el = calculate_chemical_potential(energies, densities, n_electrons, beta, memory_budget=memory_budget)
+    expected = [brentq(gfind, -5.0, 5.0, args=(energies, densities, n_electrons, b)) for b in beta[::7]]
+    assert np.allclose(mu_el[::7], expected, rtol=0, atol=1e-10)
+    # the temperatures do not need to be in order
+    order = np.random.RandomState(0).permutation(beta.size)
+    assert np.allclose(calculate_chemical_potential(energies, densities, n_electrons, beta[order]), mu_el[order],
+                       rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('memory_budget', [None, 1e-9])
+def test_stacked_chemical_potential_matches_single_grids(memory_budget):
+    """Solving the temperatures of several energy grids together should match solving each grid alone"""
+    x = np.linspace(-10., 10., 2001)
+    grids = [getdos(Dos(0.0, x, {Spin.up: 1.0 + slope*(x + 10.)}), -100, 100, 0.0, 2001, 200) for slope in (0.05, 0.2)]
+    beta = 1.0/(np.arange(5, 2005, 100.0)*k_B)
+    n_electrons = np.array([grid[0] for grid in grids])
+    energies = np.array([grid[2] for grid in grids])
+    densities = np.array([grid[3] for grid in grids])
+    grid_index = np.repeat([0, 1], beta.size)
+    mu_el = calculate_chemical_potential(energies, densities, n_electrons, np.tile(beta, 2),
+                                         memory_budget=memory_budget, grid_index=grid_index)
+    for i, grid in enumerate(grids):
+        expected = calculate_chemical_potential(grid[2], grid[3], grid[0], beta)
+        assert np.allclose(mu_el[grid_index == i], expected, rtol=0, atol=1e-10)
+
+
+def test_sommerfeld_low_temperature_regime_matches_numerical_integration():
+    """The Sommerfeld regime should cover the lowest temperatures and agree with the numerical integrals to the tolerance"""
+    energies = np.linspace(-10., 10., 4001)
+    dos = Dos(0.0, energies, {Spin.up: 1.0 + 30.0*energies**2})
+    numerical = calculate_thermal_electronic_contribution(dos, t0=0, t1=500, td=5)
+    hybrid = calculate_thermal_electronic_contribution(dos, t0=0, t1=500, td=5, sommerfeld_tolerance=1e-2)
+    regime = hybrid['sommerfeld']
+    assert not np.any(numerical['sommerfeld'])
+    assert not regime[0] and regime[1] and not regime[-1]
+    # the Sommerfeld regime is a contiguous range of the lowest temperatures
+    assert np.all(np.diff(regime[1:].astype(int)) <= 0)
+    for key in ('free_energy', 'entropy', 'heat_capacity'):
+        assert np.allclose(hybrid[key][regime], numerical[key][regime], rtol=1e-2, atol=0)
+        assert np.allclose(hybrid[key][~regime], numerical[key][~regime], rtol=1e-2, atol=0)
+
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_batch_thermal_electronic_contribution_matches_single_dos(processes):
+    """Stacking the DOS of several volumes should give the same properties as evaluating each DOS separately"""
+    energies = np.linspace(-10., 10., 2001)
+    dos_objects = [Dos(0.0, energies, {Spin.up: 1.0 + slope*(energies + 10.)}) for slope in (0.05, 0.1, 0.2)]
+    batch = calculate_thermal_electronic_contribution_batch(dos_objects, t0=0, t1=1000, td=10, memory_budget=1.0,
+                                                            processes=processes)
+    assert batch['free_energy'].shape == (len(dos_objects), batch['temperature'].size)
+    for idx, dos in enumerate(dos_objects):
+        single = calculate_thermal_electronic_contribution(dos, t0=0, t1=1000, td=10)
+        for key in ('free_energy', 'entropy', 'heat_capacity', 'chemical_potential'):
+            assert np.allclose(batch[key][idx], single[key], rtol=1e-9, atol=1e-10)
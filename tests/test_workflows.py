@@ -137,3 +137,15 @@ def test_prl_gibbs_optimization():
     with_robust_optimize = get_wf_gibbs(STRUCT, {'OPTIMIZE': True,'ROBUST': True})
     assert len(with_optimize.fws) == len(without_optimize.fws)
     assert len(with_robust_optimize.fws) == len(without_optimize.fws)+2
+
+
+def test_gibbs_wf_rough_volume_search():
+    """The rough stage should only contain rough statics, the EOS analysis and the task adding the Gibbs workflow"""
+    wf = get_wf_gibbs(STRUCT, num_deformations=5, rough_volume_search=True, num_rough_deformations=4,
+                      metadata={'tag': 'rough-test'})
+    assert len(wf.fws) == 4 + 2
+    assert sum('rough_static' in fw.name for fw in wf.fws) == 4
+    gibbs_task = wf.fws[-1].tasks[0]
+    assert gibbs_task['eos_tag'] == 'rough-test-rough'
+    assert gibbs_task['gibbs_kwargs']['num_deformations'] == 5
+    assert gibbs_task['gibbs_kwargs']['metadata']['tag'] == 'rough-test'